@@ -0,0 +1,132 @@
+"""
+Attachment helpers.
+
+Downloaded media is kept in memory (a BytesIO) rather than being written to a temporary file just so that it can be
+passed to `from_file`. Only media larger than SPILL_THRESHOLD (or media that ffprobe has to seek through, such as
+video) is spilled to disk.
+
+Media that is uploaded ahead of time (prefetched, or cached by mxc URL) can be sent by reference, without going back
+through `send_message(file=...)`. This only works for unencrypted rooms: encrypted rooms need the media encrypted
+with per-file keys, so attachments for them must be uploaded at send time.
+"""
+import contextlib
+import io
+import json
+import subprocess
+import tempfile
+import typing
+from pathlib import Path
+
+import nio
+import niobot
+
+import tracing
+
+__all__ = (
+    "SPILL_THRESHOLD",
+    "media_source",
+    "rewind",
+    "open_attachment",
+    "probe_bytes",
+    "probe",
+    "msgtype_for",
+    "send_uploaded",
+)
+
+# Overridden by ATTACHMENT_SPILL_SIZE in the config, see main.py.
+SPILL_THRESHOLD = 16 * 1024 * 1024
+MediaSource = typing.Union[io.BytesIO, Path]
+
+
+@contextlib.contextmanager
+def media_source(data: typing.Union[bytes, memoryview], suffix: str = "", on_disk: bool = None) -> \
+        typing.Iterator[MediaSource]:
+    """Yields `data` as something `from_file` accepts: a BytesIO, or the path of a temporary file if `data` is larger
+    than SPILL_THRESHOLD (or on_disk is True). The temporary file is removed on exit."""
+    if on_disk is None:
+        on_disk = len(data) > SPILL_THRESHOLD
+    if not on_disk:
+        yield io.BytesIO(data)
+        return
+    with tempfile.NamedTemporaryFile(suffix=suffix) as file:
+        file.write(data)
+        file.flush()
+        yield Path(file.name)
+
+
+def rewind(source: MediaSource) -> MediaSource:
+    """Seeks a buffer back to the start (after from_file or PIL has read it), so that it can be read again."""
+    if isinstance(source, io.IOBase):
+        source.seek(0)
+    return source
+
+
+@contextlib.asynccontextmanager
+async def open_attachment(
+        cls: typing.Type["niobot.BaseAttachment"],
+        data: typing.Union[bytes, memoryview],
+        file_name: str,
+        **kwargs
+) -> typing.AsyncIterator["niobot.BaseAttachment"]:
+    """Creates an attachment of type `cls` from `data`, valid until the block exits (upload it inside the block).
+
+    Video and audio always go through a temporary file, since ffprobe needs to seek around in them."""
+    on_disk = True if issubclass(cls, (niobot.VideoAttachment, niobot.AudioAttachment)) else None
+    with media_source(data, Path(file_name).suffix, on_disk) as source:
+        yield await cls.from_file(source, file_name=file_name, **kwargs)
+
+
+def probe_bytes(data: typing.Union[bytes, memoryview], timeout: float = 60) -> dict:
+    """Runs ffprobe over `data` through a pipe, returning the same structure as niobot.get_metadata."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "quiet", "-of", "json", "-show_streams", "-show_format", "pipe:0"],
+        input=bytes(data),
+        capture_output=True,
+        timeout=timeout,
+        check=True
+    )
+    return json.loads(result.stdout)
+
+
+def probe(data: typing.Union[bytes, memoryview], suffix: str = "") -> dict:
+    """Probes `data`, through a pipe if possible. Some containers (such as MP4s with their index at the end) can't be
+    probed without seeking, so those fall back to a temporary file."""
+    if len(data) <= SPILL_THRESHOLD:
+        try:
+            metadata = probe_bytes(data)
+        except (subprocess.SubprocessError, ValueError):
+            metadata = None
+        if metadata and metadata.get("streams"):
+            return metadata
+    with media_source(data, suffix, on_disk=True) as path:
+        return niobot.get_metadata(str(path))
+
+
+def msgtype_for(attachment: "niobot.BaseAttachment") -> str:
+    if isinstance(attachment, niobot.ImageAttachment):
+        return "m.image"
+    if isinstance(attachment, niobot.VideoAttachment):
+        return "m.video"
+    if isinstance(attachment, niobot.AudioAttachment):
+        return "m.audio"
+    return "m.file"
+
+
+async def send_uploaded(
+        bot: niobot.NioBot,
+        room: typing.Union[nio.MatrixRoom, str],
+        content: dict,
+        reply_to: typing.Union[nio.Event, str] = None
+) -> nio.RoomSendResponse:
+    """Sends the content of a media event (such as an uploaded attachment's `as_body()`) to an unencrypted room,
+    optionally as a reply."""
+    if reply_to is not None:
+        event_id = reply_to if isinstance(reply_to, str) else reply_to.event_id
+        content = {**content, "m.relates_to": {"m.in_reply_to": {"event_id": event_id}}}
+    room_id = room if isinstance(room, str) else room.room_id
+    # Counted as a send_message, since that's what it stands in for.
+    with tracing.span("send_message"):
+        response = await bot.room_send(room_id, "m.room.message", content)
+    if not isinstance(response, nio.RoomSendResponse):
+        raise niobot.MessageException(response=response)
+    return response
@@ -0,0 +1,288 @@
+"""
+A fake Matrix homeserver, for benchmarking the bot without a network.
+
+It serves scripted /sync batches (whatever has been queued with `queue_message`, plus echoes of what the bot itself
+sent), and accepts /send, /upload, /redact and friends, recording when the bot's replies arrive. Anything it doesn't
+know about gets an empty 200, which is enough to keep the client happy.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import re
+import secrets
+import time
+import typing
+
+from aiohttp import web
+
+__all__ = ("FakeHomeserver",)
+
+
+class FakeHomeserver:
+    def __init__(self, user_id: str = "@bench-bot:localhost", device_id: str = "BENCH"):
+        self.user_id = user_id
+        self.device_id = device_id
+        self.server_name = user_id.split(":", 1)[1]
+        self.rooms: typing.Dict[str, typing.List[str]] = {}
+        self.announced: typing.Set[str] = set()
+        self.pending: typing.List[typing.Tuple[str, dict]] = []
+        self.requests = collections.Counter()
+        self.sent: typing.List[dict] = []
+        self.delivered: typing.Dict[str, float] = {}
+        self.replies: typing.Dict[str, float] = {}
+        self.outstanding: typing.Dict[str, typing.Deque[str]] = collections.defaultdict(collections.deque)
+        self.url: typing.Optional[str] = None
+        self._batch = itertools.count(1)
+        self._new_events = asyncio.Event()
+        self._replied = asyncio.Event()
+        self._synced = asyncio.Event()
+        self._runner: typing.Optional[web.AppRunner] = None
+        self.routes = [
+            ("GET", re.compile(r"/_matrix/client/versions$"), self.versions),
+            ("GET", re.compile(r"/account/whoami$"), self.whoami),
+            ("GET", re.compile(r"/sync$"), self.sync),
+            ("PUT", re.compile(r"/rooms/(?P<room>[^/]+)/send/(?P<type>[^/]+)/(?P<txn>[^/]+)$"), self.send),
+            ("PUT", re.compile(r"/rooms/(?P<room>[^/]+)/redact/(?P<event>[^/]+)/(?P<txn>[^/]+)$"), self.redact),
+            ("PUT", re.compile(r"/rooms/(?P<room>[^/]+)/state/(?P<type>[^/]+)(/(?P<key>[^/]*))?$"), self.state),
+            ("POST", re.compile(r"/upload$"), self.upload),
+            ("POST", re.compile(r"/rooms/(?P<room>[^/]+)/(leave|forget)$"), self.empty),
+            ("GET", re.compile(r"/rooms/(?P<room>[^/]+)/joined_members$"), self.joined_members),
+            ("GET", re.compile(r"/joined_rooms$"), self.joined_rooms),
+            ("POST", re.compile(r"/keys/upload$"), self.keys_upload),
+            ("POST", re.compile(r"/keys/query$"), self.keys_query),
+            ("POST", re.compile(r"/keys/claim$"), self.keys_claim),
+        ]
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+
+    def _event_id(self) -> str:
+        return "$%s:%s" % (secrets.token_hex(12), self.server_name)
+
+    def add_room(self, members: typing.Iterable[str] = ()) -> str:
+        """Creates a room with the bot (and `members`) joined. It is sent to the bot in the next sync."""
+        room_id = "!%s:%s" % (secrets.token_hex(9), self.server_name)
+        self.rooms[room_id] = [self.user_id, *members]
+        self._new_events.set()
+        return room_id
+
+    def queue_message(self, room_id: str, sender: str, body: str) -> str:
+        """Queues a text message for the next sync, returning its event ID."""
+        event_id = self._event_id()
+        self.pending.append(
+            (
+                room_id,
+                {
+                    "type": "m.room.message",
+                    "event_id": event_id,
+                    "sender": sender,
+                    "origin_server_ts": self._now_ms(),
+                    "content": {"msgtype": "m.text", "body": body},
+                    "unsigned": {"age": 0},
+                }
+            )
+        )
+        self._new_events.set()
+        return event_id
+
+    async def wait_for_sync(self, timeout: float = 30):
+        """Waits until the next sync response has been sent."""
+        self._synced.clear()
+        await asyncio.wait_for(self._synced.wait(), timeout)
+
+    async def wait_for_replies(self, event_ids: typing.Iterable[str], timeout: float = 60) -> bool:
+        """Waits until the bot has replied to all of `event_ids`, returning False if it didn't in time."""
+        event_ids = set(event_ids)
+        deadline = time.monotonic() + timeout
+        while not event_ids.issubset(self.replies):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._replied.clear()
+            try:
+                await asyncio.wait_for(self._replied.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = "http://%s:%d" % (host, port)
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        for method, pattern, handler in self.routes:
+            if request.method != method:
+                continue
+            match = pattern.search(request.path)
+            if match:
+                self.requests[handler.__name__] += 1
+                return await handler(request, **match.groupdict())
+        self.requests["other"] += 1
+        return web.json_response({})
+
+    async def _json(self, request: web.Request) -> dict:
+        try:
+            return await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return {}
+
+    async def versions(self, _):
+        return web.json_response({"versions": ["r0.6.1", "v1.1", "v1.2", "v1.3", "v1.4", "v1.5", "v1.6"]})
+
+    async def whoami(self, _):
+        return web.json_response({"user_id": self.user_id, "device_id": self.device_id})
+
+    async def joined_rooms(self, _):
+        return web.json_response({"joined_rooms": list(self.rooms)})
+
+    async def joined_members(self, _, room: str):
+        members = self.rooms.get(room, [])
+        return web.json_response({"joined": {user: {"display_name": user} for user in members}})
+
+    async def keys_upload(self, _):
+        return web.json_response({"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def keys_query(self, _):
+        return web.json_response({"device_keys": {}, "failures": {}})
+
+    async def keys_claim(self, _):
+        return web.json_response({"one_time_keys": {}, "failures": {}})
+
+    async def empty(self, _, **__):
+        return web.json_response({})
+
+    def _room_state(self, room_id: str) -> typing.List[dict]:
+        members = self.rooms[room_id]
+        state = [
+            {
+                "type": "m.room.create",
+                "state_key": "",
+                "sender": members[-1],
+                "event_id": self._event_id(),
+                "origin_server_ts": self._now_ms(),
+                "content": {"creator": members[-1], "room_version": "10"},
+            },
+            {
+                "type": "m.room.power_levels",
+                "state_key": "",
+                "sender": members[-1],
+                "event_id": self._event_id(),
+                "origin_server_ts": self._now_ms(),
+                "content": {"users": {user: 100 for user in members}, "users_default": 0},
+            },
+        ]
+        for user in members:
+            state.append(
+                {
+                    "type": "m.room.member",
+                    "state_key": user,
+                    "sender": user,
+                    "event_id": self._event_id(),
+                    "origin_server_ts": self._now_ms(),
+                    "content": {"membership": "join", "displayname": user},
+                }
+            )
+        return state
+
+    async def sync(self, request: web.Request):
+        since = request.query.get("since")
+        full_state = since is None or request.query.get("full_state") == "true"
+        timeout = int(request.query.get("timeout", 0)) / 1000
+        new_rooms = set(self.rooms) - self.announced
+        if not (self.pending or new_rooms or full_state):
+            self._new_events.clear()
+            try:
+                await asyncio.wait_for(self._new_events.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            new_rooms = set(self.rooms) - self.announced
+
+        pending, self.pending = self.pending, []
+        timelines = collections.defaultdict(list)
+        for room_id, event in pending:
+            timelines[room_id].append(event)
+        join = {}
+        for room_id in self.rooms:
+            if not (full_state or room_id in new_rooms or room_id in timelines):
+                continue
+            join[room_id] = {
+                "summary": {"m.joined_member_count": len(self.rooms[room_id]), "m.invited_member_count": 0},
+                "state": {"events": self._room_state(room_id) if (full_state or room_id in new_rooms) else []},
+                "timeline": {"events": timelines.get(room_id, []), "limited": False, "prev_batch": "p0"},
+                "ephemeral": {"events": []},
+                "account_data": {"events": []},
+                "unread_notifications": {"highlight_count": 0, "notification_count": 0},
+            }
+        self.announced.update(self.rooms)
+        body = {
+            "next_batch": "s%d" % next(self._batch),
+            "rooms": {"join": join, "invite": {}, "leave": {}},
+            "account_data": {"events": []},
+            "presence": {"events": []},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {"signed_curve25519": 50},
+        }
+        response = web.json_response(body)
+        now = time.perf_counter()
+        for room_id, event in pending:
+            if event["sender"] != self.user_id:
+                self.delivered[event["event_id"]] = now
+                self.outstanding[room_id].append(event["event_id"])
+        self._synced.set()
+        return response
+
+    async def send(self, request: web.Request, room: str, type: str, txn: str):
+        content = await self._json(request)
+        received = time.perf_counter()
+        event_id = self._event_id()
+        self.sent.append({"room_id": room, "type": type, "content": content, "event_id": event_id, "at": received})
+        if type == "m.room.message" and "m.new_content" not in content:
+            reply_to = content.get("m.relates_to", {}).get("m.in_reply_to", {}).get("event_id")
+            outstanding = self.outstanding[room]
+            if reply_to is None and outstanding:
+                reply_to = outstanding[0]
+            if reply_to in outstanding:
+                outstanding.remove(reply_to)
+            if reply_to is not None and reply_to not in self.replies:
+                self.replies[reply_to] = received
+                self._replied.set()
+        # Echo the event back, like a real server would.
+        self.pending.append(
+            (
+                room,
+                {
+                    "type": type,
+                    "event_id": event_id,
+                    "sender": self.user_id,
+                    "origin_server_ts": self._now_ms(),
+                    "content": content,
+                    "unsigned": {"age": 0, "transaction_id": txn},
+                }
+            )
+        )
+        self._new_events.set()
+        return web.json_response({"event_id": event_id})
+
+    async def redact(self, _, room: str, event: str, txn: str):
+        return web.json_response({"event_id": self._event_id()})
+
+    async def state(self, _, room: str, type: str, key: str = None):
+        return web.json_response({"event_id": self._event_id()})
+
+    async def upload(self, request: web.Request):
+        await request.read()
+        return web.json_response({"content_uri": "mxc://%s/%s" % (self.server_name, secrets.token_hex(12))})
@@ -0,0 +1,195 @@
+"""
+Replays a capture written by recorder.EventRecorder (RECORD_EVENTS in the config) through the bot.
+
+Events go through the same callbacks a live sync would drive (on_message, the room router and module handlers, and
+command dispatch), but every request the client makes is answered by a stub instead of a homeserver, so only the
+bot's own work is measured. Reports CPU time per event (overall, and by event type) and, with --tracemalloc, memory
+allocated during the replay and where it came from.
+
+    python bench/replay.py capture.jsonl[.zst] [--speed 1|10|max] [--owner @you:example.com] [--tracemalloc]
+"""
+import argparse
+import asyncio
+import collections
+import inspect
+import secrets
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from throughput import make_config  # noqa: E402
+
+# Minimal bodies for the responses that need one; everything else is parsed from an empty object.
+STUB_RESPONSES = {
+    "RoomSendResponse": lambda: {"event_id": "$%s" % secrets.token_hex(12)},
+    "RoomRedactResponse": lambda: {"event_id": "$%s" % secrets.token_hex(12)},
+    "RoomPutStateResponse": lambda: {"event_id": "$%s" % secrets.token_hex(12)},
+    "UploadResponse": lambda: {"content_uri": "mxc://replay/%s" % secrets.token_hex(12)},
+    "JoinedMembersResponse": lambda: {"joined": {}},
+}
+
+
+def stub_client(bot, calls: collections.Counter, latency: float):
+    """Answers every request the client makes locally, after `latency` seconds.
+
+    The bot never logs in, so it's given a token too: otherwise nio's logged-in checks on room_send, upload and so on
+    fail before a request ever reaches _send."""
+    async def _send(response_class, method, path, data=None, response_data=None, *args, **kwargs):
+        calls[response_class.__name__] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        body = STUB_RESPONSES.get(response_class.__name__, dict)()
+        return response_class.from_dict(body, *(response_data or ()))
+
+    bot._send = _send
+    bot.access_token = "replay"
+
+
+async def deliver(bot, room, event):
+    for callback in list(bot.event_callbacks):
+        if callback.filter is None or isinstance(event, callback.filter):
+            result = callback.func(room, event)
+            if inspect.isawaitable(result):
+                await result
+
+
+async def settle(baseline: typing.Set[asyncio.Task], timeout: float):
+    """Waits for tasks spawned by handlers (replies, module work) to finish."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pending = [
+            task for task in asyncio.all_tasks()
+            if task not in baseline and task is not asyncio.current_task() and not task.done()
+        ]
+        if not pending:
+            return
+        await asyncio.wait(pending, timeout=min(1.0, deadline - time.monotonic()))
+
+
+async def main(args: argparse.Namespace):
+    store = tempfile.TemporaryDirectory(prefix="niobot-replay-")
+    config = make_config("http://127.0.0.1:9", store.name, args.user_id)
+    if args.owner:
+        config.OWNER_ID = args.owner
+    sys.modules["config"] = config
+
+    import nio
+    import recorder
+    import main as bot_main
+
+    bot = bot_main.bot
+    calls = collections.Counter()
+    stub_client(bot, calls, args.outbound_latency / 1000)
+    if getattr(bot, "start_time", None) is None:
+        bot.start_time = time.time()
+    await bot_main.on_ready(None)
+    # Startup work (the empty room sweep, warming up ytdl workers) isn't what's being measured, so let it finish.
+    startup = [bot.room_sweep_task]
+    startup += [module.warm_task for module in bot.modules.values() if hasattr(module, "warm_task")]
+    await asyncio.wait(startup, timeout=args.timeout)
+    # The outbound scheduler's loop never finishes, so it's started now, and left out of what settle() waits for
+    # along with everything else that was already running.
+    bot.outbound.start()
+    baseline = set(asyncio.all_tasks())
+
+    records = list(recorder.read_capture(args.capture))
+    events = [record for record in records if record["type"] in ("event", "room")]
+    print("Replaying %d records from %s at %s speed" % (len(events), args.capture, args.speed), flush=True)
+
+    if args.tracemalloc:
+        tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+    cpu_by_type: typing.Dict[str, float] = collections.defaultdict(float)
+    count_by_type = collections.Counter()
+    speed = None if args.speed == "max" else float(args.speed)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    previous = None
+    delivered = 0
+    commands = 0
+    for record in events:
+        if speed and previous is not None:
+            await asyncio.sleep(max(0.0, (record["t"] - previous) / speed))
+        previous = record["t"]
+        if record["type"] == "room":
+            room = bot.rooms.get(record["room_id"])
+            if room is None:
+                room = bot.rooms[record["room_id"]] = nio.MatrixRoom(record["room_id"], bot.user_id)
+                room.add_member(bot.user_id, None, None)
+            room.name = record.get("name")
+            room.encrypted = record.get("encrypted", False)
+            continue
+        source = dict(record["event"])
+        # Replayed events would otherwise be ignored as having been sent before the bot started.
+        source["origin_server_ts"] = int(time.time() * 1000)
+        event = nio.Event.parse_event(source)
+        if isinstance(event, nio.RoomMessageText) and event.body.startswith(bot.command_prefix):
+            commands += 1
+        room = bot.rooms.get(record["room_id"])
+        if room is None:
+            room = bot.rooms[record["room_id"]] = nio.MatrixRoom(record["room_id"], bot.user_id)
+        if event.sender not in room.users:
+            room.add_member(event.sender, None, None)
+        start = time.process_time()
+        await deliver(bot, room, event)
+        cpu_by_type[type(event).__name__] += time.process_time() - start
+        count_by_type[type(event).__name__] += 1
+        delivered += 1
+        # Let spawned handlers run, as the sync loop would between events.
+        await asyncio.sleep(0)
+
+    await settle(baseline, args.timeout)
+    cpu_total = time.process_time() - cpu_start
+    wall_total = time.perf_counter() - wall_start
+
+    print("Events: %d in %.2fs wall, %.2fs CPU" % (delivered, wall_total, cpu_total))
+    if delivered:
+        print("CPU per event (including spawned work): %.3fms" % (cpu_total / delivered * 1000))
+    print("Dispatch CPU by event type (callbacks only):")
+    for name, total in sorted(cpu_by_type.items(), key=lambda item: item[1], reverse=True):
+        print("  %-28s %6d events %10.3fms total %8.3fms/event" % (
+            name, count_by_type[name], total * 1000, total / count_by_type[name] * 1000
+        ))
+    print("Client requests: %s" % dict(calls))
+    if commands and not calls["RoomSendResponse"]:
+        # Nothing reached the stub, so the numbers above don't include replying at all.
+        print("%d commands were replayed, but no events were sent." % commands, file=sys.stderr)
+        exit_code = 1
+    else:
+        exit_code = 0
+
+    if args.tracemalloc:
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = after.compare_to(before, "lineno")
+        allocated = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+        print("Allocations: %.1f KiB retained (%.1f B/event), peak traced %.1f KiB" % (
+            allocated / 1024, allocated / max(1, delivered), peak / 1024
+        ))
+        for stat in stats[:args.top]:
+            print("  %s" % stat)
+
+    await bot.close()
+    store.cleanup()
+    return exit_code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="A capture file written by the event recorder.")
+    parser.add_argument("--speed", default="max", help="1 for real time, 10 for 10x, or max (default) for no delays.")
+    parser.add_argument("--user-id", default="@replay-bot:localhost", help="The bot's user ID during the replay.")
+    parser.add_argument("--owner", help="The owner ID, so that owner-only commands in the capture run.")
+    parser.add_argument("--outbound-latency", type=float, default=0, help="Milliseconds each stubbed request takes.")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for spawned work to finish.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Trace allocations (slows the replay down).")
+    parser.add_argument("--top", type=int, default=15, help="How many allocation sites to show.")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,154 @@
+"""
+End-to-end command throughput benchmark.
+
+Runs the real bot (main.py, with all of its MODULES) against a local FakeHomeserver, and measures how long it takes
+from a command being delivered in a sync response to the bot's reply arriving at the server, at increasing room and
+event counts.
+
+Nothing leaves the machine: requests made through bot.http (the quote prefetcher, the support module's release
+checks and so on) are answered with a 503 by a mock transport, and counted.
+
+    python bench/throughput.py [--rooms 1 10 100] [--batch 1 10 50] [--commands ping help pp rooms.list] [--json out]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import httpx  # noqa: E402
+
+from fake_homeserver import FakeHomeserver  # noqa: E402
+
+OWNER = "@owner:localhost"
+COMMANDS = {
+    "ping": "?ping",
+    "help": "?help",
+    "pp": '?pp {"a": [1, 2, 3], "b": {"c": null}}',
+    "rooms.list": "?rooms.list",
+}
+
+
+# Hosts that bot.http was asked for, while benchmarking.
+BLOCKED_REQUESTS = collections.Counter()
+
+
+def offline(request: httpx.Request) -> httpx.Response:
+    BLOCKED_REQUESTS[request.url.host] += 1
+    return httpx.Response(503, text="Offline (benchmark).")
+
+
+def make_config(homeserver: str, store_path: str, user_id: str) -> types.ModuleType:
+    """A config module pointing the bot at the fake homeserver, with outbound rate limits out of the way, and other
+    HTTP requests kept off the network."""
+    config = types.ModuleType("config")
+    config.HOMESERVER = homeserver
+    config.USER_ID = user_id
+    config.DEVICE_ID = "BENCH"
+    config.TOKEN = "bench"
+    config.OWNER_ID = OWNER
+    config.STORE_PATH = store_path
+    config.LOG_LEVEL = logging.WARNING
+    config.OUTBOUND_RATE = config.OUTBOUND_ROOM_RATE = 1e9
+    config.OUTBOUND_BURST = config.OUTBOUND_ROOM_BURST = 1e9
+    config.EDIT_INTERVAL = 0
+    config.LAZY_MODULES = ()
+    config.HTTP_TRANSPORT = httpx.MockTransport(offline)
+    return config
+
+
+async def run_scenario(server: FakeHomeserver, rooms: list, command: str, count: int, timeout: float) -> dict:
+    import latency
+
+    event_ids = [server.queue_message(rooms[n % len(rooms)], OWNER, COMMANDS[command]) for n in range(count)]
+    started = time.perf_counter()
+    completed = await server.wait_for_replies(event_ids, timeout)
+    histogram = latency.Histogram()
+    replied = [event_id for event_id in event_ids if event_id in server.replies]
+    for event_id in replied:
+        histogram.record((server.replies[event_id] - server.delivered[event_id]) * 1000)
+    elapsed = (max(server.replies[e] for e in replied) - started) if replied else 0
+    percentiles = {p: value or 0.0 for p, value in histogram.percentiles(50, 95, 99).items()}
+    return {
+        "command": command,
+        "rooms": len(rooms),
+        "events": count,
+        "replied": len(replied),
+        "completed": completed,
+        "p50_ms": percentiles[50],
+        "p95_ms": percentiles[95],
+        "p99_ms": percentiles[99],
+        "throughput": len(replied) / elapsed if elapsed else 0.0,
+    }
+
+
+async def main(args: argparse.Namespace):
+    server = FakeHomeserver()
+    url = await server.start()
+    store = tempfile.TemporaryDirectory(prefix="niobot-bench-")
+    sys.modules["config"] = make_config(url, store.name, server.user_id)
+    all_rooms = [server.add_room((OWNER,))]
+
+    import main as bot_main
+    bot = bot_main.bot
+    bot_task = asyncio.create_task(bot.start(access_token="bench"))
+    try:
+        # Wait for on_ready to have mounted everything.
+        deadline = time.monotonic() + args.timeout
+        while "rooms.list" not in bot.commands:
+            if bot_task.done():
+                bot_task.result()
+            if time.monotonic() > deadline:
+                raise TimeoutError("The bot did not become ready in time.")
+            await asyncio.sleep(0.1)
+
+        # Warm up every command once, so first-call costs (imports, caches) aren't counted.
+        await run_scenario(server, all_rooms, "ping", 1, args.timeout)
+        for command in args.commands:
+            await run_scenario(server, all_rooms, command, 1, args.timeout)
+
+        results = []
+        for room_count in sorted(args.rooms):
+            while len(all_rooms) < room_count:
+                all_rooms.append(server.add_room((OWNER,)))
+            await server.wait_for_sync(args.timeout)
+            rooms = all_rooms[:room_count]
+            for command in args.commands:
+                for count in args.batch:
+                    result = await run_scenario(server, rooms, command, count, args.timeout)
+                    results.append(result)
+                    print(
+                        "{command:<12} rooms={rooms:<5} events={events:<5} p50={p50_ms:8.2f}ms p95={p95_ms:8.2f}ms "
+                        "p99={p99_ms:8.2f}ms {throughput:8.1f} cmd/s{incomplete}".format(
+                            incomplete="" if result["completed"] else " (INCOMPLETE)",
+                            **result
+                        ),
+                        flush=True
+                    )
+        print("Requests served: %s" % dict(server.requests))
+        print("Outbound HTTP requests blocked: %s" % dict(BLOCKED_REQUESTS))
+        if args.json:
+            Path(args.json).write_text(json.dumps(results, indent=4))
+    finally:
+        await bot.close()
+        bot_task.cancel()
+        await server.stop()
+        store.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--commands", nargs="+", choices=list(COMMANDS), default=list(COMMANDS))
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for each batch of replies.")
+    parser.add_argument("--json", help="Also write the results to this file as JSON.")
+    asyncio.run(main(parser.parse_args()))
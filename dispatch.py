@@ -0,0 +1,104 @@
+"""
+Room-indexed event routing.
+
+Rather than every module registering a global event callback and then checking the room ID itself, handlers are
+registered against specific room IDs (or a predicate, for the odd handler that needs to look at everything). Each
+event is then looked up by room ID, so events in rooms nobody cares about cost one dict lookup, and never touch a
+module's handler (or its locks).
+"""
+import asyncio
+import collections
+import dataclasses
+import logging
+import typing
+
+import nio
+import niobot
+
+__all__ = ("Route", "RoomEventRouter")
+
+Handler = typing.Callable[[nio.MatrixRoom, nio.Event], typing.Awaitable[typing.Any]]
+
+
+@dataclasses.dataclass(frozen=True)
+class Route:
+    handler: Handler
+    event_types: typing.Tuple[type, ...]
+    room_id: typing.Optional[str] = None
+    predicate: typing.Optional[typing.Callable[[nio.MatrixRoom, nio.Event], bool]] = None
+    include_old: bool = False
+
+
+class RoomEventRouter:
+    """Dispatches room events to the handlers registered for that room.
+
+    Handlers are run as their own tasks, so a slow handler doesn't hold up the sync loop (or other handlers)."""
+    def __init__(
+            self,
+            bot: niobot.NioBot,
+            event_types: typing.Tuple[type, ...] = (nio.RoomMessageText, nio.RoomMessageMedia)
+    ):
+        self.bot = bot
+        self.by_room: typing.Dict[str, typing.List[Route]] = collections.defaultdict(list)
+        self.predicates: typing.List[Route] = []
+        self.log = logging.getLogger(__name__)
+        self._tasks: typing.Set[asyncio.Task] = set()
+        # noinspection PyTypeChecker
+        bot.add_event_callback(self.dispatch, event_types)
+
+    def add(
+            self,
+            handler: Handler,
+            *,
+            room_id: str = None,
+            predicate: typing.Callable[[nio.MatrixRoom, nio.Event], bool] = None,
+            event_types: typing.Tuple[type, ...] = (nio.RoomMessageText,),
+            include_old: bool = False
+    ) -> Route:
+        """Registers a handler for events in `room_id`, or for any event matching `predicate`.
+
+        Events from before the bot started are skipped unless `include_old` is True."""
+        if (room_id is None) == (predicate is None):
+            raise ValueError("Exactly one of room_id or predicate must be given.")
+        route = Route(handler, tuple(event_types), room_id, predicate, include_old)
+        if room_id is not None:
+            self.by_room[room_id].append(route)
+        else:
+            self.predicates.append(route)
+        return route
+
+    def remove(self, handler: Handler):
+        """Removes every route for the given handler."""
+        for room_id in list(self.by_room):
+            self.by_room[room_id] = [route for route in self.by_room[room_id] if route.handler != handler]
+            if not self.by_room[room_id]:
+                del self.by_room[room_id]
+        self.predicates = [route for route in self.predicates if route.handler != handler]
+
+    def routes_for(self, room: nio.MatrixRoom, event: nio.Event) -> typing.List[Route]:
+        routes = self.by_room.get(room.room_id, [])
+        if self.predicates:
+            routes = routes + [route for route in self.predicates if route.predicate(room, event)]
+        return routes
+
+    async def dispatch(self, room: nio.MatrixRoom, event: nio.Event):
+        if room.room_id not in self.by_room and not self.predicates:
+            return
+        old = None
+        for route in self.routes_for(room, event):
+            if not isinstance(event, route.event_types):
+                continue
+            if not route.include_old:
+                if old is None:
+                    old = self.bot.is_old(event)
+                if old:
+                    continue
+            task = asyncio.create_task(route.handler(room, event))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            error = task.exception()
+            self.log.error("Error in room event handler: %r", error, exc_info=error)
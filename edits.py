@@ -0,0 +1,91 @@
+"""
+Coalescing message edits.
+
+Every edit is a full room event, and homeservers rate limit them like any other message. A command that edits its
+progress message several times in quick succession ends up waiting on 429s caused by its own progress updates, and
+spams busy rooms with events nobody reads.
+
+`coalesce(message)` wraps a sent message so that edits are sent at most once per `interval`. An edit made while one is
+waiting replaces it (so superseded states are never sent), and the latest state is always delivered eventually.
+"""
+import asyncio
+import logging
+import time
+import typing
+
+import metrics
+
+__all__ = ("CoalescedMessage", "coalesce", "DEFAULT_INTERVAL", "EDITS")
+
+# Overridden by EDIT_INTERVAL in the config, see main.py.
+DEFAULT_INTERVAL = 2.0
+EDITS = metrics.REGISTRY.counter(
+    "niobot_coalesced_edits_total",
+    "Progress message edits, by whether they were sent or superseded before they could be.",
+    ("result",)
+)
+log = logging.getLogger(__name__)
+
+
+class CoalescedMessage:
+    """Wraps a message (as returned by `Context.respond`), rate limiting its edits.
+
+    Any other attribute is passed through to the wrapped message."""
+    def __init__(self, message, interval: float = None):
+        self.message = message
+        self.interval = DEFAULT_INTERVAL if interval is None else interval
+        self._pending: typing.Optional[typing.Tuple[tuple, dict]] = None
+        self._last_edit = 0.0
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def __getattr__(self, item):
+        return getattr(self.message, item)
+
+    async def edit(self, *args, **kwargs) -> "CoalescedMessage":
+        """Queues an edit, replacing any edit that hasn't been sent yet. Returns immediately."""
+        return self.edit_nowait(*args, **kwargs)
+
+    def edit_nowait(self, *args, **kwargs) -> "CoalescedMessage":
+        """The same as `edit`, for callbacks that can't await (such as transfer progress callbacks)."""
+        if self._pending is not None:
+            EDITS.inc(result="superseded")
+        self._pending = (args, kwargs)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._deliver())
+        return self
+
+    async def _deliver(self):
+        while self._pending is not None:
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            args, kwargs = self._pending
+            self._pending = None
+            try:
+                await self.message.edit(*args, **kwargs)
+                EDITS.inc(result="sent")
+            except Exception as e:
+                log.warning("Failed to edit message: %r", e, exc_info=e)
+            finally:
+                self._last_edit = time.monotonic()
+
+    async def flush(self):
+        """Waits for the latest edit to be sent."""
+        if self._task is not None and not self._task.done():
+            await self._task
+
+    async def delete(self, *args, **kwargs):
+        """Drops any pending edits and deletes the message."""
+        if self._pending is not None:
+            EDITS.inc(result="superseded")
+            self._pending = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        return await self.message.delete(*args, **kwargs)
+
+
+def coalesce(message, interval: float = None) -> CoalescedMessage:
+    """Wraps `message` in a CoalescedMessage (if it isn't one already)."""
+    if isinstance(message, CoalescedMessage):
+        return message
+    return CoalescedMessage(message, interval)
@@ -1,77 +1,146 @@
-from types import NoneType
+import bisect
+import difflib
+import functools
+import typing
+
 import niobot
 from niobot.utils.help_command import *
 
 
+def display_name(class_name: str) -> str:
+    if class_name.endswith("Module"):
+        return class_name[:-6]
+    return class_name
+
+
+def module_name(command: niobot.Command) -> str:
+    """The display name of the module a command belongs to (including lazy modules that haven't loaded yet)."""
+    if command.module is not None:
+        return display_name(type(command.module).__name__)
+    return display_name(getattr(command, "lazy_module_name", None) or "N/A")
+
+
+class HelpIndex:
+    """Pre-rendered help, rebuilt only after commands or modules change.
+
+    Install it with `install()`, which hooks the bot's mount/unmount and add/remove command methods to invalidate it."""
+    def __init__(self, bot: niobot.NioBot):
+        self.bot = bot
+        self.overview: typing.Optional[str] = None
+        # module name -> rendered module help, and lower-cased name -> name
+        self.modules: typing.Dict[str, str] = {}
+        self.modules_lower: typing.Dict[str, str] = {}
+        # sorted (lower-cased name, name) pairs of every command name and alias, for prefix search
+        self.names: typing.List[typing.Tuple[str, str]] = []
+
+    def install(self):
+        for name in ("mount_module", "unmount_module", "add_command", "remove_command"):
+            method = getattr(self.bot, name, None)
+            if method is not None:
+                setattr(self.bot, name, self._invalidating(method))
+
+    def _invalidating(self, method: typing.Callable) -> typing.Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.invalidate()
+        return wrapper
+
+    def invalidate(self):
+        self.overview = None
+
+    def _line(self, command: niobot.Command) -> str:
+        return "- {}: {}".format(
+            format_command_line(self.bot.command_prefix, command),
+            get_short_description(command)
+        )
+
+    def build(self):
+        groups: typing.Dict[str, typing.List[niobot.Command]] = {}
+        seen = set()
+        for command in self.bot.commands.values():
+            if id(command) in seen:
+                continue
+            seen.add(id(command))
+            groups.setdefault(module_name(command), []).append(command)
+        for module in self.bot.modules:
+            groups.setdefault(display_name(type(module).__name__), [])
+
+        self.modules = {}
+        overview = []
+        for name, commands in groups.items():
+            lines = [self._line(command) for command in commands]
+            if commands:
+                self.modules[name] = "\n".join(["### Module {}".format(name), *lines, ""])
+                overview += ["### Module {!r}".format(name), *lines, ""]
+            else:
+                self.modules[name] = "No commands found in module {}".format(name)
+        self.modules_lower = {name.lower(): name for name in self.modules}
+        self.names = sorted((name.lower(), name) for name in self.bot.commands)
+        self.overview = "\n".join(overview)
+
+    def _ensure_built(self):
+        if self.overview is None:
+            self.build()
+
+    def get_overview(self) -> str:
+        """The rendered help for every command, grouped by module."""
+        self._ensure_built()
+        return self.overview
+
+    def get_module(self, name: str) -> typing.Optional[str]:
+        """The rendered help for a module, by exact name, or case-insensitively if no command shares the name."""
+        self._ensure_built()
+        if name in self.modules:
+            return self.modules[name]
+        if self.bot.get_command(name) is None and name.lower() in self.modules_lower:
+            return self.modules[self.modules_lower[name.lower()]]
+        return None
+
+    def search(self, query: str, limit: int = 5) -> typing.List[str]:
+        """Command names starting with `query`, then (if there's room) close fuzzy matches."""
+        self._ensure_built()
+        query = query.lower()
+        results = []
+        index = bisect.bisect_left(self.names, (query, ""))
+        while index < len(self.names) and len(results) < limit and self.names[index][0].startswith(query):
+            results.append(self.names[index][1])
+            index += 1
+        if len(results) < limit:
+            lowered = {lower: name for lower, name in self.names}
+            for match in difflib.get_close_matches(query, list(lowered), n=limit):
+                if lowered[match] not in results:
+                    results.append(lowered[match])
+        return results[:limit]
+
+
+def get_index(bot: niobot.NioBot) -> HelpIndex:
+    index = getattr(bot, "help_index", None)
+    if index is None:
+        index = bot.help_index = HelpIndex(bot)
+        index.install()
+    return index
+
+
 async def custom_help(ctx: niobot.Context, command_name: str = None):
     """Displays help about a command."""
-    if command_name is not None:
-        # check if the first arg is a module name
-        name = command_name
-        for module in ctx.bot.modules:
-            mn = type(module).__name__
-            if mn.endswith("Module"):
-                mn = mn[:-6]
-            matches = any(
-                (
-                    mn.lower() == name.lower() and ctx.bot.get_command(name) is None,
-                    mn == name,  # exact match, case sensitive
+    index = get_index(ctx.bot)
+    if command_name is None:
+        return await ctx.respond(index.get_overview())
+
+    # check if the first arg is a module name
+    module_help = index.get_module(command_name)
+    if module_help is not None:
+        return await ctx.respond(module_help)
+    if ctx.bot.get_command(command_name) is None:
+        suggestions = index.search(command_name)
+        if suggestions:
+            return await ctx.respond(
+                "No command or module named `{}`. Did you mean: {}?".format(
+                    command_name, ", ".join("`{}`".format(name) for name in suggestions)
                 )
             )
-            if matches:
-                # list all commands in this module
-                cmds = []
-                for cmd in ctx.bot.commands:
-                    command = ctx.bot.get_command(cmd)
-                    if command.module == module:
-                        if command not in cmds:
-                            cmds.append(command)
-                if cmds:
-                    lines = ['### Module {}'.format(mn)]
-                    for cmd in cmds:
-                        lines.append(
-                            "- {}: {}".format(
-                                format_command_line(ctx.client.command_prefix, cmd),
-                                get_short_description(cmd)
-                            )
-                        )
-                    lines.append("")
-                    return await ctx.respond("\n".join(lines))
-                else:
-                    return await ctx.respond("No commands found in module {}".format(mn))
-        # Defer showing help for a particular command to the built-in help command.
-        return await help_command_callback(ctx)
-    else:
-        mods = {}
-        seen = []
-        for cmd in ctx.bot.commands:
-            cmd = ctx.bot.get_command(cmd)
-            if cmd in seen:
-                continue
-            seen.append(cmd)
-            if cmd.module not in mods:
-                mods[cmd.module] = []
-            mods[cmd.module].append(cmd)
-        
-        
-        lines = []
-        for mod, cmds in mods.items():
-            if mod:
-                mod = type(mod).__name__
-            else:
-                mod = "N/A"
-            
-            if mod.endswith("Module"):
-                mod = mod[:-6]
-
-            lines.append(f"### Module {mod!r}")
-            for cmd in cmds:
-                lines.append(
-                    "- {}: {}".format(
-                        format_command_line(ctx.client.command_prefix, cmd),
-                        get_short_description(cmd)
-                    )
-                )
-            lines.append("")
-        
-        await ctx.respond("\n".join(lines))
+    # Defer showing help for a particular command to the built-in help command.
+    return await help_command_callback(ctx)
@@ -0,0 +1,280 @@
+"""
+A persistent, conditional-request aware cache for outbound GET requests.
+
+Responses are stored in SQLite (under STORE_PATH) along with their validators. While a response is fresh (per its
+`Cache-Control: max-age`), it is served straight from disk; once stale, it is revalidated with
+`If-None-Match`/`If-Modified-Since`, and a 304 is answered from the cache. GitHub doesn't count 304s against the rate
+limit, so this saves both budget and bandwidth. The store is bounded in size, evicting the least recently used
+responses first.
+
+This is a private cache: `s-maxage` (meant for shared caches) is ignored, responses are only served to requests that
+agree on the request headers named in their `Vary`, and responses to requests with credentials are keyed by those
+credentials, so they're never served to anyone else.
+
+Cached responses have `response.extensions["from_cache"]` set to True.
+"""
+import asyncio
+import email.utils
+import hashlib
+import json
+import logging
+import time
+import typing
+from pathlib import Path
+
+import httpx
+
+import metrics
+
+__all__ = ("HTTPCache", "CACHE_REQUESTS")
+
+CACHE_REQUESTS = metrics.REGISTRY.counter(
+    "niobot_http_cache_requests_total",
+    "Cacheable HTTP requests, by outcome (hit, revalidated, miss, uncacheable).",
+    ("result",)
+)
+# Headers that are worth keeping with a cached body. Everything else (cookies, hop-by-hop headers, rate limit
+# counters) is either meaningless or stale when replayed.
+STORED_HEADERS = (
+    "content-type",
+    "etag",
+    "last-modified",
+    "cache-control",
+    "expires",
+    "location",
+    "link",
+)
+
+
+def parse_cache_control(value: str) -> typing.Dict[str, typing.Optional[str]]:
+    directives = {}
+    for part in value.split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def freshness(headers: httpx.Headers, now: float) -> typing.Optional[float]:
+    """Returns when a response stops being fresh, or None if it must not be stored at all."""
+    directives = parse_cache_control(headers.get("cache-control", ""))
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return now
+    max_age = directives.get("max-age")
+    if max_age is not None:
+        try:
+            return now + max(0, int(max_age))
+        except ValueError:
+            return now
+    if "expires" in headers:
+        try:
+            return email.utils.parsedate_to_datetime(headers["expires"]).timestamp()
+        except (TypeError, ValueError):
+            return now
+    return now
+
+
+class HTTPCache:
+    """A size-bounded, disk-backed HTTP response cache.
+
+    If the database can't be opened, requests pass straight through to the network."""
+    def __init__(self, path: typing.Union[str, Path], max_size: int = 64 * 1024 * 1024, max_entry_size: int = None):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size or max_size // 8
+        self.db = None
+        self.log = logging.getLogger(__name__)
+        self._open_lock = asyncio.Lock()
+        self._failed = False
+
+    async def _connect(self):
+        if self.db is not None or self._failed:
+            return self.db
+        async with self._open_lock:
+            if self.db is None and not self._failed:
+                try:
+                    import aiosqlite
+
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    db = await aiosqlite.connect(self.path)
+                    async with db.execute("PRAGMA table_info(responses)") as cursor:
+                        columns = {row[1] for row in await cursor.fetchall()}
+                    if columns and "vary" not in columns:
+                        # From before responses were keyed by credentials and Vary, so none of them can be trusted.
+                        await db.execute("DROP TABLE responses")
+                    await db.execute(
+                        "CREATE TABLE IF NOT EXISTS responses ("
+                        "key TEXT PRIMARY KEY, "
+                        "url TEXT NOT NULL, "
+                        "status INTEGER NOT NULL, "
+                        "headers TEXT NOT NULL, "
+                        "body BLOB NOT NULL, "
+                        "size INTEGER NOT NULL, "
+                        "fresh_until REAL NOT NULL, "
+                        "last_used REAL NOT NULL, "
+                        "vary TEXT NOT NULL"
+                        ")"
+                    )
+                    await db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_used)")
+                    await db.commit()
+                    self.db = db
+                except Exception as e:
+                    self._failed = True
+                    self.log.error("Failed to open HTTP cache at %s, caching is disabled: %r", self.path, e, exc_info=e)
+        return self.db
+
+    async def close(self):
+        if self.db is not None:
+            db, self.db = self.db, None
+            await db.close()
+
+    @staticmethod
+    def key_for(url: str, headers: httpx.Headers, credentials: str = "") -> str:
+        # Different Accept headers can get different representations of the same URL, and a response to a request with
+        # credentials is only for requests with the same credentials.
+        return hashlib.sha256(
+            ("%s\n%s\n%s" % (url, headers.get("accept", ""), credentials)).encode()
+        ).hexdigest()
+
+    @staticmethod
+    def credentials_for(client: httpx.AsyncClient, request: httpx.Request, auth) -> typing.Optional[str]:
+        """Identifies the credentials a request is made with ("" for none), or None if they can't be identified (such
+        as a custom httpx.Auth, which only applies them as the request is sent)."""
+        if client.auth is not None:
+            return None
+        credentials = request.headers.get("authorization", "")
+        if isinstance(auth, tuple):
+            credentials += "\n%s:%s" % auth
+        elif auth is not None:
+            return None
+        return credentials
+
+    @staticmethod
+    def vary_for(response: httpx.Response) -> typing.Optional[typing.Dict[str, typing.Optional[str]]]:
+        """The request headers a response varies by, with the values they had. None if it varies by everything."""
+        names = [name.strip().lower() for name in response.headers.get("vary", "").split(",") if name.strip()]
+        if "*" in names:
+            return None
+        return {name: response.request.headers.get(name) for name in names}
+
+    @staticmethod
+    def _response(request: httpx.Request, status: int, headers: typing.List[list], body: bytes) -> httpx.Response:
+        return httpx.Response(
+            status,
+            headers=headers,
+            content=body,
+            request=request,
+            extensions={"from_cache": True}
+        )
+
+    async def get(self, client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+        """Performs a GET through the cache, with the same keyword arguments as `client.get`."""
+        db = await self._connect()
+        request = client.build_request(
+            "GET",
+            url,
+            **{name: kwargs.pop(name) for name in ("headers", "params", "cookies", "timeout") if name in kwargs}
+        )
+        credentials = self.credentials_for(client, request, kwargs.get("auth"))
+        if db is None or credentials is None:
+            CACHE_REQUESTS.inc(result="uncacheable")
+            return await client.send(request, **kwargs)
+
+        key = self.key_for(str(request.url), request.headers, credentials)
+        async with db.execute(
+            "SELECT status, headers, body, fresh_until, vary FROM responses WHERE key = ?", (key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        now = time.time()
+        if row is not None and any(request.headers.get(name) != value for name, value in json.loads(row[4]).items()):
+            # Stored for a request with different values for the headers the response varies by.
+            row = None
+
+        if row is not None:
+            status, headers, body, fresh_until, _ = row
+            headers = json.loads(headers)
+            if fresh_until > now:
+                CACHE_REQUESTS.inc(result="hit")
+                await self._touch(key, now)
+                return self._response(request, status, headers, body)
+            stored = httpx.Headers(headers)
+            if "etag" in stored:
+                request.headers["If-None-Match"] = stored["etag"]
+            if "last-modified" in stored:
+                request.headers["If-Modified-Since"] = stored["last-modified"]
+
+        response = await client.send(request, **kwargs)
+        if row is not None and response.status_code == 304:
+            CACHE_REQUESTS.inc(result="revalidated")
+            # A 304 may carry updated validators/freshness, which replace the stored ones.
+            merged = httpx.Headers(headers)
+            for name in STORED_HEADERS:
+                if name in response.headers:
+                    merged[name] = response.headers[name]
+            headers = [[name, value] for name, value in merged.multi_items()]
+            fresh_until = freshness(merged, now) or now
+            await db.execute(
+                "UPDATE responses SET headers = ?, fresh_until = ?, last_used = ? WHERE key = ?",
+                (json.dumps(headers), fresh_until, now, key)
+            )
+            await db.commit()
+            return self._response(request, status, headers, body)
+
+        await response.aread()
+        await self.store(key, response, now)
+        return response
+
+    async def store(self, key: str, response: httpx.Response, now: float):
+        fresh_until = freshness(response.headers, now)
+        validated = "etag" in response.headers or "last-modified" in response.headers
+        vary = self.vary_for(response)
+        if (
+                response.status_code != 200
+                or fresh_until is None
+                or vary is None
+                or (fresh_until <= now and not validated)
+                or len(response.content) > self.max_entry_size
+        ):
+            CACHE_REQUESTS.inc(result="uncacheable")
+            return
+        CACHE_REQUESTS.inc(result="miss")
+        headers = [[name, value] for name, value in response.headers.multi_items() if name.lower() in STORED_HEADERS]
+        await self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, url, status, headers, body, size, fresh_until, last_used, vary) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                str(response.url),
+                response.status_code,
+                json.dumps(headers),
+                response.content,
+                len(response.content),
+                fresh_until,
+                now,
+                json.dumps(vary)
+            )
+        )
+        await self.evict()
+        await self.db.commit()
+
+    async def _touch(self, key: str, now: float):
+        await self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        await self.db.commit()
+
+    async def evict(self):
+        """Removes the least recently used responses until the cache fits in max_size."""
+        async with self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses") as cursor:
+            (total,) = await cursor.fetchone()
+        if total <= self.max_size:
+            return
+        evict = []
+        async with self.db.execute("SELECT key, size FROM responses ORDER BY last_used") as cursor:
+            async for key, size in cursor:
+                if total <= self.max_size:
+                    break
+                evict.append((key,))
+                total -= size
+        await self.db.executemany("DELETE FROM responses WHERE key = ?", evict)
+        self.log.debug("Evicted %d responses from the HTTP cache", len(evict))
@@ -0,0 +1,132 @@
+"""
+The bot's shared HTTP clients.
+
+Creating a client per request throws away the connection (and TLS session) every time, so everything should go
+through `bot.http.get()` instead, which hands out long-lived, keep-alive pooled clients with shared timeouts, user
+agent, per-host connection limits, and HTTP/2 where the `h2` package is installed.
+"""
+import asyncio
+import logging
+import typing
+
+import httpx
+import niobot
+
+__all__ = ("HostLimitedTransport", "HTTPClients")
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    HTTP2_AVAILABLE = False
+else:
+    HTTP2_AVAILABLE = True
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Wraps a response body stream, calling `release` once it has been closed."""
+    def __init__(self, stream: httpx.AsyncByteStream, release: typing.Callable[[], None]):
+        self.stream = stream
+        self._release = release
+        self._released = False
+
+    async def __aiter__(self) -> typing.AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """A transport that allows at most `per_host` requests in flight to any single host.
+
+    A slot is held until the response body has been read (or the response closed), not just until the headers
+    arrive."""
+    def __init__(self, transport: httpx.AsyncBaseTransport, per_host: int):
+        self.transport = transport
+        self.per_host = per_host
+        self._semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        semaphore = self._semaphores.setdefault(request.url.host, asyncio.Semaphore(self.per_host))
+        await semaphore.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, semaphore.release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class HTTPClients:
+    """A registry of named, lazily created, shared httpx clients."""
+    def __init__(
+            self,
+            user_agent: str = niobot.__user_agent__,
+            timeout: float = 30,
+            max_connections: int = 100,
+            max_keepalive: int = 20,
+            per_host: int = 10,
+            http2: bool = None,
+            transport: httpx.AsyncBaseTransport = None
+    ):
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.per_host = per_host
+        self.http2 = HTTP2_AVAILABLE if http2 is None else http2
+        # Replaces the network for every client (for example, an httpx.MockTransport in benchmarks and tests).
+        self.transport = transport
+        self.clients: typing.Dict[str, httpx.AsyncClient] = {}
+        # An http_cache.HTTPCache, if responses should be cached.
+        self.cache = None
+        self.log = logging.getLogger(__name__)
+
+    def get(self, name: str = "default", **kwargs) -> httpx.AsyncClient:
+        """Returns the client with the given name, creating it with any extra httpx.AsyncClient kwargs if need be.
+
+        The kwargs are only used the first time a name is requested."""
+        client = self.clients.get(name)
+        if client is None or client.is_closed:
+            headers = {"User-Agent": self.user_agent}
+            headers.update(kwargs.pop("headers", {}))
+            kwargs.setdefault("follow_redirects", True)
+            kwargs.setdefault("timeout", self.timeout)
+            transport = HostLimitedTransport(
+                self.transport or httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2),
+                self.per_host
+            )
+            client = self.clients[name] = httpx.AsyncClient(headers=headers, transport=transport, **kwargs)
+            self.log.debug("Created HTTP client %r (http2=%s)", name, self.http2)
+        return client
+
+    async def cached_get(self, url: str, name: str = "default", **kwargs) -> httpx.Response:
+        """GETs `url` with the named client, through the response cache if there is one."""
+        client = self.get(name)
+        if self.cache is None:
+            return await client.get(url, **kwargs)
+        return await self.cache.get(client, url, **kwargs)
+
+    async def aclose(self):
+        """Closes every client (and the cache). They will be recreated if they are asked for again."""
+        if self.cache is not None:
+            await self.cache.close()
+        clients, self.clients = self.clients, {}
+        for name, client in clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                self.log.warning("Failed to close HTTP client %r: %r", name, e)
@@ -0,0 +1,191 @@
+"""
+Fair scheduling for long-running jobs (such as downloads).
+
+At most `concurrency` jobs run at once, and at most `per_user` of those belong to any one user. Waiting jobs are
+queued per user, and released round-robin between users, so one user queueing ten jobs doesn't hold everyone else up
+behind all ten.
+
+    async with scheduler.slot(ctx.message.sender, url, on_position=report) as job:
+        ...  # runs once it's this job's turn
+
+Jobs can be cancelled with `cancel`, whether they're still queued or already running: the task that entered the slot
+is cancelled, and `job.cancelled` is set so that work running in a thread can check it and stop early. The slot then
+raises JobCancelled, rather than the CancelledError, so that a cancelled job can be told apart from shutdown.
+"""
+import asyncio
+import collections
+import contextlib
+import itertools
+import logging
+import time
+import typing
+
+import metrics
+
+__all__ = ("Job", "JobCancelled", "JobScheduler", "QUEUED", "RUNNING", "DONE")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+
+JOB_WAIT = metrics.REGISTRY.histogram(
+    "niobot_job_wait_seconds",
+    "Time jobs spent queued before starting.",
+    ("scheduler",),
+    buckets=(0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+)
+
+PositionCallback = typing.Callable[["Job", int], typing.Awaitable[typing.Any]]
+
+
+class Job:
+    def __init__(self, job_id: int, owner: str, description: str):
+        self.id = job_id
+        self.owner = owner
+        self.description = description
+        self.state = QUEUED
+        self.cancelled = False
+        self.task: typing.Optional[asyncio.Task] = asyncio.current_task()
+        self.queued_at = time.monotonic()
+        self.started_at: typing.Optional[float] = None
+
+    def __repr__(self):
+        return "<Job id=%d owner=%r state=%s description=%r>" % (self.id, self.owner, self.state, self.description)
+
+
+class JobCancelled(Exception):
+    def __init__(self, job: Job):
+        super().__init__("Job %d was cancelled." % job.id)
+        self.job = job
+
+
+class JobScheduler:
+    def __init__(self, name: str, concurrency: int = 2, per_user: int = 1):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.per_user = max(1, per_user)
+        # owner -> their waiting jobs, oldest first.
+        self.waiting: typing.Dict[str, typing.Deque[Job]] = {}
+        self.running: typing.Dict[int, Job] = {}
+        self.jobs: typing.Dict[int, Job] = {}
+        self.log = logging.getLogger("%s.%s" % (__name__, name))
+        self._running_by_owner: typing.Counter[str] = collections.Counter()
+        # owner -> when they last had a job started (as a dispatch count). The round-robin goes to whoever's waited
+        # longest since their last turn, and owners who've never had one go first.
+        self._last_turn: typing.Dict[str, int] = {}
+        self._turns = itertools.count()
+        self._ids = itertools.count(1)
+        self._changed = asyncio.Event()
+
+    def __len__(self):
+        return sum(map(len, self.waiting.values()))
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _turn_order(self) -> typing.List[str]:
+        """Waiting owners, in the order they'll get their next turn."""
+        return sorted(self.waiting, key=lambda owner: self._last_turn.get(owner, -1))
+
+    def _next(self) -> typing.Optional[Job]:
+        for owner in self._turn_order():
+            if self._running_by_owner[owner] >= self.per_user:
+                continue
+            queue = self.waiting[owner]
+            job = queue.popleft()
+            if not queue:
+                del self.waiting[owner]
+            self._last_turn[owner] = next(self._turns)
+            return job
+
+    def _dispatch(self):
+        while len(self.running) < self.concurrency:
+            job = self._next()
+            if job is None:
+                break
+            job.state = RUNNING
+            job.started_at = time.monotonic()
+            self.running[job.id] = job
+            self._running_by_owner[job.owner] += 1
+            JOB_WAIT.observe(job.started_at - job.queued_at, scheduler=self.name)
+            self.log.info("Starting %r after %.1fs", job, job.started_at - job.queued_at)
+        self._notify()
+
+    def position(self, job: Job) -> int:
+        """How many queued jobs will (probably) start before this one."""
+        if job.state != QUEUED:
+            return 0
+        queues = [self.waiting[owner] for owner in self._turn_order()]
+        ahead = 0
+        for depth in itertools.count():
+            for queue in queues:
+                if depth < len(queue):
+                    if queue[depth] is job:
+                        return ahead
+                    ahead += 1
+        return ahead
+
+    @contextlib.asynccontextmanager
+    async def slot(
+            self,
+            owner: str,
+            description: str = "",
+            on_position: PositionCallback = None
+    ) -> typing.AsyncIterator[Job]:
+        """Waits for a turn to run a job on behalf of `owner`, calling `on_position` whenever its place in the queue
+        changes, and holds the slot until the block exits."""
+        job = Job(next(self._ids), owner, description)
+        self.jobs[job.id] = job
+        self.waiting.setdefault(owner, collections.deque()).append(job)
+        try:
+            self._dispatch()
+            last = None
+            while job.state == QUEUED:
+                changed = self._changed
+                position = self.position(job)
+                if on_position is not None and position != last:
+                    last = position
+                    await on_position(job, position)
+                if job.state == QUEUED:
+                    await changed.wait()
+            yield job
+        except asyncio.CancelledError:
+            if not job.cancelled:
+                raise
+            if hasattr(job.task, "uncancel"):
+                job.task.uncancel()
+            raise JobCancelled(job) from None
+        finally:
+            self._finish(job)
+
+    def _finish(self, job: Job):
+        if job.state == QUEUED:
+            queue = self.waiting.get(job.owner)
+            if queue is not None:
+                queue.remove(job)
+                if not queue:
+                    del self.waiting[job.owner]
+        elif job.state == RUNNING:
+            del self.running[job.id]
+            self._running_by_owner[job.owner] -= 1
+            if not self._running_by_owner[job.owner]:
+                del self._running_by_owner[job.owner]
+        if job.owner not in self.waiting and job.owner not in self._running_by_owner:
+            self._last_turn.pop(job.owner, None)
+        job.state = DONE
+        self.jobs.pop(job.id, None)
+        self._dispatch()
+
+    def jobs_for(self, owner: str) -> typing.List[Job]:
+        return [job for job in self.jobs.values() if job.owner == owner]
+
+    def cancel(self, job: Job) -> bool:
+        """Cancels a queued or running job. Returns False if it had already finished."""
+        if job.state == DONE or job.cancelled:
+            return False
+        self.log.info("Cancelling %r", job)
+        job.cancelled = True
+        if job.task is not None:
+            job.task.cancel()
+        return True
@@ -0,0 +1,166 @@
+"""
+Constant-memory streaming latency statistics.
+
+Rather than keeping every sample around and averaging them on demand, samples are counted into log-spaced buckets
+(in the same vein as HDR histograms), so memory is bounded by the range of values seen, not how many there were,
+and percentiles can be read without sorting a list of samples.
+"""
+import math
+import time
+import typing
+
+__all__ = ("Histogram", "RollingHistogram", "LatencyTracker")
+
+
+class Histogram:
+    """A log-bucketed histogram with a fixed relative precision.
+
+    With the default precision of 2%, values between 0.01ms and a day fit into roughly 1,100 buckets, however in
+    practice only a few dozen are ever populated."""
+    MIN_VALUE = 0.01
+
+    __slots__ = ("precision", "_log_base", "buckets", "count", "total", "min", "max")
+
+    def __init__(self, precision: float = 0.02):
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        return math.floor(math.log(max(value, self.MIN_VALUE)) / self._log_base)
+
+    def _value(self, index: int) -> float:
+        # The midpoint of the bucket, which is within half the precision of any value that landed in it.
+        return math.exp((index + 0.5) * self._log_base)
+
+    def record(self, value: float, count: int = 1):
+        """Records a value."""
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram"):
+        """Adds all the values recorded in another histogram (of the same precision) to this one."""
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def clear(self):
+        self.buckets.clear()
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def mean(self) -> typing.Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def percentiles(self, *percentiles: float) -> typing.Dict[float, typing.Optional[float]]:
+        """Returns the (approximate) value at each of the given percentiles, in a single pass over the buckets.
+
+        Values are None if nothing has been recorded."""
+        result = {p: None for p in percentiles}
+        if not self.count:
+            return result
+        # The extremes are known exactly, so only look up the percentiles in between.
+        for p in percentiles:
+            if p <= 0:
+                result[p] = self.min
+            elif p >= 100:
+                result[p] = self.max
+        targets = sorted((math.ceil(p / 100 * self.count), p) for p in percentiles if 0 < p < 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while targets and seen >= targets[0][0]:
+                _, p = targets.pop(0)
+                # A bucket's midpoint can lie outside the range of values actually recorded.
+                result[p] = min(max(self._value(index), self.min), self.max)
+            if not targets:
+                break
+        return result
+
+    def percentile(self, percentile: float) -> typing.Optional[float]:
+        return self.percentiles(percentile)[percentile]
+
+
+class RollingHistogram:
+    """A histogram covering only the last `window` seconds.
+
+    The window is split into `slots` sub-histograms which are recycled as time moves on, so old values fall out
+    `window / slots` seconds at a time."""
+    def __init__(self, window: float, slots: int, precision: float = 0.02):
+        self.window = window
+        self.slot_width = window / slots
+        self.precision = precision
+        self.slots = [Histogram(precision) for _ in range(slots)]
+        self.epochs = [-1] * slots
+
+    def _slot(self, now: float) -> Histogram:
+        epoch = int(now // self.slot_width)
+        position = epoch % len(self.slots)
+        if self.epochs[position] != epoch:
+            self.slots[position].clear()
+            self.epochs[position] = epoch
+        return self.slots[position]
+
+    def record(self, value: float, now: float = None):
+        self._slot(time.monotonic() if now is None else now).record(value)
+
+    def snapshot(self, now: float = None) -> Histogram:
+        """Merges the live slots into a single histogram."""
+        now = time.monotonic() if now is None else now
+        oldest = int(now // self.slot_width) - len(self.slots) + 1
+        merged = Histogram(self.precision)
+        for epoch, slot in zip(self.epochs, self.slots):
+            if epoch >= oldest:
+                merged.merge(slot)
+        return merged
+
+
+class LatencyTracker:
+    """Tracks latencies (in milliseconds) over rolling 1 minute, 15 minute and 1 hour windows, plus all time."""
+    WINDOWS = {
+        "1m": (60, 6),
+        "15m": (900, 15),
+        "1h": (3600, 12),
+    }
+
+    def __init__(self, precision: float = 0.02):
+        self.windows = {name: RollingHistogram(*spec, precision=precision) for name, spec in self.WINDOWS.items()}
+        self.all_time = Histogram(precision)
+        self.last: typing.Optional[float] = None
+
+    def record(self, latency: float):
+        now = time.monotonic()
+        for window in self.windows.values():
+            window.record(latency, now)
+        self.all_time.record(latency)
+        self.last = latency
+
+    def histogram(self, window: str = "15m") -> Histogram:
+        """Returns the histogram for the given window ("1m", "15m", "1h" or "all")."""
+        if window == "all":
+            return self.all_time
+        return self.windows[window].snapshot()
+
+    def percentiles(self, window: str = "15m", percentiles=(50, 95, 99)) -> typing.Dict[float, typing.Optional[float]]:
+        return self.histogram(window).percentiles(*percentiles)
+
+    def summary(self, window: str = "15m") -> str:
+        """A human-readable p50/p95/p99 summary, such as "p50 12.34ms, p95 56.78ms, p99 90.12ms"."""
+        values = self.percentiles(window)
+        if values[50] is None:
+            return "N/A"
+        return ", ".join("p%d %.2fms" % (p, value) for p, value in values.items())
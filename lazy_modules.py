@@ -0,0 +1,211 @@
+"""
+Lazy module mounting, and a report of how long each module took to load.
+
+A lazy module is only imported and mounted the first time one of its commands is used. Until then, it is
+represented by stub commands, built from a manifest of its commands that is recorded whenever the module is
+mounted for real. If there is no manifest for a module yet (or the module's source has changed since it was
+recorded), it is mounted eagerly so that one can be made.
+
+Modules that listen for events or run background tasks should not be lazy, as nothing runs until a command does.
+"""
+import asyncio
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+import typing
+from pathlib import Path
+
+import niobot
+
+__all__ = ("LazyModuleLoader",)
+
+
+class LazyModuleLoader:
+    def __init__(
+            self,
+            bot: niobot.NioBot,
+            manifest_path: typing.Union[str, Path],
+            lazy: typing.Iterable[str] = (),
+            budget: float = None
+    ):
+        self.bot = bot
+        self.manifest_path = Path(manifest_path)
+        self.lazy = set(lazy)
+        self.budget = budget
+        self.manifest: typing.Dict[str, dict] = {}
+        self.loaded: typing.Set[str] = set()
+        self.failed: typing.Dict[str, Exception] = {}
+        # module path -> (seconds, top-level packages it pulled in)
+        self.timings: typing.Dict[str, typing.Tuple[float, typing.List[str]]] = {}
+        self.startup_time = 0.0
+        self.log = logging.getLogger(__name__)
+        self._locks: typing.Dict[str, asyncio.Lock] = {}
+        try:
+            self.manifest = json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _source_mtime(module_path: str) -> typing.Optional[float]:
+        spec = importlib.util.find_spec(module_path)
+        if spec is None or not spec.origin:
+            return None
+        try:
+            return os.path.getmtime(spec.origin)
+        except OSError:
+            return None
+
+    def _has_fresh_manifest(self, module_path: str) -> bool:
+        entry = self.manifest.get(module_path)
+        return bool(entry) and entry.get("mtime") == self._source_mtime(module_path)
+
+    def save_manifest(self):
+        try:
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            self.manifest_path.write_text(json.dumps(self.manifest, indent=4))
+        except OSError as e:
+            self.log.warning("Failed to save module manifest to %s: %r", self.manifest_path, e)
+
+    def mount(self, module_path: str):
+        """Mounts a module right now, recording how long it took and what it imported."""
+        before = set(sys.modules)
+        start = time.perf_counter()
+        self.bot.mount_module(module_path)
+        elapsed = time.perf_counter() - start
+        pulled_in = sorted({name.split(".")[0] for name in set(sys.modules) - before} - {module_path.split(".")[0]})
+        self.timings[module_path] = (elapsed, pulled_in)
+        self.loaded.add(module_path)
+        self.failed.pop(module_path, None)
+        self._record(module_path)
+
+    def _record(self, module_path: str):
+        commands = {}
+        for command in self.bot.commands.values():
+            if type(command.module).__module__ == module_path and command.name not in commands:
+                commands[command.name] = {
+                    "name": command.name,
+                    "aliases": list(getattr(command, "aliases", None) or ()),
+                    "description": getattr(command, "description", None),
+                    "usage": getattr(command, "usage", None),
+                    "hidden": getattr(command, "hidden", False),
+                    "module": type(command.module).__name__,
+                }
+        self.manifest[module_path] = {
+            "mtime": self._source_mtime(module_path),
+            "commands": list(commands.values()),
+        }
+
+    def mount_all(self, modules: typing.Iterable[str]):
+        """Mounts the given modules, deferring lazy ones that have a manifest."""
+        start = time.perf_counter()
+        for module_path in modules:
+            try:
+                if module_path in self.lazy and self._has_fresh_manifest(module_path):
+                    self._add_stubs(module_path)
+                else:
+                    self.mount(module_path)
+            except Exception as e:
+                self.failed[module_path] = e
+                self.log.error("Failed to load %s: %s", module_path, e, exc_info=True)
+        self.startup_time += time.perf_counter() - start
+        self.save_manifest()
+
+    def _add_stubs(self, module_path: str):
+        for spec in self.manifest[module_path]["commands"]:
+            stub = niobot.Command(
+                spec["name"],
+                self._make_stub(module_path, spec["name"]),
+                aliases=spec["aliases"],
+                description=spec["description"],
+                usage=spec["usage"],
+                hidden=spec["hidden"],
+                # The real command parses the arguments, so the stub takes any number of them.
+                greedy=True,
+                arguments=[niobot.Argument("args", str, required=False, default=None)],
+            )
+            stub.lazy_module = module_path
+            stub.lazy_module_name = spec["module"]
+            self.bot.add_command(stub)
+        self.log.debug("Deferred loading %s", module_path)
+
+    def _remove_stubs(self, module_path: str):
+        for name, command in list(self.bot.commands.items()):
+            if getattr(command, "lazy_module", None) == module_path:
+                self.bot.commands.pop(name)
+
+    def _make_stub(self, module_path: str, name: str):
+        async def lazy_command(ctx: niobot.Context, args: str = None):
+            await self.ensure_loaded(module_path)
+            command = self.bot.get_command(name)
+            if command is None or getattr(command, "lazy_module", None):
+                raise niobot.CommandDisabledError("%s is no longer provided by %s" % (name, module_path))
+            # The stub has none of the real command's checks (such as is_owner), so run them before invoking it.
+            await self._run_checks(command, ctx)
+            # invoke only parses the arguments, and returns the callback's coroutine.
+            return await (await command.invoke(ctx))
+
+        lazy_command.__doc__ = "Loads %s, then runs %s." % (module_path, name)
+        return lazy_command
+
+    @staticmethod
+    async def _run_checks(command: niobot.Command, ctx: niobot.Context):
+        """Runs a command's checks the same way Command.invoke does, raising CheckFailure if any of them fail."""
+        names = getattr(command.callback, "__nio_checks__", {})
+        for check in command.checks:
+            name = names.get(check, getattr(check, "__name__", repr(check)))
+            try:
+                result = await niobot.force_await(check, ctx)
+            except niobot.CheckFailure:
+                raise
+            except Exception as e:
+                raise niobot.CheckFailure(name, exception=e) from e
+            if not result:
+                raise niobot.CheckFailure(name)
+
+    async def ensure_loaded(self, module_path: str):
+        """Mounts a lazy module if it isn't already."""
+        lock = self._locks.setdefault(module_path, asyncio.Lock())
+        async with lock:
+            if module_path in self.loaded:
+                return
+            # Do the (slow) import off the event loop. mount_module then finds it already in sys.modules.
+            start = time.perf_counter()
+            before = set(sys.modules)
+            await niobot.run_blocking(importlib.import_module, module_path)
+            import_time = time.perf_counter() - start
+            self._remove_stubs(module_path)
+            try:
+                self.mount(module_path)
+            except Exception:
+                self._add_stubs(module_path)
+                raise
+            elapsed, _ = self.timings[module_path]
+            pulled_in = sorted({name.split(".")[0] for name in set(sys.modules) - before} - {"modules"})
+            self.timings[module_path] = (import_time + elapsed, pulled_in)
+            self.log.info("Lazily loaded %s in %.2f seconds", module_path, import_time + elapsed)
+            self.save_manifest()
+
+    def report(self, import_time: float = None) -> typing.List[str]:
+        """Lines describing where startup time went, and which modules are still deferred."""
+        lines = []
+        startup = self.startup_time
+        if import_time is not None:
+            lines.append("main imports: %.3fs" % import_time)
+            startup += import_time
+        for module_path, (elapsed, pulled_in) in sorted(self.timings.items(), key=lambda x: x[1][0], reverse=True):
+            lines.append(
+                "%s: %.3fs%s" % (module_path, elapsed, " (imported %s)" % ", ".join(pulled_in) if pulled_in else "")
+            )
+        for module_path in self.lazy - self.loaded - set(self.failed):
+            if module_path in self.manifest:
+                lines.append("%s: deferred" % module_path)
+        for module_path, error in self.failed.items():
+            lines.append("%s: failed (%r)" % (module_path, error))
+        lines.append("startup total: %.3fs" % startup)
+        if self.budget is not None and startup > self.budget:
+            lines.append("over the startup budget of %.3fs by %.3fs!" % (self.budget, startup - self.budget))
+        return lines
@@ -1,27 +1,43 @@
-import collections
+import time
+IMPORT_STARTED = time.perf_counter()
+
+import functools
+import heapq
+import inspect
 import io
+import itertools
+import json
 import os
 import sys
 import shutil
 import subprocess
 import pathlib
-import time
-import httpx
-from datetime import timedelta
+import typing
 from pathlib import Path
 
-import psutil
 import logging
 import asyncio
 
 import config
 
 import nio
-import humanize
 import niobot
-from bs4 import BeautifulSoup
 from niobot import Context, NioBotException
+import attachments
+import dispatch
+import edits
 import help_command
+import http_cache
+import http_client
+import latency
+import lazy_modules
+import metrics
+import outbound
+import recorder
+import system_stats
+import tracing
+
+IMPORT_TIME = time.perf_counter() - IMPORT_STARTED
 
 os.chdir(pathlib.Path(__file__).parent.absolute())
 if not os.path.exists("./venv"):
@@ -42,49 +58,312 @@ MODULES = (
 )
 
 
+QUEUE_DROPPED = metrics.REGISTRY.counter(
+    "niobot_background_queue_dropped_total",
+    "Jobs dropped because the background queue and its overflow buffer were both full."
+)
+
+
+class Job(typing.NamedTuple):
+    """A serialisable job descriptor, which is dispatched by name to a handler registered with BackgroundQueue.job"""
+    name: str
+    kwargs: dict
+    id: int | None = None
+
+
 class BackgroundQueue:
     """Handles deferring tasks (such as cleanup) to a queue.
 
-    This queue system works in a FIFO system, and does not delay between task jobs.
-    This is deal for tasks that need to be done in the background, but not necessarily immediately, or are maybe
-    important however are async and do not have an async context.
+    Jobs are run by a pool of workers (see ``QUEUE_WORKERS`` in config), lowest priority value first, and FIFO
+    within a single priority lane. This is ideal for tasks that need to be done in the background, but not
+    necessarily immediately, or are maybe important however are async and do not have an async context.
+
+    Coroutines (and other awaitables) are awaited directly on the event loop, while plain callables are sent off to
+    the thread pool via niobot.run_blocking.
+
+    If ``QUEUE_DURABLE`` is set in config, jobs added via `add_job` are persisted to an SQLite database in the
+    store directory, and are only removed once they have run. Anything left over from a previous run is replayed
+    when the workers start, and only a queue's worth of jobs is ever held in memory.
 
     Or maybe just some simple tasks are thrown in here, who knows, who cares. If its in here, it'll get run."""
-    def __init__(self):
-        self.queue = asyncio.Queue(getattr(config, "QUEUE_SIZE", 100))
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 5
+    PRIORITY_CLEANUP = 10
+
+    def __init__(self, workers: int = None, durable: bool = None):
+        self.queue = asyncio.PriorityQueue(getattr(config, "QUEUE_SIZE", 100))
         self.log = logging.getLogger("bot_queue")
-        self.task: asyncio.Task | None = None
+        self.worker_count = max(1, workers or getattr(config, "QUEUE_WORKERS", 4))
+        self.tasks: list[asyncio.Task] = []
+        # Jobs that were added while the queue was full, as a heap ordered like the queue itself. These are fed back
+        # into the queue (best first) as slots free up. Past QUEUE_OVERFLOW_SIZE, new jobs are dropped.
+        self.overflow: list = []
+        self.overflow_size = getattr(config, "QUEUE_OVERFLOW_SIZE", 1000)
+        self._overflow_freed = asyncio.Event()
+        self._counter = itertools.count()
+
+        self.durable = getattr(config, "QUEUE_DURABLE", False) if durable is None else durable
+        self.db_path = Path(getattr(config, "STORE_PATH", "./store")) / "queue.db"
+        self.handlers: dict[str, typing.Callable] = {}
+        self.db = None
+        self.db_ready = asyncio.Event()
+        self.durable_task: asyncio.Task | None = None
+        self._inserts: list[tuple[str, str, int]] = []
+        self._finished: list[int] = []
+        self._wakeup = asyncio.Event()
+        self._closing = False
 
     def start_worker(self):
-        self.task = asyncio.create_task(self.worker())
+        """Starts the worker pool. Does nothing for workers that are already running.
+
+        In durable mode, this also opens the job database and replays any unfinished jobs."""
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < self.worker_count:
+            self.tasks.append(asyncio.create_task(self.worker(len(self.tasks))))
+        if self.durable and (self.durable_task is None or self.durable_task.done()):
+            self.durable_task = asyncio.create_task(self.durable_loop())
+
+    def job(self, name: str = None):
+        """Registers a job handler, which jobs added with `add_job` are dispatched to by name.
+
+        Handlers are called with the job's keyword arguments, and may be sync or async."""
+        def decorator(func):
+            self.handlers[name or func.__name__] = func
+            return func
+        return decorator
+
+    def add_job(self, name: str, priority: int = PRIORITY_NORMAL, **kwargs) -> bool:
+        """Adds a job by descriptor, without waiting. Keyword arguments must be JSON serialisable.
+
+        In durable mode, the job is written to disk in the next batch and survives restarts until it has run.
+        Otherwise, it's added with `add`, and False is returned if it had to be dropped."""
+        if name not in self.handlers:
+            raise KeyError("No job handler registered for %r" % name)
+        if not self.durable:
+            return self.add(Job(name, kwargs), priority)
+        self._persist(name, kwargs, priority)
+        return True
+
+    async def put_job(self, name: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        """Like `add_job`, but waits for room (with `put`) rather than dropping the job when the queue is full."""
+        if name not in self.handlers:
+            raise KeyError("No job handler registered for %r" % name)
+        if not self.durable:
+            return await self.put(Job(name, kwargs), priority)
+        self._persist(name, kwargs, priority)
+
+    def _persist(self, name: str, kwargs: dict, priority: int):
+        self._inserts.append((name, json.dumps(kwargs), priority))
+        if len(self._inserts) >= getattr(config, "QUEUE_COMMIT_BATCH", 50):
+            self._wakeup.set()
+
+    async def get_state(self, key: str) -> str | None:
+        """Fetches a persisted value from the durable queue's database. Always None when not durable."""
+        if not self.durable:
+            return None
+        await self.db_ready.wait()
+        if self.db is None:
+            return None
+        async with self.db.execute("SELECT value FROM state WHERE key = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_state(self, key: str, value: str):
+        """Persists a value in the durable queue's database. Does nothing when not durable."""
+        if not self.durable:
+            return
+        await self.db_ready.wait()
+        if self.db is None:
+            return
+        await self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+        await self.db.commit()
 
-    def add(self, task):
-        self.queue.put_nowait(task)
+    async def durable_loop(self):
+        """Commits queued inserts and completions in batches, and feeds stored jobs into the in-memory queue."""
+        try:
+            await self._durable_loop()
+        except Exception as e:
+            self.log.critical("Durable queue failed, falling back to in-memory jobs: %r", e, exc_info=e)
+            self.durable = False
+            self.db_ready.set()
+            inserts, self._inserts = self._inserts, []
+            for name, kwargs, priority in inserts:
+                await self.put(Job(name, json.loads(kwargs)), priority)
+
+    async def _durable_loop(self):
+        import aiosqlite
+
+        interval = getattr(config, "QUEUE_COMMIT_INTERVAL", 1.0)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "name TEXT NOT NULL, "
+                "kwargs TEXT NOT NULL, "
+                "priority INTEGER NOT NULL, "
+                "claimed INTEGER NOT NULL DEFAULT 0"
+                ")"
+            )
+            await db.execute("CREATE INDEX IF NOT EXISTS jobs_order ON jobs (claimed, priority, id)")
+            await db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            # Anything that was claimed by a previous run never finished, so it needs running again.
+            await db.execute("UPDATE jobs SET claimed = 0 WHERE claimed = 1")
+            await db.commit()
+            async with db.execute("SELECT COUNT(*) FROM jobs") as cursor:
+                (pending,) = await cursor.fetchone()
+            if pending:
+                self.log.info("Replaying %d unfinished jobs from %s", pending, self.db_path)
+            self.db = db
+            self.db_ready.set()
+            try:
+                while not self._closing:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    if self._closing:
+                        break
+                    try:
+                        await self._flush()
+                        await self._feed()
+                    except Exception as e:
+                        self.log.error("Failed to sync durable queue: %r", e, exc_info=e)
+            finally:
+                await self._flush()
+                self.db = None
+
+    async def _flush(self):
+        inserts, self._inserts = self._inserts, []
+        finished, self._finished = self._finished, []
+        if inserts:
+            await self.db.executemany("INSERT INTO jobs (name, kwargs, priority) VALUES (?, ?, ?)", inserts)
+        if finished:
+            await self.db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in finished])
+        if inserts or finished:
+            await self.db.commit()
+            self.log.debug("Committed %d new and %d finished jobs", len(inserts), len(finished))
+
+    async def _feed(self):
+        if self.overflow:
+            return
+        free = (self.queue.maxsize or getattr(config, "QUEUE_COMMIT_BATCH", 50)) - self.queue.qsize()
+        if free <= 0:
+            return
+        async with self.db.execute(
+            "SELECT id, name, kwargs, priority FROM jobs WHERE claimed = 0 ORDER BY priority, id LIMIT ?",
+            (free,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        # Jobs added with `add` since the free space was counted may have taken some of it, so only the rows that
+        # actually made it into the queue are claimed. The rest are picked up by a later feed.
+        claimed = []
+        for job_id, name, kwargs, priority in rows:
+            try:
+                self.queue.put_nowait((priority, next(self._counter), Job(name, json.loads(kwargs), job_id)))
+            except asyncio.QueueFull:
+                break
+            claimed.append((job_id,))
+        if claimed:
+            await self.db.executemany("UPDATE jobs SET claimed = 1 WHERE id = ?", claimed)
+            await self.db.commit()
+
+    async def close(self):
+        """Stops the durable loop, after it has committed any jobs (and completions) that haven't been written yet."""
+        self._closing = True
+        self._wakeup.set()
+        if self.durable_task is not None and not self.durable_task.done():
+            await self.durable_task
+
+    def _offer(self, item: tuple) -> bool:
+        """Puts an item in the queue, or in the overflow buffer if the queue is full (or jobs are already waiting in
+        the buffer, which would otherwise be jumped). Returns False if there's no room in either."""
+        if not self.overflow:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except asyncio.QueueFull:
+                self.log.warning(
+                    "Queue is full (%d jobs), holding jobs back until a slot frees up.", self.queue.qsize()
+                )
+        if len(self.overflow) >= self.overflow_size:
+            return False
+        heapq.heappush(self.overflow, item)
+        return True
+
+    def add(self, task, priority: int = PRIORITY_NORMAL) -> bool:
+        """Adds a job to the queue without waiting.
+
+        If the queue is full, the job is held in an overflow buffer until a worker frees up a slot. If that's full too,
+        the job is dropped (and closed, if it's a coroutine), and False is returned. Use `put` to wait for room
+        instead."""
+        if self._offer((priority, next(self._counter), task)):
+            return True
+        QUEUE_DROPPED.inc()
+        self.log.error("Queue and overflow buffer are full (%d jobs), dropping %r", self.qsize(), task)
+        if inspect.iscoroutine(task):
+            task.close()
+        return False
+
+    put_nowait = add
+
+    async def put(self, task, priority: int = PRIORITY_NORMAL):
+        """Adds a job to the queue, waiting for room in the overflow buffer if both it and the queue are full."""
+        item = (priority, next(self._counter), task)
+        while not self._offer(item):
+            self._overflow_freed.clear()
+            await self._overflow_freed.wait()
+
+    def qsize(self) -> int:
+        """The number of jobs waiting to be run, including those in the overflow buffer."""
+        return self.queue.qsize() + len(self.overflow)
+
+    def _refill(self):
+        while self.overflow and not self.queue.full():
+            self.queue.put_nowait(heapq.heappop(self.overflow))
+            self._overflow_freed.set()
 
     @property
     def healthy(self) -> bool:
-        """Indicates the health of the queue worker. False means the task is not running."""
-        if not self.task:
-            return False
-        running = not self.task.done() and not self.task.cancelled()
-        return running
-
-    async def worker(self):
+        """Indicates the health of the queue workers. False means no worker is running."""
+        return any(not task.done() for task in self.tasks)
+
+    async def run(self, task):
+        """Runs a single job, awaiting it if it is awaitable, otherwise running it in a thread."""
+        if isinstance(task, Job):
+            handler = self.handlers[task.name]
+            if inspect.iscoroutinefunction(handler):
+                return await handler(**task.kwargs)
+            task = functools.partial(handler, **task.kwargs)
+        if inspect.isawaitable(task):
+            return await task
+        result = await niobot.run_blocking(task)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def worker(self, number: int = 0):
         while True:
-            task = await self.queue.get()
+            _, _, task = await self.queue.get()
+            self._refill()
             try:
                 task_id = id(task)
             except SystemError as e:
                 self.log.critical("Failed to generate a unique ID for task %r", task)
                 task_id = os.urandom(6).hex()
-            self.log.debug("Running task %r", task_id)
+            self.log.debug("Worker %d running task %r", number, task_id)
             try:
-                await niobot.run_blocking(task)
+                await self.run(task)
             except Exception as e:
                 self.log.error("Failed to execute job %r: %r", task_id, e, exc_info=e)
             finally:
                 self.log.debug("Finished task %r", task_id)
                 self.queue.task_done()
+                if isinstance(task, Job) and task.id is not None:
+                    self._finished.append(task.id)
+                    if self.queue.empty():
+                        self._wakeup.set()
 
 
 bot = niobot.NioBot(
@@ -98,26 +377,89 @@ bot = niobot.NioBot(
 bot.commands.pop('h')
 bot.commands.pop('help')
 bot.command('help', aliases=['h'])(help_command.custom_help)
+bot.help_index = help_command.HelpIndex(bot)
+bot.help_index.install()
 bot.queue = BackgroundQueue()
-bot.ping_history = collections.deque(maxlen=100)
+bot.router = dispatch.RoomEventRouter(bot)
+bot.http = http_client.HTTPClients(
+    timeout=getattr(config, "HTTP_TIMEOUT", 30),
+    max_connections=getattr(config, "HTTP_MAX_CONNECTIONS", 100),
+    max_keepalive=getattr(config, "HTTP_MAX_KEEPALIVE", 20),
+    per_host=getattr(config, "HTTP_PER_HOST_LIMIT", 10),
+    transport=getattr(config, "HTTP_TRANSPORT", None),
+)
+bot.http.cache = http_cache.HTTPCache(
+    Path(getattr(config, "STORE_PATH", "./store")) / "http-cache.db",
+    getattr(config, "HTTP_CACHE_SIZE", 64 * 1024 * 1024),
+)
+_close = bot.close
+
+
+async def close_bot():
+    """Closes the shared HTTP clients (and flushes the event recorder and durable queue) along with the bot's own
+    session."""
+    await bot.queue.close()
+    if bot.recorder is not None:
+        await bot.recorder.close()
+    await bot.http.aclose()
+    await _close()
+
+
+bot.close = close_bot
+bot.recorder = None
+if getattr(config, "RECORD_EVENTS", None):
+    bot.recorder = recorder.EventRecorder(bot, config.RECORD_EVENTS)
+    bot.recorder.install()
+edits.DEFAULT_INTERVAL = getattr(config, "EDIT_INTERVAL", 2.0)
+attachments.SPILL_THRESHOLD = getattr(config, "ATTACHMENT_SPILL_SIZE", 16 * 1024 * 1024)
+bot.outbound = outbound.OutboundScheduler(
+    bot,
+    rate=getattr(config, "OUTBOUND_RATE", 5.0),
+    burst=getattr(config, "OUTBOUND_BURST", 10),
+    room_rate=getattr(config, "OUTBOUND_ROOM_RATE", 1.0),
+    room_burst=getattr(config, "OUTBOUND_ROOM_BURST", 5),
+)
+bot.outbound.install()
+bot.latency_stats = latency.LatencyTracker()
+bot.tracer = tracing.Tracer(
+    bot,
+    getattr(config, "TRACE_FILE", None),
+    getattr(config, "TRACE_FLUSH_INTERVAL", 5.0),
+)
+bot.tracer.install()
+bot.module_loader = lazy_modules.LazyModuleLoader(
+    bot,
+    Path(getattr(config, "STORE_PATH", "./store")) / "module-manifest.json",
+    getattr(config, "LAZY_MODULES", ("modules.user_eval", "modules.ytdl", "modules.management")),
+    getattr(config, "STARTUP_BUDGET", 2.0),
+)
+bot.exporters = []
+bot.metrics_server = None
+metrics.instrument_uploads(bot)
+metrics.REGISTRY.gauge(
+    "niobot_background_queue_depth", "Jobs waiting in the background queue.", function=bot.queue.qsize
+)
+metrics.REGISTRY.gauge(
+    "niobot_outbound_queue_depth", "Outbound room events waiting to be sent.", function=bot.outbound.__len__
+)
+bot.system_stats = system_stats.SystemSampler(
+    getattr(config, "STATS_INTERVAL", 5.0),
+    getattr(config, "STATS_HISTORY", 720),
+)
 
 
-async def kuma_ping_loop():
-    session = httpx.AsyncClient(follow_redirects=True)
-    while True:
-        if len(bot.ping_history):
-            _ping = round((sum(bot.ping_history) / len(bot.ping_history)), 2)
-        else:
-            _ping = ""
-        try:
-            await session.get(
-                config.KUMA_URL.format(ping=_ping)
-            )
-            bot.log.debug("pinged kuma.")
-        except Exception as e:
-            bot.log.error("Failed to ping kuma: %r", e, exc_info=e)
-        finally:
-            await asyncio.sleep(60)
+@bot.queue.job("room_leave")
+async def room_leave_job(room_id: str):
+    await bot.room_leave(room_id)
+
+
+def kuma_params() -> dict:
+    # Kuma only takes one number as the ping, so that's the median. p95/p99 are available for custom URLs.
+    percentiles = {
+        "p%d" % p: "" if value is None else round(value, 2)
+        for p, value in bot.latency_stats.percentiles("1m").items()
+    }
+    return {"ping": percentiles["p50"], **percentiles}
 
 
 async def handle_key_verification_start(event: nio.KeyVerificationEvent):
@@ -132,41 +474,111 @@ async def handle_key_verification_start(event: nio.KeyVerificationEvent):
 bot.add_event_callback(handle_key_verification_start, (nio.KeyVerificationEvent,))
 
 
+async def sweep_empty_rooms():
+    """Leaves every room that the bot is the only member of.
+
+    Rooms with an already synced member list (or a sync summary showing other members) are checked locally, and the
+    rest are fetched from the homeserver, ROOM_SWEEP_CONCURRENCY at a time, backing off when rate limited."""
+    last_sweep = await bot.queue.get_state("room_sweep")
+    if last_sweep and time.time() - float(last_sweep) < getattr(config, "ROOM_SWEEP_INTERVAL", 21600):
+        bot.log.info("Skipping empty room sweep, the last one finished %d seconds ago.", time.time() - float(last_sweep))
+        return
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(getattr(config, "ROOM_SWEEP_CONCURRENCY", 8))
+    retries = getattr(config, "ROOM_SWEEP_RETRIES", 5)
+    backoff_until = 0.0
+    fetched = 0
+    left = 0
+
+    async def fetch_members(room_id: str) -> list[str] | None:
+        nonlocal backoff_until, fetched
+        for attempt in range(retries):
+            async with semaphore:
+                # If anyone got rate limited, everyone waits.
+                delay = backoff_until - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                response = await bot.joined_members(room_id)
+            if isinstance(response, niobot.JoinedMembersResponse):
+                fetched += 1
+                return [member.user_id for member in response.members]
+            if response.status_code != "M_LIMIT_EXCEEDED":
+                bot.log.warning("Failed to fetch members of %s: %r", room_id, response)
+                return None
+            retry_after = (response.retry_after_ms or 1000 * 2 ** attempt) / 1000
+            bot.log.debug("Rate limited fetching members of %s, retrying in %.1f seconds", room_id, retry_after)
+            backoff_until = max(backoff_until, loop.time() + retry_after)
+        bot.log.warning("Gave up fetching members of %s after %d attempts", room_id, retries)
+
+    async def check_room(room: nio.MatrixRoom):
+        nonlocal left
+        if room.members_synced:
+            # Joined members only, like joined_members: a room with nobody but a pending invite still counts as empty.
+            members = [user_id for user_id, user in room.users.items() if not user.invited]
+        elif room.summary and (room.summary.joined_member_count or 0) > 1:
+            return
+        else:
+            members = await fetch_members(room.room_id)
+            if members is None:
+                return
+        if members == [bot.user_id]:
+            print("Leaving empty room:", room.room_id)
+            await bot.queue.put_job("room_leave", bot.queue.PRIORITY_CLEANUP, room_id=room.room_id)
+            left += 1
+
+    start = time.time()
+    rooms = list(bot.rooms.values())
+    results = await asyncio.gather(*(check_room(room) for room in rooms), return_exceptions=True)
+    for room, result in zip(rooms, results):
+        if isinstance(result, Exception):
+            bot.log.error("Failed to check whether %s is empty: %r", room.room_id, result, exc_info=result)
+    bot.log.info(
+        "Swept %d rooms in %.2f seconds (%d member lists fetched), leaving %d.",
+        len(rooms), time.time() - start, fetched, left
+    )
+    await bot.queue.set_state("room_sweep", str(time.time()))
+
+
 @bot.on_event("ready")
 async def on_ready(_: niobot.SyncResponse):
-    for module in MODULES:
-        try:
-            bot.mount_module(module)
-        except Exception as e:
-            logging.error("Failed to load %s: %s", module, e, exc_info=True)
+    bot.module_loader.mount_all(MODULES)
     bot.queue.start_worker()
+    bot.system_stats.start()
+    bot.tracer.instrument_commands()
     try:
         from config import DISCORD_BRIDGE_TOKEN
     except ImportError:
         print("No loading discord bridge module, DISCORD_BRIDGE_TOKEN is not in config.py")
     else:
-        bot.mount_module("modules.discord_bridge")
+        bot.module_loader.mount_all(("modules.discord_bridge",))
+    for line in bot.module_loader.report(IMPORT_TIME):
+        bot.log.info("Startup: %s", line)
     print("Logged in as %r!" % bot.user_id)
     print("Prefix:", bot.command_prefix)
     print("Owner:", bot.owner_id)
     print("Device:", bot.device_id)
-    for room_id, room in bot.rooms.items():
-        _members = await bot.joined_members(room_id)
-        if isinstance(_members, niobot.JoinedMembersResponse):
-            if bot.user_id not in _members.members:
-                continue
-            if len(_members.members) == 1 and _members.members[0] == bot.user_id:
-                print("Leaving empty room:", room_id)
-                bot.queue.add(bot.room_leave(room_id))
+    bot.room_sweep_task = asyncio.create_task(sweep_empty_rooms())
     if hasattr(config, "KUMA_URL"):
         bot.log.info("starting Uptime Kuma ping loop")
-        asyncio.create_task(kuma_ping_loop())
+        bot.exporters.append(metrics.KumaExporter(
+            config.KUMA_URL, kuma_params, getattr(config, "KUMA_INTERVAL", 60), client=bot.http.get()
+        ))
+        bot.exporters[-1].start()
     else:
         bot.log.warning("No KUMA_URL environment variable specified, will not be updating Uptime Kuma.")
+    if getattr(config, "METRICS_PORT", None) and bot.metrics_server is None:
+        bot.metrics_server = metrics.MetricsServer(
+            metrics.REGISTRY,
+            getattr(config, "METRICS_HOST", "127.0.0.1"),
+            config.METRICS_PORT
+        )
+        await bot.metrics_server.start()
 
 
 @bot.on_event("command_error")
 async def on_command_error(ctx: Context, error: Exception):
+    bot.tracer.on_error(ctx)
     if isinstance(error, niobot.CommandArgumentsError):
         await ctx.respond("Invalid arguments: " + str(error))
     elif isinstance(error, niobot.CommandDisabledError):
@@ -181,54 +593,51 @@ async def on_command_error(ctx: Context, error: Exception):
 async def on_message(_, event: nio.RoomMessageText):
     if bot.is_old(event):
         return
-    latency = bot.latency(event)
-    bot.ping_history.append(latency)
+    latency_ms = bot.latency(event)
+    bot.latency_stats.record(latency_ms)
+    metrics.MESSAGE_LATENCY.observe(latency_ms / 1000)
 
 
 @bot.command()
 async def ping(ctx: Context):
     """Shows the roundtrip latency"""
     latency = ctx.latency
-    average = sum(bot.ping_history) / len(bot.ping_history)
+    summary = bot.latency_stats.summary("15m")
     start = time.time()
-    msg = await ctx.respond(f"Pong! {latency:.2f}ms (Average {average:.2f}ms)")
+    msg = await ctx.respond(f"Pong! {latency:.2f}ms (15m: {summary})")
     end = time.time()
     await msg.edit(
-        content=f"Pong! {latency:.2f}ms (Average {average:.2f}ms) (Reply time: {end - start:.2f}ms)"
+        content=f"Pong! {latency:.2f}ms (15m: {summary}) (Reply time: {(end - start) * 1000:.2f}ms)"
     )
 
 
 @bot.command()
 async def info(ctx: Context):
     """Shows information about the bot"""
-    def psutil_crap() -> dict:
-        output = {}
-        proc = psutil.Process()
-        with proc.oneshot():
-            output["memory_process"] = humanize.naturalsize(proc.memory_info().rss)
-            output["cpu_process"] = proc.cpu_percent(interval=1)
-            output["memory_system"] = humanize.naturalsize(psutil.virtual_memory().used)
-            output["memory_pct"] = psutil.virtual_memory().percent
-            output["cpu_system"] = psutil.cpu_percent(interval=1)
-            output["uptime"] = time.time() - psutil.boot_time()
-        return output
+    import humanize
+    from bs4 import BeautifulSoup
 
+    stats = bot.system_stats.snapshot()
     uptime = time.time() - bot.start_time
-    average_ping_seconds = sum(bot.ping_history) / len(bot.ping_history) / 1000
-    psutil_data = await niobot.run_blocking(psutil_crap)
     table = {
-        "Uptime": "%s (%s system)" % (humanize.naturaldelta(uptime), humanize.naturaldelta(psutil_data["uptime"])),
-        "CPU Usage": "{0[cpu_process]:.1f}% ({0[cpu_system]:.1f}% system)".format(psutil_data),
-        "Memory Usage": "{0[memory_process]} ({0[memory_system]} system, {0[memory_pct]}%)".format(psutil_data),
+        "Uptime": "%s (%s system)" % (
+            humanize.naturaldelta(uptime), humanize.naturaldelta(time.time() - stats.boot_time)
+        ),
+        "CPU Usage": "%.1f%% (%.1f%% system)" % (stats.cpu_process, stats.cpu_system),
+        "Memory Usage": "%s (%s system, %s%%)" % (
+            humanize.naturalsize(stats.memory_process), humanize.naturalsize(stats.memory_system), stats.memory_pct
+        ),
+        "Threads / FDs": "%d / %s" % (stats.threads, "N/A" if stats.open_fds is None else stats.open_fds),
+        "Loop Lag": "%.2fms" % stats.loop_lag,
         "Ping": f"{ctx.latency:.2f}ms",
-        "Average Ping": humanize.naturaltime(
-            timedelta(seconds=average_ping_seconds), minimum_unit="microseconds"
-        )[:-4],
+        "Ping (1m)": bot.latency_stats.summary("1m"),
+        "Ping (1h)": bot.latency_stats.summary("1h"),
     }
     if bot.queue.healthy:
-        table["Queue"] = "<span data-mx-color=\"#00FF00\">Healthy</span>"
+        table["Queue"] = "<span data-mx-color=\"#00FF00\">Healthy</span> (%d pending)" % bot.queue.qsize()
     else:
         table["Queue"] = "<span data-mx-color=\"#FF0000\">Dead!</span>"
+    table["Outbound"] = "%d pending" % len(bot.outbound)
     table_html = "<table><thead><tr>{head}</tr></thead><tbody><tr>{body}</tr></tbody></table>"
     head = ["<th>{}</th>".format(x) for x in table.keys()]
     body = ["<td>{}</td>".format(x) for x in table.values()]
@@ -237,10 +646,50 @@ async def info(ctx: Context):
     await ctx.respond("**Owner:** %s\n\n**Live device ID:** %s\n\n%s" % (bot.owner_id, bot.device_id, soup.prettify()))
 
 
+@bot.command(name="stats")
+@niobot.is_owner()
+async def command_stats(ctx: Context, window: str = "1h"):
+    """Shows p50/p95 timings per command, over the last 1m, 15m, 1h or all time."""
+    if window not in ("1m", "15m", "1h", "all"):
+        return await ctx.respond("Window must be one of 1m, 15m, 1h, or all.")
+    rows = bot.tracer.table(window)
+    if not rows:
+        return await ctx.respond("No commands have been run in that window.")
+
+    def fmt(values: tuple) -> str:
+        return "%.1f/%.1f" % values
+
+    lines = ["Command timings over %s, p50/p95 in ms:" % window, "```"]
+    lines.append("%-20s %6s %15s %15s %15s %15s" % ("command", "count", "total", "parse", "execution", "outbound"))
+    for command, count, phases in rows:
+        lines.append(
+            "%-20s %6d %15s %15s %15s %15s" % (
+                command,
+                count,
+                fmt(phases["total"]),
+                fmt(phases["parse"]),
+                fmt(phases["execution"]),
+                fmt(phases["outbound"]),
+            )
+        )
+    lines.append("```")
+    await ctx.respond("\n".join(lines))
+
+
+@bot.command(name="system-stats")
+@niobot.is_owner()
+async def system_stats_history(ctx: Context):
+    """Exports the sampled system stats history as CSV, for graphing trends."""
+    if not bot.system_stats.history:
+        return await ctx.respond("No samples have been taken yet.")
+    x = io.BytesIO(bot.system_stats.to_csv().encode("utf-8"))
+    await ctx.respond(file=await niobot.FileAttachment.from_file(x, "system-stats.csv"))
+
+
 @bot.command(name="upload", usage="<type: image|video|audio|file>", arguments=[niobot.Argument("type", str)])
 async def upload_attachment(ctx: Context, _type: str):
     """Uploads an image"""
-    msg = await ctx.respond("Processing media...")
+    msg = edits.coalesce(await ctx.respond("Processing media..."))
     attachment = None
     if _type.startswith("/"):
         p = Path(__file__).parent / "assets" / _type[1:]
@@ -353,7 +802,9 @@ async def send(ctx: Context, room: nio.MatrixRoom, text: str):
 
 @bot.command()
 async def modules(ctx):
-    """Lists currently loaded modules."""
-    await ctx.respond("Loaded modules:\n%s" % "\n".join("* " + str(x) for x in MODULES))
+    """Lists modules, and how long each one took to load."""
+    await ctx.respond("Modules:\n%s" % "\n".join("* " + x for x in bot.module_loader.report(IMPORT_TIME)))
+
 
-bot.run(access_token=getattr(config, "TOKEN", None), password=getattr(config, "PASSWORD", None))
+if __name__ == "__main__":
+    bot.run(access_token=getattr(config, "TOKEN", None), password=getattr(config, "PASSWORD", None))
@@ -0,0 +1,321 @@
+"""
+A tiny in-process metrics registry, plus exporters for it.
+
+Metrics are rendered in the Prometheus text exposition format, either served locally by `MetricsServer` for a
+scraper, or pushed elsewhere (such as `KumaExporter` for Uptime Kuma). Metric definitions are idempotent, so
+modules can declare their own at import time and survive being reloaded.
+"""
+import asyncio
+import logging
+import math
+import threading
+import typing
+
+__all__ = (
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "REGISTRY",
+    "MetricsServer",
+    "KumaExporter",
+    "instrument_uploads",
+    "MESSAGE_LATENCY",
+    "COMMANDS",
+    "COMMAND_DURATION",
+    "UPLOAD_BYTES",
+)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: typing.Sequence[str], values: typing.Sequence[str], extra: str = "") -> str:
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s expects labels %r, got %r" % (self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> typing.Iterable[typing.Tuple[str, str, float]]:
+        """Yields (name suffix, rendered labels, value) tuples."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation.replace("\n", " ")),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, labels, _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A value that only ever goes up."""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: typing.Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only go up.")
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield "", _format_labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """A value that can go up and down.
+
+    If `function` is given, it is called at collection time for the (unlabelled) value instead."""
+    type = "gauge"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: typing.Sequence[str] = (),
+            function: typing.Callable[[], float] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.values: typing.Dict[tuple, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            yield "", "", self.function()
+            return
+        for key, value in list(self.values.items()):
+            yield "", _format_labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    """Counts observations into fixed, cumulative buckets, so that they can be aggregated by the scraper."""
+    type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: typing.Sequence[str] = (),
+            buckets: typing.Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [bucket counts..., sum, count]
+        self.values: typing.Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        for key, state in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield "_bucket", _format_labels(self.labelnames, key, 'le="%s"' % _format_value(bound)), cumulative
+            yield "_sum", _format_labels(self.labelnames, key), state[-2]
+            yield "_count", _format_labels(self.labelnames, key), state[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: typing.Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Registers a metric, returning the already registered one if there's one of the same name and type."""
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError("Metric %r is already registered as a %s" % (metric.name, existing.type))
+            if isinstance(metric, Gauge) and metric.function is not None:
+                existing.function = metric.function
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in list(self.metrics.values())) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGE_LATENCY = REGISTRY.histogram(
+    "niobot_message_latency_seconds",
+    "Time between a message being sent and the bot receiving it through sync."
+)
+COMMANDS = REGISTRY.counter("niobot_commands_total", "Commands invoked.", ("command", "status"))
+COMMAND_DURATION = REGISTRY.histogram(
+    "niobot_command_duration_seconds",
+    "Time taken to run a command, from dispatch to completion.",
+    ("command",)
+)
+UPLOAD_BYTES = REGISTRY.counter("niobot_upload_bytes_total", "Bytes uploaded to the media repository.")
+
+
+def instrument_uploads(client) -> None:
+    """Wraps a client's upload method so that upload sizes are counted in UPLOAD_BYTES."""
+    original = client.upload
+
+    async def upload(*args, **kwargs):
+        response = await original(*args, **kwargs)
+        filesize = kwargs.get("filesize")
+        if filesize is None and len(args) >= 6:
+            filesize = args[5]
+        if filesize:
+            UPLOAD_BYTES.inc(filesize)
+        return response
+
+    client.upload = upload
+
+
+class MetricsServer:
+    """Serves a registry at /metrics over a bare-bones HTTP listener."""
+    def __init__(self, registry: Registry = REGISTRY, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: typing.Optional[asyncio.AbstractServer] = None
+        self.log = logging.getLogger(__name__)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.log.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Drain the headers, we don't care about any of them.
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+                body = self.registry.render().encode("utf-8")
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found\n"
+            writer.write(
+                (
+                    "HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (
+                        status, content_type, len(body)
+                    )
+                ).encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class KumaExporter:
+    """Pushes to an Uptime Kuma push monitor every `interval` seconds.
+
+    `url` is formatted with whatever `params` returns on each push. If no (httpx) `client` is given, one is created
+    for the lifetime of the exporter."""
+    def __init__(self, url: str, params: typing.Callable[[], dict], interval: float = 60, client=None):
+        self.url = url
+        self.params = params
+        self.interval = interval
+        self.client = client
+        self.task: typing.Optional[asyncio.Task] = None
+        self.log = logging.getLogger(__name__)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        if self.client is None:
+            import httpx
+
+            async with httpx.AsyncClient(follow_redirects=True) as self.client:
+                await self._push_loop()
+        else:
+            await self._push_loop()
+
+    async def _push_loop(self):
+        while True:
+            try:
+                await self.client.get(self.url.format(**self.params()))
+                self.log.debug("pinged kuma.")
+            except Exception as e:
+                self.log.error("Failed to ping kuma: %r", e, exc_info=e)
+            finally:
+                await asyncio.sleep(self.interval)
@@ -11,22 +11,36 @@ import hashlib
 import PIL.Image
 import PIL.ImageDraw
 import websockets
-import aiohttp
+import httpx
 import niobot
 from nio import MatrixRoom, RoomMessageText, RoomMessageMedia
 import pathlib
-import tempfile
+
+import attachments
+import metrics
 
 try:
     from config import DISCORD_BRIDGE_TOKEN
 except ImportError:
     DISCORD_BRIDGE_TOKEN = None
 
+BRIDGE_MESSAGES = metrics.REGISTRY.counter(
+    "niobot_bridge_messages_total",
+    "Messages relayed by the discord bridge.",
+    ("direction",)
+)
+BRIDGE_BYTES = metrics.REGISTRY.counter(
+    "niobot_bridge_attachment_bytes_total",
+    "Attachment bytes mirrored from discord by the bridge."
+)
+
 
 class QuoteModule(niobot.Module):
+    ROOM_ID = "!WrLNqENUnEZvLJiHsu:nexy7574.co.uk"
+
     def __init__(self, bot: niobot.NioBot):
         super().__init__(bot)
-        self.bot.add_event_callback(self.on_message, (RoomMessageText, RoomMessageMedia))
+        self.bot.router.add(self.on_message, room_id=self.ROOM_ID, event_types=(RoomMessageText, RoomMessageMedia))
         self.fifo_task = asyncio.create_task(self.message_poller())
         self.last_author: str = "@jimmy-bot:nexy7574.co.uk"
         self.last_author_ts = 0
@@ -35,6 +49,11 @@ class QuoteModule(niobot.Module):
         self.processing = {}
         self._log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
 
+    def __teardown__(self):
+        self.bot.router.remove(self.on_message)
+        self.fifo_task.cancel()
+        super().__teardown__()
+
     async def get_mxc_for(self, avatar_url: str) -> str:
         loc = pathlib.Path.home() / ".cache" / "jimmy-matrix" / "avatars.db"
         loc.parent.mkdir(0o751, True, True)
@@ -47,26 +66,21 @@ class QuoteModule(niobot.Module):
                     self._log.debug("Avatar %r is cached, returning %r", avatar_url, row[0])
                     return row[0]
             self._log.info("Avatar %r is not cached, uploading.", avatar_url)
-            async with aiohttp.ClientSession(headers={"User-Agent": niobot.__user_agent__}) as client:
-                async with client.get(avatar_url) as response:
-                    response.raise_for_status()
-                    content_type = response.headers["Content-Type"].split(";")[0].split("/")[1]
-                    with tempfile.NamedTemporaryFile(suffix="." + content_type) as tmp:
-                        tmp.write(await response.read())
-                        tmp.flush()
-                        await niobot.run_blocking(self.make_image_round, pathlib.Path(tmp.name))
-                        tmp.seek(0)
-                        media = await niobot.ImageAttachment.from_file(tmp.name)
-                        await media.upload(self.bot, False)
-                        await connection.execute("INSERT INTO avatars (url, mxc) VALUES (?, ?)",
-                                                 (avatar_url, media.url))
-                        await connection.commit()
-                        return media.url
+            client = self.bot.http.get()
+            response = await client.get(avatar_url)
+            response.raise_for_status()
+            data = await niobot.run_blocking(self.make_image_round, response.content)
+            async with attachments.open_attachment(niobot.ImageAttachment, data, "avatar.png") as media:
+                await media.upload(self.bot, False)
+            await connection.execute("INSERT INTO avatars (url, mxc) VALUES (?, ?)",
+                                     (avatar_url, media.url))
+            await connection.commit()
+            return media.url
 
     @staticmethod
-    def make_image_round(path: pathlib.Path) -> pathlib.Path:
-        """Effectively the same as adding border-radius: 50% to the image"""
-        img = PIL.Image.open(path)
+    def make_image_round(data: bytes) -> bytes:
+        """Effectively the same as adding border-radius: 50% to the image. Returns the result as a PNG."""
+        img = PIL.Image.open(io.BytesIO(data))
         img = img.convert("RGBA")
         mask = PIL.Image.new("L", img.size, 0)
 
@@ -75,221 +89,211 @@ class QuoteModule(niobot.Module):
 
         img.putalpha(mask)
         img.thumbnail((16, 16), PIL.Image.Resampling.LANCZOS, 3)
-        img.save(path)
-        return path
+        output = io.BytesIO()
+        img.save(output, "png")
+        return output.getvalue()
 
     async def message_poller(self):
         if not DISCORD_BRIDGE_TOKEN:
             return
         log = logging.getLogger("%s.%s.%s" % (__name__, self.__class__.__name__, "message_poller"))
-        ROOM_ID = "!WrLNqENUnEZvLJiHsu:nexy7574.co.uk"
-        room = self.bot.rooms[ROOM_ID]
+        room = self.bot.rooms[self.ROOM_ID]
         while True:
             try:
-                async with aiohttp.ClientSession(headers={"User-Agent": niobot.__user_agent__}) as client:
-                    log.info("Starting discord bridge task")
-                    async for ws in websockets.connect(
-                            "wss://droplet.nexy7574.co.uk/jimmy/bridge/recv",
-                            extra_headers={"secret": DISCORD_BRIDGE_TOKEN}
-                    ):
-                        log.info("Connected to discord bridge & awaiting messages.")
-                        async for payload in ws:
-                            log.debug("Decoding payload...")
-                            try:
-                                payload = json.loads(payload)
-                            except json.JSONDecodeError as e:
-                                log.exception("Error while decoding payload: %r", e, exc_info=e)
-                                continue
-                            log.info("Received bridge payload:\n%s", json.dumps(payload, indent=4))
-                            if payload["author"] == "Jimmy Savile#3762":
-                                log.info("Ignoring message from jimmy discord")
-                                continue
-                            _author = self.last_author
-                            y = None
-                            self.last_author = payload["author"]
-                            self.last_author_ts = payload["at"]
-                            if payload["content"]:
-                                # noinspection PyProtectedMember
-                                pre_render = await self.bot._markdown_to_html(payload["content"])
-                                if _author == payload["author"]:
-                                    log.debug("Last & current author is %r, not prepending author name", _author)
-                                    text = "<blockquote>%s</blockquote>"
-                                    args = (pre_render,)
-                                else:
-                                    log.debug(
-                                        "Last author is %r, current author is %r, prepending author name",
-                                        _author
-                                    )
-                                    text = "**%s**:<br><blockquote>%s</blockquote>"
-                                    if payload.get("avatar"):
-                                        avatar_url = payload["avatar"]
-                                        try:
-                                            avatar_mxc = await self.get_mxc_for(avatar_url)
-                                        except aiohttp.ClientError:
-                                            avatar_mxc = await self.get_mxc_for(
-                                                "https://cdn.discordapp.com/embed/avatars/%d.png" % (
-                                                    min(max(0, (payload["at"] >> 22) % 6), 5)
-                                                )
+                client = self.bot.http.get()
+                log.info("Starting discord bridge task")
+                async for ws in websockets.connect(
+                        "wss://droplet.nexy7574.co.uk/jimmy/bridge/recv",
+                        extra_headers={"secret": DISCORD_BRIDGE_TOKEN}
+                ):
+                    log.info("Connected to discord bridge & awaiting messages.")
+                    async for payload in ws:
+                        log.debug("Decoding payload...")
+                        try:
+                            payload = json.loads(payload)
+                        except json.JSONDecodeError as e:
+                            log.exception("Error while decoding payload: %r", e, exc_info=e)
+                            continue
+                        log.info("Received bridge payload:\n%s", json.dumps(payload, indent=4))
+                        if payload["author"] == "Jimmy Savile#3762":
+                            log.info("Ignoring message from jimmy discord")
+                            continue
+                        _author = self.last_author
+                        y = None
+                        self.last_author = payload["author"]
+                        self.last_author_ts = payload["at"]
+                        if payload["content"]:
+                            # noinspection PyProtectedMember
+                            pre_render = await self.bot._markdown_to_html(payload["content"])
+                            if _author == payload["author"]:
+                                log.debug("Last & current author is %r, not prepending author name", _author)
+                                text = "<blockquote>%s</blockquote>"
+                                args = (pre_render,)
+                            else:
+                                log.debug(
+                                    "Last author is %r, current author is %r, prepending author name",
+                                    _author
+                                )
+                                text = "**%s**:<br><blockquote>%s</blockquote>"
+                                if payload.get("avatar"):
+                                    avatar_url = payload["avatar"]
+                                    try:
+                                        avatar_mxc = await self.get_mxc_for(avatar_url)
+                                    except httpx.HTTPError:
+                                        avatar_mxc = await self.get_mxc_for(
+                                            "https://cdn.discordapp.com/embed/avatars/%d.png" % (
+                                                min(max(0, (payload["at"] >> 22) % 6), 5)
                                             )
-                                        log.info("Avatar for %r resolved to %r", avatar_url, avatar_mxc)
-                                        _resolved_author = '<img src="%s" width="16px" height="16px"> %s' % (
-                                            avatar_mxc,
-                                            payload["author"]
                                         )
-                                    else:
-                                        _resolved_author = payload["author"]
-                                    args = (_resolved_author, pre_render)
+                                    log.info("Avatar for %r resolved to %r", avatar_url, avatar_mxc)
+                                    _resolved_author = '<img src="%s" width="16px" height="16px"> %s' % (
+                                        avatar_mxc,
+                                        payload["author"]
+                                    )
+                                else:
+                                    _resolved_author = payload["author"]
+                                args = (_resolved_author, pre_render)
 
-                                log.info("Sending message %r to matrix", payload)
-                                y = await self.bot.send_message(
-                                    room,
-                                    text % args,
-                                    message_type="m.text"
-                                )
-                                self.bridge_responses.append(y.event_id)
+                            log.info("Sending message %r to matrix", payload)
+                            y = await self.bot.send_message(
+                                room,
+                                text % args,
+                                message_type="m.text"
+                            )
+                            self.bridge_responses.append(y.event_id)
+                            BRIDGE_MESSAGES.inc(direction="to_matrix")
 
-                            if payload["attachments"]:
-                                log.info(
-                                    "Message has %d attachments - beginning processing.",
-                                    len(payload["attachments"])
-                                )
-                                for attachment in payload["attachments"]:
-                                    try:
-                                        async with client.get(attachment["url"]) as response:
-                                            if response.status != 200:
-                                                continue
+                        if payload["attachments"]:
+                            log.info(
+                                "Message has %d attachments - beginning processing.",
+                                len(payload["attachments"])
+                            )
+                            for attachment in payload["attachments"]:
+                                try:
+                                    response = await client.get(attachment["url"])
+                                    if response.status_code != 200:
+                                        continue
 
-                                            with tempfile.NamedTemporaryFile(
-                                                    suffix=pathlib.Path(attachment["url"]).suffix
-                                            ) as tmp:
-                                                buf = await response.read()
-                                                md5 = hashlib.md5()
-                                                md5.update(buf)
-                                                md5 = md5.hexdigest()
-                                                tmp.write(buf)
-                                                log.info(
-                                                    "Wrote %d bytes to %r for %s",
-                                                    len(buf),
-                                                    tmp.name,
-                                                    md5
-                                                )
-                                                del buf  # keep memory usage as low as possible
-                                                tmp.flush()
-                                                tmp.seek(0)
-                                                content_type = attachment["content_type"]
+                                    buf = response.content
+                                    size = len(buf)
+                                    BRIDGE_BYTES.inc(size)
+                                    md5 = hashlib.md5(buf).hexdigest()
+                                    content_type = attachment["content_type"]
+                                    # Images are handled in memory, everything else needs a file to probe.
+                                    with attachments.media_source(
+                                            buf,
+                                            pathlib.Path(attachment["url"]).suffix,
+                                            on_disk=None if content_type.startswith("image/") else True
+                                    ) as source:
+                                        log.info("Buffered %d bytes for %s in %r", size, md5, source)
+                                        del buf  # keep memory usage as low as possible
 
-                                                if content_type.startswith("image/"):
-                                                    log.info("Converting image to attachment %s", md5)
-                                                    media = await niobot.ImageAttachment.from_file(
-                                                        tmp.name,
-                                                        generate_blurhash=False
-                                                    )
-                                                    assert media.xyz_amorgan_blurhash is None
-                                                    thumbnail = io.BytesIO()
-                                                    log.info("Generating thumbnail for %s", md5)
-                                                    (
-                                                        await niobot.run_blocking(
-                                                            media.thumbnailify_image,
-                                                            PIL.Image.open(media.file)
-                                                        )
-                                                    ).save(thumbnail, "webp")
-                                                    thumbnail.seek(0)
-                                                    log.info("Generating blurhash for %s thumbnail", md5)
-                                                    await media.get_blurhash(file=thumbnail)
-                                                elif content_type.startswith("video/"):
-                                                    # step one - create the video attachment without a thumbnail
-                                                    log.info("Creating thumbnail-less video attachment for %s", md5)
-                                                    media = await niobot.VideoAttachment.from_file(
-                                                        tmp.name,
-                                                        generate_blurhash=False,
-                                                        thumbnail=False
-                                                    )
+                                        if content_type.startswith("image/"):
+                                            log.info("Converting image to attachment %s", md5)
+                                            media = await niobot.ImageAttachment.from_file(
+                                                source,
+                                                file_name=attachment["filename"],
+                                                generate_blurhash=False
+                                            )
+                                            assert media.xyz_amorgan_blurhash is None
+                                            thumbnail = io.BytesIO()
+                                            log.info("Generating thumbnail for %s", md5)
+                                            (
+                                                await niobot.run_blocking(
+                                                    media.thumbnailify_image,
+                                                    PIL.Image.open(attachments.rewind(source))
+                                                )
+                                            ).save(thumbnail, "webp")
+                                            thumbnail.seek(0)
+                                            log.info("Generating blurhash for %s thumbnail", md5)
+                                            await media.get_blurhash(file=thumbnail)
+                                        elif content_type.startswith("video/"):
+                                            # step one - create the video attachment without a thumbnail
+                                            log.info("Creating thumbnail-less video attachment for %s", md5)
+                                            media = await niobot.VideoAttachment.from_file(
+                                                source,
+                                                generate_blurhash=False,
+                                                thumbnail=False
+                                            )
 
-                                                    # step two - extract the first frame of the video
-                                                    log.info("Extracting first frame of video for %s", md5)
-                                                    _frame_one = await niobot.run_blocking(
-                                                        niobot.first_frame,
-                                                        PIL.Image.open(media.file),
-                                                        "webp"
-                                                    )
-                                                    frame_one = io.BytesIO()
-                                                    _frame_one.save(frame_one, "webp")
-                                                    frame_one.seek(0)
+                                            # step two - extract the first frame of the video
+                                            log.info("Extracting first frame of video for %s", md5)
+                                            _frame_one = await niobot.run_blocking(
+                                                niobot.first_frame,
+                                                PIL.Image.open(media.file),
+                                                "webp"
+                                            )
+                                            frame_one = io.BytesIO()
+                                            _frame_one.save(frame_one, "webp")
+                                            frame_one.seek(0)
 
-                                                    # step three - scale the video down to 320x240
-                                                    log.info("Thumbnailing %s", md5)
-                                                    thumbnail = io.BytesIO(
-                                                        await niobot.run_blocking(
-                                                            niobot.ImageAttachment.thumbnailify_image,
-                                                            frame_one
-                                                        )
-                                                    )
+                                            # step three - scale the video down to 320x240
+                                            log.info("Thumbnailing %s", md5)
+                                            thumbnail = io.BytesIO(
+                                                await niobot.run_blocking(
+                                                    niobot.ImageAttachment.thumbnailify_image,
+                                                    frame_one
+                                                )
+                                            )
 
-                                                    # Step four - cast to an image attachment
-                                                    log.info("Creating thumbnail attachment for %s", md5)
-                                                    media_thumbnail = await niobot.ImageAttachment.from_file(
-                                                        thumbnail,
-                                                    )
+                                            # Step four - cast to an image attachment
+                                            log.info("Creating thumbnail attachment for %s", md5)
+                                            media_thumbnail = await niobot.ImageAttachment.from_file(
+                                                thumbnail,
+                                            )
 
-                                                    # Step five - assign the thumbnail to the video attachment
-                                                    log.info("Assigning thumbnail to video attachment for %s", md5)
-                                                    media.thumbnail = media_thumbnail
-                                                else:
-                                                    log.warning("Unknown attachment type %r. Guessing factory...")
-                                                    factory = niobot.which(tmp.name)
-                                                    if factory is None:
-                                                        log.warning("Unable to guess factory for %r", content_type)
-                                                        continue
-                                                    log.info("Factory for %r is %r", content_type, factory)
-                                                    media = await factory.from_file(tmp.name)
-                                                    log.info("Factory %r generated %r", factory, media)
-                                                log.info("Uploading attachment %s", md5)
-                                                try:
-                                                    x = await asyncio.wait_for(
-                                                        self.bot.send_message(
-                                                            room,
-                                                            'BRIDGE_' + attachment["filename"],
-                                                            file=media,
-                                                            reply_to=y.event_id if y else None
-                                                        ),
-                                                        timeout=300
-                                                    )
-                                                except asyncio.TimeoutError:
-                                                    log.exception(
-                                                        "Timed out while uploading attachment %s\n"
-                                                        "Size (bytes): %d\n"
-                                                        "Content-Type: %s\n"
-                                                        "Filename: %s",
-                                                        md5,
-                                                        len(tmp.read()),
-                                                        content_type,
-                                                        attachment["filename"],
-                                                        exc_info=True
-                                                    )
-                                                    continue
-                                                else:
-                                                    log.info("Uploaded attachment %s", md5)
-                                                    self.bridge_responses.append(x.event_id)
-                                    except Exception as e:
-                                        log.exception("Error while mirroring discord media: %r", e, exc_info=e)
-                                        continue
+                                            # Step five - assign the thumbnail to the video attachment
+                                            log.info("Assigning thumbnail to video attachment for %s", md5)
+                                            media.thumbnail = media_thumbnail
+                                        else:
+                                            log.warning("Unknown attachment type %r. Guessing factory...")
+                                            factory = niobot.which(source)
+                                            if factory is None:
+                                                log.warning("Unable to guess factory for %r", content_type)
+                                                continue
+                                            log.info("Factory for %r is %r", content_type, factory)
+                                            media = await factory.from_file(source)
+                                            log.info("Factory %r generated %r", factory, media)
+                                        log.info("Uploading attachment %s", md5)
+                                        try:
+                                            x = await asyncio.wait_for(
+                                                self.bot.send_message(
+                                                    room,
+                                                    'BRIDGE_' + attachment["filename"],
+                                                    file=media,
+                                                    reply_to=y.event_id if y else None
+                                                ),
+                                                timeout=300
+                                            )
+                                        except asyncio.TimeoutError:
+                                            log.exception(
+                                                "Timed out while uploading attachment %s\n"
+                                                "Size (bytes): %d\n"
+                                                "Content-Type: %s\n"
+                                                "Filename: %s",
+                                                md5,
+                                                size,
+                                                content_type,
+                                                attachment["filename"],
+                                                exc_info=True
+                                            )
+                                            continue
+                                        else:
+                                            log.info("Uploaded attachment %s", md5)
+                                            self.bridge_responses.append(x.event_id)
+                                            BRIDGE_MESSAGES.inc(direction="to_matrix")
+                                except Exception as e:
+                                    log.exception("Error while mirroring discord media: %r", e, exc_info=e)
+                                    continue
             except Exception as e:
                 log.exception("Error while reading from websocket: %r", e, exc_info=e)
                 continue
 
-    # @niobot.event("message")
+    # Only called for new events in ROOM_ID, see the router registration in __init__.
     async def on_message(self, room: MatrixRoom, event: RoomMessageText | RoomMessageMedia):
         log = logging.getLogger("%s.%s.%s" % (__name__, self.__class__.__name__, "on_message"))
         async with self.bridge_lock:
             log.debug("Processing message: %s in %s", event, room)
-            if self.bot.is_old(event):
-                log.debug("Ignoring old message: %s in %s", event, room)
-                return
-
-            if room.room_id != "!WrLNqENUnEZvLJiHsu:nexy7574.co.uk":
-                log.debug("Ignoring message in %s", room)
-                return
-
             if event.body.startswith(("~", "?", "!")):
                 log.debug("Ignoring escaped message: %s", event)
                 return
@@ -309,29 +313,26 @@ class QuoteModule(niobot.Module):
                 if isinstance(event, RoomMessageMedia):
                     payload["message"] = await self.bot.mxc_to_http(event.url)
                 log.debug("Payload: %s", payload)
-                async with aiohttp.ClientSession(headers={"User-Agent": niobot.__user_agent__}) as client:
-                    log.debug("Sending message to discord bridge")
-                    async with client.post(
-                        "https://droplet.nexy7574.co.uk/jimmy/bridge",
-                        json=payload,
-                        headers={
-                            "Connection": "Close"
-                        },
-                        timeout=aiohttp.ClientTimeout(total=10)
-                    ) as response:
-                        if response.status == 400:
-                            data = await response.json()
-                            if data["detail"] == "Message too long.":
-                                await self.bot.add_reaction(room, event, "\N{PRINTER}\N{VARIATION SELECTOR-16}")
-                        elif response.status != 201:
-                            log.error(
-                                "Error while sending message to discord bridge (%d): %s",
-                                response.status,
-                                await response.text()
-                            )
-                            await self.bot.add_reaction(room, event, "\N{CROSS MARK}")
-                            return
-                        log.info("Message sent to discord bridge")
+                log.debug("Sending message to discord bridge")
+                response = await self.bot.http.get().post(
+                    "https://droplet.nexy7574.co.uk/jimmy/bridge",
+                    json=payload,
+                    timeout=10
+                )
+                if response.status_code == 400:
+                    data = response.json()
+                    if data["detail"] == "Message too long.":
+                        await self.bot.add_reaction(room, event, "\N{PRINTER}\N{VARIATION SELECTOR-16}")
+                elif response.status_code != 201:
+                    log.error(
+                        "Error while sending message to discord bridge (%d): %s",
+                        response.status_code,
+                        response.text
+                    )
+                    await self.bot.add_reaction(room, event, "\N{CROSS MARK}")
+                    return
+                log.info("Message sent to discord bridge")
+                BRIDGE_MESSAGES.inc(direction="to_discord")
             else:
                 log.debug("No discord bridge token set, ignoring message")
 
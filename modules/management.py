@@ -1,6 +1,8 @@
 import niobot
 import io
 
+import edits
+
 
 class ManagementModule(niobot.Module):
     @niobot.command(name="rooms.list")
@@ -32,7 +34,7 @@ class ManagementModule(niobot.Module):
             room = ctx.room.room_id
 
         if room == "--empty":
-            msg = await ctx.respond("Gathering rooms...")
+            msg = edits.coalesce(await ctx.respond("Gathering rooms..."))
             log = io.BytesIO()
 
             def write_log(m: str) -> None:
@@ -62,9 +64,10 @@ class ManagementModule(niobot.Module):
                     targets.append(room.room_id)
             log.seek(0)
             await msg.edit('Leaving %d rooms...' % len(targets))
-            for room in targets:
+            for n, room in enumerate(targets, 1):
                 await self.bot.room_leave(room)
                 await self.bot.room_forget(room)
+                await msg.edit('Leaving %d rooms... (%d/%d)' % (len(targets), n, len(targets)))
 
             value = log.getvalue()
             if len(value) > 1000:
@@ -74,7 +77,7 @@ class ManagementModule(niobot.Module):
             else:
                 await msg.edit('Done! Log:\n```%s```' % log.read().decode("utf-8"))
         else:
-            msg = await ctx.respond("Leaving room %s" % room)
+            msg = edits.coalesce(await ctx.respond("Leaving room %s" % room))
             response = await self.bot.room_leave(room)
             if isinstance(response, niobot.RoomLeaveError):
                 await msg.edit("Failed to leave room %s: %s" % (room, response.message))
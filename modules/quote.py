@@ -1,87 +1,254 @@
 import asyncio
+import contextlib
+import dataclasses
 import io
+import json
+import logging
+import random
 import re
 import time
+import typing
+from pathlib import Path
 
-import niobot
+import aiosqlite
 import httpx
-import tempfile
+import niobot
+
+import attachments
+import config
+
+
+@dataclasses.dataclass
+class PrefetchedQuote:
+    url: str
+    data: bytes
+    attachment: niobot.ImageAttachment
+    fetched_at: float
+    gen_time: float
+    dl_time: float
+    ul_time: float
 
 
 class QuoteModule(niobot.Module):
+    INSPIROBOT_URL = "https://inspirobot.me/api?generate=true"
+
     def __init__(self, bot):
         super().__init__(bot)
-        self.lock = asyncio.Lock()
+        self.log = logging.getLogger(__name__)
+        self.pool: asyncio.Queue[PrefetchedQuote] = asyncio.Queue(getattr(config, "QUOTE_POOL_SIZE", 3))
+        self.prefetch_delay = getattr(config, "QUOTE_PREFETCH_DELAY", 5.0)
+        self.prefetch_task = asyncio.create_task(self.prefetcher())
+        self.xkcd_db = Path(getattr(config, "STORE_PATH", "./store")) / "xkcd.db"
+        self.xkcd: typing.Optional[aiosqlite.Connection] = None
+        self._xkcd_lock = asyncio.Lock()
+
+    def __teardown__(self):
+        self.prefetch_task.cancel()
+        if self.xkcd is not None:
+            xkcd, self.xkcd = self.xkcd, None
+            asyncio.create_task(xkcd.close())
+        super().__teardown__()
+
+    async def fetch_quote(self, upload: bool = True) -> PrefetchedQuote:
+        """Generates a quote, downloads it, and (unless upload is False) uploads it to the media repository."""
+        client = self.bot.http.get()
+        start = time.time()
+        response = await client.get(self.INSPIROBOT_URL)
+        gen_time = time.time() - start
+        response.raise_for_status()
+        url = response.text
+        start = time.time()
+        response = await client.get(url)
+        dl_time = time.time() - start
+        response.raise_for_status()
+        attachment = await niobot.ImageAttachment.from_file(
+            io.BytesIO(response.content),
+            file_name=url.rsplit("/", 1)[-1]
+        )
+        ul_time = 0.0
+        if upload:
+            start = time.time()
+            await attachment.upload(self.bot, False)
+            ul_time = time.time() - start
+        return PrefetchedQuote(url, response.content, attachment, time.time(), gen_time, dl_time, ul_time)
+
+    async def prefetcher(self):
+        """Keeps the pool topped up, fetching at most one quote every prefetch_delay seconds."""
+        while True:
+            try:
+                quote = await self.fetch_quote()
+            except Exception as e:
+                self.log.warning("Failed to prefetch a quote: %r", e)
+                await asyncio.sleep(max(self.prefetch_delay, 30))
+                continue
+            await self.pool.put(quote)
+            await asyncio.sleep(self.prefetch_delay)
 
     @niobot.command("quote", aliases=['q'])
     async def quote(self, ctx: niobot.Context, verbose: bool = False):
         """Generate a random quote.
         
         The source is https://inspirobot.me/"""
-        msg = await ctx.respond("Waiting...")
-        async with self.lock:
-            with tempfile.NamedTemporaryFile(suffix=".jpg") as tmp:
-                async with httpx.AsyncClient() as client:
-                    start = time.time()
-                    response = await client.get("https://inspirobot.me/api?generate=true")
-                    end = time.time()
-                    gen_time = (end - start)
-                    if response.status_code != 200:
-                        await msg.edit("Something happened!")
-                        return
-                    url = response.text
-                    start = time.time()
-                    response = await client.get(url)
-                    end = time.time()
-                    dl_time = (end - start)
-                    if response.status_code != 200:
-                        await msg.edit("Something happened and nearly succeeded!")
-                        return
-                    with open(tmp.name, "wb") as f:
-                        f.write(response.content)
-                    attachment = await niobot.ImageAttachment.from_file(tmp.name)
-                    start = time.time()
-                    await ctx.respond(url, file=attachment)
-                    end = time.time()
-                    ul_time = (end - start)
-                    if verbose:
-                        await msg.edit(
-                            "Response times:\n* Generate: {:,.2f}ms\n* Download: {:,.2f}ms\n* Upload: {:,.2f}ms".format(
-                                gen_time * 1000,
-                                dl_time * 1000,
-                                ul_time * 1000
-                            )
-                        )
-                    else:
-                        await msg.delete("command completed")
+        pooled = True
+        try:
+            quote = self.pool.get_nowait()
+        except asyncio.QueueEmpty:
+            pooled = False
+            try:
+                quote = await self.fetch_quote(upload=not ctx.room.encrypted)
+            except Exception as e:
+                self.log.error("Failed to fetch a quote: %r", e, exc_info=e)
+                await ctx.respond("Something happened!")
+                return
+
+        start = time.time()
+        if ctx.room.encrypted:
+            attachment = quote.attachment
+            if pooled:
+                # Pooled media was uploaded unencrypted, so encrypted rooms get a fresh upload.
+                attachment = await niobot.ImageAttachment.from_file(
+                    io.BytesIO(quote.data),
+                    file_name=quote.attachment.file_name
+                )
+            await ctx.respond(quote.url, file=attachment)
+        else:
+            await attachments.send_uploaded(
+                self.bot,
+                ctx.room,
+                quote.attachment.as_body(quote.url),
+                reply_to=ctx.message
+            )
+        send_time = time.time() - start
+        if verbose:
+            await ctx.respond(
+                "Response times ({}):\n* Generate: {:,.2f}ms\n* Download: {:,.2f}ms\n* Upload: {:,.2f}ms\n"
+                "* Send: {:,.2f}ms".format(
+                    "prefetched %.0fs ago" % (time.time() - quote.fetched_at) if pooled else "not prefetched",
+                    quote.gen_time * 1000,
+                    quote.dl_time * 1000,
+                    quote.ul_time * 1000,
+                    send_time * 1000
+                )
+            )
+
+    @contextlib.asynccontextmanager
+    async def xkcd_connection(self) -> typing.AsyncIterator[aiosqlite.Connection]:
+        """The connection to the xkcd cache, which maps comic numbers to their metadata and uploaded image. It's
+        opened on first use, and kept open until the module is torn down."""
+        if self.xkcd is None:
+            async with self._xkcd_lock:
+                if self.xkcd is None:
+                    self.xkcd = await self._open_xkcd()
+        yield self.xkcd
+
+    async def _open_xkcd(self) -> aiosqlite.Connection:
+        self.xkcd_db.parent.mkdir(parents=True, exist_ok=True)
+        connection = await aiosqlite.connect(self.xkcd_db)
+        try:
+            async with connection.execute("PRAGMA table_info(comics)") as cursor:
+                columns = {row[1] for row in await cursor.fetchall()}
+            if columns and "content" not in columns:
+                # From before whole event contents were stored. Their info lacks the mimetype and size.
+                await connection.execute("DROP TABLE comics")
+            await connection.execute(
+                "CREATE TABLE IF NOT EXISTS comics ("
+                "num INTEGER PRIMARY KEY, "
+                "metadata TEXT NOT NULL, "
+                "content TEXT NOT NULL"
+                ")"
+            )
+            await connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            await connection.commit()
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def xkcd_cached(self, number: int) -> typing.Optional[dict]:
+        """A comic's metadata, and the content of the event its (already uploaded) image was sent as."""
+        async with self.xkcd_connection() as connection:
+            async with connection.execute("SELECT metadata, content FROM comics WHERE num = ?", (number,)) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        return {"metadata": json.loads(row[0]), "content": json.loads(row[1])}
+
+    async def xkcd_store(self, number: int, metadata: dict, content: dict):
+        async with self.xkcd_connection() as connection:
+            await connection.execute(
+                "INSERT OR REPLACE INTO comics (num, metadata, content) VALUES (?, ?, ?)",
+                (number, json.dumps(metadata), json.dumps(content))
+            )
+            await connection.commit()
+
+    async def xkcd_latest(self) -> typing.Optional[int]:
+        """The number of the latest comic, refreshed at most every XKCD_LATEST_TTL seconds."""
+        async with self.xkcd_connection() as connection:
+            async with connection.execute("SELECT value FROM state WHERE key = 'latest'") as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                latest, checked = json.loads(row[0])
+                if time.time() - checked < getattr(config, "XKCD_LATEST_TTL", 3600):
+                    return latest
+            try:
+                response = await self.bot.http.cached_get("https://xkcd.com/info.0.json")
+                response.raise_for_status()
+                latest = response.json()["num"]
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                self.log.warning("Failed to fetch the latest xkcd: %r", e)
+                return json.loads(row[0])[0] if row is not None else None
+            await connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES ('latest', ?)",
+                (json.dumps([latest, time.time()]),)
+            )
+            await connection.commit()
+            return latest
 
     @niobot.command(name="xkcd")
     async def xkcd_command(self, ctx: niobot.Context, comic_number: int = None):
         """Fetches an XKCD comic.
 
         If none is provided, a random one is chosen."""
-        async with httpx.AsyncClient() as session:
-            if comic_number is None:
+        session = self.bot.http.get()
+        if comic_number is None:
+            latest = await self.xkcd_latest()
+            if latest is not None:
+                comic_number = random.randint(1, latest - 1)
+                if comic_number >= 404:
+                    # There is no comic 404.
+                    comic_number += 1
+            else:
                 response = await session.get("https://c.xkcd.com/random/comic/", follow_redirects=False)
                 if response.status_code != 302:
                     await ctx.respond("Unable to fetch a random comic (HTTP %d)" % response.status_code)
                     return
-                comic_number = re.match(r"https://xkcd.com/(\d+)/", response.headers["Location"]).group(1)
+                comic_number = int(re.match(r"https://xkcd.com/(\d+)/", response.headers["Location"]).group(1))
 
-            response = await session.get("https://xkcd.com/%d/info.0.json" % comic_number)
-            if response.status_code != 200:
-                await ctx.respond("Unable to fetch comic %d (HTTP %d)" % (comic_number, response.status_code))
-                return
+        cached = await self.xkcd_cached(comic_number)
+        if cached is not None and not ctx.room.encrypted:
+            await attachments.send_uploaded(self.bot, ctx.room, cached["content"], reply_to=ctx.message)
+            return
 
-            data = response.json()
-            download = await session.get(data["img"])
-            if download.status_code != 200:
-                await ctx.respond("Unable to download comic %d (HTTP %d)" % (comic_number, download.status_code))
-                return
+        response = await self.bot.http.cached_get("https://xkcd.com/%d/info.0.json" % comic_number)
+        if response.status_code != 200:
+            await ctx.respond("Unable to fetch comic %d (HTTP %d)" % (comic_number, response.status_code))
+            return
+
+        data = response.json()
+        download = await session.get(data["img"])
+        if download.status_code != 200:
+            await ctx.respond("Unable to download comic %d (HTTP %d)" % (comic_number, download.status_code))
+            return
 
-            with tempfile.NamedTemporaryFile("wb", prefix="xkcd-comic-", suffix=".png") as file:
-                file.write(download.content)
-                file.flush()
-                file.seek(0)
-                attachment = await niobot.ImageAttachment.from_file(file.name)
-                await ctx.respond(data["alt"], file=attachment)
+        attachment = await niobot.ImageAttachment.from_file(
+            io.BytesIO(download.content),
+            file_name=data["img"].rsplit("/", 1)[-1]
+        )
+        if ctx.room.encrypted:
+            # Encrypted uploads are keyed per file, so they can't be reused.
+            await ctx.respond(data["alt"], file=attachment)
+            return
+        await attachment.upload(self.bot, False)
+        content = attachment.as_body(data["alt"])
+        await self.xkcd_store(comic_number, data, content)
+        await attachments.send_uploaded(self.bot, ctx.room, content, reply_to=ctx.message)
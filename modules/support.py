@@ -39,19 +39,20 @@ class SupportRoomModule(niobot.Module):
     
     def __init__(self, bot: niobot.NioBot):
         super().__init__(bot)
-        self.http_client = httpx.AsyncClient(
-            headers={
-                "user-agent": niobot.__user_agent__
-            }
-        )
         self.last_etag = None
         self.next_run = datetime.datetime.utcnow()
         self._log = logging.getLogger(__name__)
         self.task = asyncio.create_task(self.github_task())
         self.db_lock = asyncio.Lock()
+        self.bot.router.add(self.on_message, room_id=self.ROOM_ID)
         if auth_getter():
             self._log.info("Using GitHub PAT for API requests.")
 
+    def __teardown__(self):
+        self.bot.router.remove(self.on_message)
+        self.task.cancel()
+        super().__teardown__()
+
     @staticmethod
     def version_is_newer(a: str, b: str) -> bool:
         """Checks if version A is newer than version B."""
@@ -67,21 +68,17 @@ class SupportRoomModule(niobot.Module):
 
         while True:
             try:
-                headers = {
-                    "Accept": "application/vnd.github+json",
-                }
-                if self.last_etag:
-                    headers["If-None-Match"] = self.last_etag
-                response = await self.http_client.get(
+                response = await self.bot.http.cached_get(
                     self.GITHUB_API_URL,
-                    headers=headers,
+                    headers={"Accept": "application/vnd.github+json"},
                     auth=auth_getter()
                 )
-                if response.status_code == 304:
+                response.raise_for_status()
+                # The cache handles revalidation, this just skips releases that have already been handled.
+                if response.headers.get("etag") and response.headers["etag"] == self.last_etag:
                     data = None
                 else:
-                    response.raise_for_status()
-                    self.last_etag = response.headers["etag"]
+                    self.last_etag = response.headers.get("etag")
                     data = response.json()
             except httpx.HTTPStatusError as e:
                 self._log.warning("Failed to fetch latest release data from GitHub: %s", e)
@@ -157,7 +154,7 @@ class SupportRoomModule(niobot.Module):
             "Runtime version: %s" % niobot_version.__version__,
         ]
         # Get pypi version
-        pypi_response = await self.http_client.get(self.PYPI_API_URL)
+        pypi_response = await self.bot.http.cached_get(self.PYPI_API_URL)
         if pypi_response.status_code != 200:
             lines.append(
                 "\N{cross mark} Failed to fetch PyPi version (HTTP %d %s)" % (
@@ -171,7 +168,7 @@ class SupportRoomModule(niobot.Module):
             lines.append("PyPi version: [%s](%s)" % (pypi_version, data["info"]["package_url"]))
 
         # Get GitHub version
-        github_response = await self.http_client.get(self.GITHUB_API_URL, auth=auth_getter())
+        github_response = await self.bot.http.cached_get(self.GITHUB_API_URL, auth=auth_getter())
         if github_response.status_code != 200:
             lines.append(
                 "\N{cross mark} Failed to fetch GitHub version (HTTP %d %s)" % (
@@ -188,14 +185,13 @@ class SupportRoomModule(niobot.Module):
             "\n\n".join(lines)
         )
 
-    @niobot.event("message")
     async def on_message(self, room: niobot.MatrixRoom, message: niobot.RoomMessageText):
-        if message.sender == self.bot.user_id or room.room_id != self.ROOM_ID:
+        if message.sender == self.bot.user_id:
             return
 
         msc_links = []
         for msc_match in self.MSC_REGEX.finditer(message.body):
-            response = await self.http_client.get(
+            response = await self.bot.http.cached_get(
                 self.MSC_URL % msc_match.group(1),
                 auth=auth_getter()
             )
@@ -234,7 +230,7 @@ class SupportRoomModule(niobot.Module):
             if gh_match.group(1) in repos:
                 repo = repos[gh_match.group(1)]
                 no = gh_match.group(3)
-                response = await self.http_client.get(
+                response = await self.bot.http.cached_get(
                     self.GH_URL % (repo, no),
                     auth=auth_getter()
                 )
@@ -6,7 +6,6 @@ import shlex
 import tempfile
 import textwrap
 
-import aiohttp
 import niobot
 import asyncio
 import re
@@ -20,6 +19,8 @@ import traceback
 import io
 import functools
 
+import attachments
+
 
 class EvalModule(niobot.Module):
     def __init__(self, bot: niobot.NioBot):
@@ -162,24 +163,25 @@ class EvalModule(niobot.Module):
     @niobot.is_owner()
     async def thumbnail(self, ctx: niobot.Context, url: str):
         """Get the thumbnail for a URL"""
-        async with aiohttp.ClientSession(headers={"User-Agent": niobot.__user_agent__}) as client:
-            async with client.get(url) as response:
-                if response.status != 200:
-                    await ctx.respond("Error: %d" % response.status)
-                    return
-                data = await response.read()
-                data = io.BytesIO(data)
-                thumb = await niobot.run_blocking(
-                    niobot.ImageAttachment.thumbnailify_image,
-                    data,
-                )
-                thumb.save('file.webp', "webp")
-                attachment = await niobot.ImageAttachment.from_file(
-                    'file.webp',
-                    generate_blurhash=True
-                )
-                self.log.info("Generated thumbnail: %r", attachment)
-                await ctx.respond(
-                    "thumbnail.webp",
-                    file=attachment
-                )
+        response = await self.bot.http.get().get(url)
+        if response.status_code != 200:
+            await ctx.respond("Error: %d" % response.status_code)
+            return
+        data = io.BytesIO(response.content)
+        thumb = await niobot.run_blocking(
+            niobot.ImageAttachment.thumbnailify_image,
+            data,
+        )
+        output = io.BytesIO()
+        thumb.save(output, "webp")
+        async with attachments.open_attachment(
+            niobot.ImageAttachment,
+            output.getbuffer(),
+            "thumbnail.webp",
+            generate_blurhash=True
+        ) as attachment:
+            self.log.info("Generated thumbnail: %r", attachment)
+            await ctx.respond(
+                "thumbnail.webp",
+                file=attachment
+            )
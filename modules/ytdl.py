@@ -1,18 +1,25 @@
 import json
 import pathlib
 import asyncio
+import contextlib
+import copy
+import time
 from urllib.parse import urlparse
 
-import aiohttp
 import niobot
 import subprocess
+import attachments
 import config
+import edits
+import jobs
+import progress
+import ytdl_workers
 from functools import partial
 
 import nio
 import aiofiles
+import aiosqlite
 import magic
-from yt_dlp import YoutubeDL
 import tempfile
 import typing
 
@@ -40,9 +47,41 @@ class YoutubeDownloadModule(niobot.Module):
         self.to_mount = {
             "ytdl": self.ytdl,
         }
-        self.lock = asyncio.Lock()
+        self.jobs = jobs.JobScheduler(
+            "ytdl",
+            concurrency=getattr(config, "YTDL_CONCURRENCY", 2),
+            per_user=getattr(config, "YTDL_USER_CONCURRENCY", 1)
+        )
+        self.cache_db = pathlib.Path(getattr(config, "STORE_PATH", "./store")) / "ytdl.db"
+        self.cache: typing.Optional[aiosqlite.Connection] = None
+        self._cache_lock = asyncio.Lock()
+        # One more worker than there are download slots, so that extracting info for a new request doesn't have to
+        # wait for a download to finish.
+        self.workers = ytdl_workers.WorkerPool(
+            getattr(config, "YTDL_WORKERS", self.jobs.concurrency + 1),
+            getattr(config, "YTDL_WORKER_MAX_JOBS", 25)
+        )
+        self.warm_task = asyncio.create_task(self.workers.start())
 
-    def _download(self, url: str, download_format: str, *, temp_dir: str) -> typing.List[pathlib.Path]:
+    def __teardown__(self):
+        asyncio.create_task(self.workers.close())
+        if self.cache is not None:
+            cache, self.cache = self.cache, None
+            asyncio.create_task(cache.close())
+        super().__teardown__()
+
+    async def _download(
+            self,
+            url: str,
+            download_format: str,
+            *,
+            temp_dir: str,
+            info: dict = None,
+            on_progress: typing.Callable[[dict], typing.Any] = None
+    ) -> typing.List[pathlib.Path]:
+        """Downloads `url` into temp_dir, returning the downloaded files.
+
+        If `info` (from get_video_info) is given, it's processed directly, rather than extracting the page again."""
         args = YTDL_ARGS.copy()
         dl_loc = pathlib.Path(temp_dir) / "dl"
         tmp_loc = pathlib.Path(temp_dir) / "tmp"
@@ -58,11 +97,10 @@ class YoutubeDownloadModule(niobot.Module):
             args["format"] = "(bv+ba/b)[filesize<100M]"
         args["format"] = "(%s)[vcodec!=h265]" % args["format"]
 
-        with YoutubeDL(args) as ytdl_instance:
-            self.log.info("Downloading %s with format: %r", url, args["format"])
-            ytdl_instance.download(
-                [url]
-            )
+        self.log.info("Downloading %s with format: %r", url, args["format"])
+        # With info, format selection is re-run against info["formats"] with this format, so the earlier selection
+        # (made with the default format) doesn't matter.
+        await self.workers.run("download", on_progress, url=url, args=args, info=info)
 
         x = list(dl_loc.iterdir())
         return x
@@ -111,15 +149,203 @@ class YoutubeDownloadModule(niobot.Module):
             body["url"] = response.content_uri
             return body
 
+    async def fetch_thumbnail(self, thumbnail_url: str) -> typing.Optional[niobot.ImageAttachment]:
+        """Downloads and uploads a video's thumbnail."""
+        parsed = urlparse(thumbnail_url)
+        resp = await self.bot.http.get().get(
+            thumbnail_url,
+            headers={
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) " + niobot.__user_agent__
+            }
+        )
+        if resp.status_code != 200:
+            self.log.warning("Failed to fetch thumbnail %s (HTTP %d)", thumbnail_url, resp.status_code)
+            return None
+        async with attachments.open_attachment(
+                niobot.ImageAttachment,
+                resp.content,
+                parsed.path.split("/")[-1]
+        ) as att:
+            await att.upload(self.client)
+        return att
+
+    async def prepare_upload(
+            self,
+            file: pathlib.Path,
+            thumbnail_task: typing.Optional["asyncio.Task[typing.Optional[niobot.ImageAttachment]]"]
+    ) -> niobot.VideoAttachment:
+        """Probes a downloaded file into an attachment, with the (shared) thumbnail, if there is one."""
+        if thumbnail_task is None:
+            # Let niobot generate a thumbnail from the video instead.
+            return await niobot.VideoAttachment.from_file(file)
+        upload, thumbnail = await asyncio.gather(
+            niobot.VideoAttachment.from_file(file, thumbnail=False),
+            asyncio.shield(thumbnail_task)
+        )
+        if thumbnail is not None:
+            # The thumbnail is shared between files (which may differ in resolution), so each gets its own copy.
+            upload.thumbnail = copy.deepcopy(thumbnail)
+            upload.thumbnail.info["h"] = upload.info["h"]
+            upload.thumbnail.info["w"] = upload.info["w"]
+        return upload
+
+    async def upload_with_progress(
+            self,
+            msg: edits.CoalescedMessage,
+            upload: niobot.BaseAttachment,
+            file: pathlib.Path,
+            resolution: str
+    ):
+        """Uploads `upload` (read from `file`) and its thumbnail, showing the upload's progress in msg, and records the
+        measured upload rate."""
+        size = file.stat().st_size
+        reporter = progress.TransferProgress(
+            msg,
+            "Uploading %s (%s)" % (file.name, resolution),
+            total=size,
+            expected_rate=await self.get_throughput("upload")
+        )
+        msg.edit_nowait(reporter.render())
+        monitor = nio.TransferMonitor(size, on_transferred=reporter.update)
+        async with aiofiles.open(file, "rb") as _file:
+            response, _ = await self.client.upload(
+                _file,
+                content_type=upload.mime_type,
+                filename=file.name,
+                filesize=size,
+                monitor=monitor
+            )
+        if not isinstance(response, nio.UploadResponse):
+            raise niobot.MediaUploadException(response=response)
+        upload.url = response.content_uri
+        await self.record_throughput("upload", size, reporter.duration)
+        if upload.thumbnail and upload.thumbnail.url is None:
+            # A thumbnail niobot generated from the video (rather than one fetch_thumbnail already uploaded).
+            await upload.thumbnail.upload(self.client)
+
     async def get_video_info(self, url: str, secure: bool = False) -> dict:
         """Extracts JSON information about the video"""
-        args = YTDL_ARGS.copy()
-        with YoutubeDL(args) as ytdl_instance:
-            info = ytdl_instance.extract_info(url, download=False)
-            info = ytdl_instance.sanitize_info(info, remove_private_keys=secure)
+        info = await self.workers.run("extract", url=url, args=YTDL_ARGS.copy(), secure=secure)
         self.log.debug("ytdl info for %s: %r", url, info)
         return info
 
+    @staticmethod
+    def cache_key(info: dict, download_format: str) -> str:
+        """Identifies a download by what was downloaded (not by the URL, since many URLs lead to the same video)."""
+        return "%s:%s:%s" % (info.get("extractor_key") or info.get("extractor"), info["id"], download_format)
+
+    @contextlib.asynccontextmanager
+    async def cache_connection(self) -> typing.AsyncIterator[aiosqlite.Connection]:
+        """The connection to the download cache, which maps downloads to the content of the events they were sent as.
+        It's opened on first use, and kept open until the module is torn down."""
+        if self.cache is None:
+            async with self._cache_lock:
+                if self.cache is None:
+                    self.cache = await self._open_cache()
+        yield self.cache
+
+    async def _open_cache(self) -> aiosqlite.Connection:
+        self.cache_db.parent.mkdir(parents=True, exist_ok=True)
+        connection = await aiosqlite.connect(self.cache_db)
+        try:
+            await connection.execute(
+                "CREATE TABLE IF NOT EXISTS throughput (direction TEXT PRIMARY KEY, rate REAL NOT NULL, updated REAL)"
+            )
+            await connection.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "key TEXT PRIMARY KEY, "
+                "title TEXT NOT NULL, "
+                "url TEXT NOT NULL, "
+                "contents TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "created REAL NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "hits INTEGER NOT NULL DEFAULT 0"
+                ")"
+            )
+            await connection.commit()
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def get_throughput(self, direction: str) -> float:
+        """The measured rate of downloads or uploads (direction), in bytes per second. Falls back to the configured
+        DOWNLOAD_SPEED_MEGABITS or UPLOAD_SPEED_BITS until something's been measured."""
+        async with self.cache_connection() as connection:
+            async with connection.execute("SELECT rate FROM throughput WHERE direction = ?", (direction,)) as cursor:
+                row = await cursor.fetchone()
+        if row is not None:
+            return row[0]
+        if direction == "download":
+            return getattr(config, "DOWNLOAD_SPEED_MEGABITS", 75) * (10**6) / 8
+        return getattr(config, "UPLOAD_SPEED_BITS", 15 * (10**6)) / 8
+
+    async def record_throughput(self, direction: str, size: int, seconds: float):
+        """Folds a finished transfer into the measured rate (an exponentially weighted moving average)."""
+        if size < 1024 * 1024 or seconds <= 0:
+            # Small transfers are mostly latency, and would drag the average down.
+            return
+        rate = size / seconds
+        previous = await self.get_throughput(direction)
+        rate = 0.3 * rate + 0.7 * previous
+        async with self.cache_connection() as connection:
+            await connection.execute(
+                "INSERT OR REPLACE INTO throughput (direction, rate, updated) VALUES (?, ?, ?)",
+                (direction, rate, time.time())
+            )
+            await connection.commit()
+        self.log.debug("Measured %s throughput is now %.1f KiB/s", direction, rate / 1024)
+
+    async def cache_get(self, key: str) -> typing.Optional[typing.List[dict]]:
+        """The event contents a download was sent as, if it was sent within the last YTDL_CACHE_TTL seconds."""
+        async with self.cache_connection() as connection:
+            async with connection.execute("SELECT contents, created FROM downloads WHERE key = ?", (key,)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > getattr(config, "YTDL_CACHE_TTL", 7 * 86400):
+                await connection.execute("DELETE FROM downloads WHERE key = ?", (key,))
+                await connection.commit()
+                return None
+            await connection.execute(
+                "UPDATE downloads SET last_used = ?, hits = hits + 1 WHERE key = ?",
+                (time.time(), key)
+            )
+            await connection.commit()
+        return json.loads(row[0])
+
+    async def cache_store(self, key: str, info: dict, contents: typing.List[dict], size: int):
+        now = time.time()
+        async with self.cache_connection() as connection:
+            await connection.execute(
+                "INSERT OR REPLACE INTO downloads (key, title, url, contents, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, info.get("title") or key, info.get("original_url") or "", json.dumps(contents), size, now, now)
+            )
+            await self.cache_evict(connection)
+            await connection.commit()
+
+    async def cache_evict(self, connection: aiosqlite.Connection):
+        """Removes expired downloads, then the least recently used ones until the total is within YTDL_CACHE_SIZE."""
+        await connection.execute(
+            "DELETE FROM downloads WHERE created < ?",
+            (time.time() - getattr(config, "YTDL_CACHE_TTL", 7 * 86400),)
+        )
+        max_size = getattr(config, "YTDL_CACHE_SIZE", 5 * 1024 ** 3)
+        async with connection.execute("SELECT COALESCE(SUM(size), 0) FROM downloads") as cursor:
+            (total,) = await cursor.fetchone()
+        evict = []
+        async with connection.execute("SELECT key, size FROM downloads ORDER BY last_used") as cursor:
+            async for key, size in cursor:
+                if total <= max_size:
+                    break
+                evict.append((key,))
+                total -= size
+        await connection.executemany("DELETE FROM downloads WHERE key = ?", evict)
+        if evict:
+            self.log.info("Evicted %d downloads from the cache", len(evict))
+
     @staticmethod
     def resolve_thumbnail(info: dict, resolution: str = None) -> typing.Optional[str]:
         """Resolves the thumbnail URL from the info dict"""
@@ -170,109 +396,219 @@ class YoutubeDownloadModule(niobot.Module):
         if ctx.room.encrypted:
             await ctx.respond("This command is not available in encrypted rooms.")
             return
-        if self.lock.locked():
-            msg = await ctx.respond("Waiting for previous download to finish...")
-        else:
-            msg = await ctx.respond("Downloading...")
-        async with self.lock:
-            room = ctx.room
-            dl_format = _format or "(bv+ba/b)[filesize<=80M]/b"  #
-            try:
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    info = await self.get_video_info(url)
-                    if not info:
-                        await msg.edit("Could not get video info (Restricted?)")
+        msg = edits.coalesce(await ctx.respond("Fetching video info..."))
+        dl_format = _format or "(bv+ba/b)[filesize<=80M]/b"
+        try:
+            info = await self.get_video_info(url)
+        except Exception as e:
+            self.log.error("Error: %s", e, exc_info=e)
+            await msg.edit("Error: " + str(e))
+            return
+        if not info:
+            await msg.edit("Could not get video info (Restricted?)")
+            return
+
+        key = self.cache_key(info, dl_format)
+        cached = await self.cache_get(key)
+        if cached is not None:
+            self.log.info("Sending %s from the cache", key)
+            await msg.edit("Sending [%r](%s)..." % (info["title"], info["original_url"]))
+            for content in cached:
+                await attachments.send_uploaded(self.bot, ctx.room, content)
+            await msg.delete("Command completed.")
+            return
+
+        async def report_position(job: jobs.Job, position: int):
+            await msg.edit(
+                "Waiting for %s (`%sytdl-cancel %d` to cancel)..." % (
+                    "%d download%s ahead of this one" % (position, "s" if position != 1 else "")
+                    if position else "a free download slot",
+                    ctx.bot.command_prefix,
+                    job.id
+                )
+            )
+
+        try:
+            async with self.jobs.slot(ctx.message.sender, url, on_position=report_position) as job:
+                await msg.edit("Downloading...")
+                await self.download_job(ctx, msg, job, url, info, dl_format)
+        except jobs.JobCancelled:
+            await msg.edit("Download cancelled.")
+
+    async def download_job(
+            self,
+            ctx: niobot.Context,
+            msg: edits.CoalescedMessage,
+            job: jobs.Job,
+            url: str,
+            info: dict,
+            dl_format: str
+    ):
+        """Downloads and sends `url`, once `job` has been given a slot, and caches what was sent."""
+        room = ctx.room
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                size = int(info.get("filesize") or info.get("filesize_approx") or 30 * 1024 * 1024)
+                download_rate = await self.get_throughput("download")
+                label = "Downloading [%r](%s)" % (info["title"], info["original_url"])
+                await msg.edit("%s (ETA %s)..." % (label, progress.format_duration(size / download_rate)))
+                reporters: typing.Dict[str, progress.TransferProgress] = {}
+
+                def on_progress(status: dict):
+                    # bv+ba downloads the video and the audio separately, so each file gets its own progress.
+                    if status["status"] not in ("downloading", "finished") or not status.get("filename"):
                         return
-                    size = int(info.get("filesize") or info.get("filesize_approx") or 30 * 1024 * 1024)
-                    download_speed = getattr(config, "DOWNLOAD_SPEED_MEGABITS", 75) * (10**6)
-                    ETA = (size * 8) / download_speed
-                    minutes, seconds = divmod(ETA, 60)
-                    seconds = round(seconds)
-                    await msg.edit(
-                        "Downloading [%r](%s) (ETA %s)..." % (
-                            info["title"],
-                            info["original_url"],
-                            "%d minutes and %d seconds" % (minutes, seconds) if minutes else "%d seconds" % seconds
+                    reporter = reporters.get(status["filename"])
+                    if reporter is None:
+                        reporter = reporters[status["filename"]] = progress.TransferProgress(
+                            msg,
+                            "%s, part %d" % (label, len(reporters) + 1) if reporters else label,
+                            expected_rate=download_rate
                         )
+                    reporter.update(
+                        status.get("downloaded_bytes") or 0,
+                        status.get("total_bytes") or status.get("total_bytes_estimate")
                     )
-                    self.log.info("Downloading %s to %s", url, temp_dir)
-                    files = await niobot.run_blocking(self._download, url, dl_format, temp_dir=temp_dir)
-                    await msg.edit("Processing...")
-                    self.log.info("Downloaded %d files", len(files))
-                    if not files:
-                        await msg.edit("No files downloaded")
-                        return
-                    sent = False
-                    for file in files:
-                        thumbnail = None
-                        data = await niobot.run_blocking(
-                            niobot.get_metadata,
-                            file
-                        )
-                        size_mb = file.stat().st_size / 1024 / 1024
-                        resolution = "%dx%d" % (data["streams"][0]["width"], data["streams"][0]["height"])
-
-                        thumbnail_url = self.resolve_thumbnail(info, resolution)
-                        if thumbnail_url:
-                            parsed = urlparse(thumbnail_url)
-                            with tempfile.NamedTemporaryFile(
-                                suffix='.%s' % parsed.path.split(".")[-1],
-                                delete=False
-                            ) as thumb:
-                                async with aiohttp.ClientSession(
-                                    headers={
-                                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) " +
-                                                      niobot.__user_agent__
-                                    }
-                                ) as session:
-                                    async with session.get(thumbnail_url) as resp:
-                                        if resp.status == 200:
-                                            thumb.write(await resp.read())
-                                            thumb.flush()
-                                            thumb.seek(0)
-                                            att = await niobot.ImageAttachment.from_file(
-                                                thumb.name,
-                                                file_name=parsed.path.split("/")[-1]
-                                            )
-                                            await att.upload(ctx.client)
-                                            thumbnail = att
-
-                        upload_speed = getattr(config, "UPLOAD_SPEED_BITS", 15) / (10**6)
-                        ETA = ((size_mb / 1024 / 1024) * 8) / upload_speed
-                        minutes, seconds = divmod(ETA, 60)
-                        seconds = round(seconds)
-                        await msg.edit(
-                            "Uploading %s (%dMb, %s, ETA %s)..." % (
-                                file.name,
-                                size_mb,
-                                resolution,
-                                "%d minutes and %d seconds" % (minutes, seconds) if minutes else "%d seconds" % seconds
-                            )
-                        )
-                        self.log.info("Uploading %s (%dMb, %s)", file.name, size_mb, resolution)
-                        upload = await niobot.VideoAttachment.from_file(
-                            file,
-                            thumbnail=thumbnail,
-                        )
-                        if upload.thumbnail:
-                            upload.thumbnail.info["h"] = upload.info["h"]
-                            upload.thumbnail.info["w"] = upload.info["w"]
+
+                self.log.info("Downloading %s to %s", url, temp_dir)
+                files = await self._download(url, dl_format, temp_dir=temp_dir, info=info, on_progress=on_progress)
+                await self.record_throughput(
+                    "download",
+                    sum(reporter.done for reporter in reporters.values()),
+                    sum(reporter.duration for reporter in reporters.values())
+                )
+                await msg.edit("Processing...")
+                self.log.info("Downloaded %d files", len(files))
+                if not files:
+                    await msg.edit("No files downloaded")
+                    return
+                # The thumbnail only depends on the video, so it's fetched (once) while the files are probed. Each
+                # file is then prepared while the one before it uploads.
+                resolution = "%dx%d" % (info["width"], info["height"]) if info.get("width") and info.get("height") \
+                    else None
+                thumbnail_url = self.resolve_thumbnail(info, resolution)
+                thumbnail_task = asyncio.create_task(self.fetch_thumbnail(thumbnail_url)) if thumbnail_url else None
+                prepared = asyncio.create_task(self.prepare_upload(files[0], thumbnail_task))
+                sent = []
+                sent_size = 0
+                try:
+                    for index, file in enumerate(files):
+                        upload = await prepared
+                        if index + 1 < len(files):
+                            prepared = asyncio.create_task(self.prepare_upload(files[index + 1], thumbnail_task))
+                        resolution = "%dx%d" % (upload.info["w"], upload.info["h"])
+                        self.log.info("Uploading %s (%.1fMb, %s)", file.name, upload.size_as("mib"), resolution)
                         try:
-                            await self.client.send_message(room, content=file.name, file=upload)
+                            await self.upload_with_progress(msg, upload, file, resolution)
+                            await attachments.send_uploaded(self.bot, room, upload.as_body(file.name))
                         except Exception as e:
                             self.log.error("Error: %s", e, exc_info=e)
                             await msg.edit("Error: %r" % e)
                             return
-                        sent = True
-
-                    if sent:
-                        await msg.edit("Completed, downloaded [your video]({})".format("url"))
-                        await asyncio.sleep(10)
-                        await msg.delete("Command completed.")
-            except Exception as e:
-                self.log.error("Error: %s", e, exc_info=e)
-                await msg.edit("Error: " + str(e))
+                        sent.append(upload.as_body(file.name))
+                        sent_size += file.stat().st_size
+                finally:
+                    for task in (prepared, thumbnail_task):
+                        if task is not None and not task.done():
+                            task.cancel()
+
+                if sent:
+                    await self.cache_store(self.cache_key(info, dl_format), info, sent, sent_size)
+                    await msg.edit("Completed, downloaded [your video]({})".format(info["original_url"]))
+                    await asyncio.sleep(10)
+                    await msg.delete("Command completed.")
+        except Exception as e:
+            self.log.error("Error: %s", e, exc_info=e)
+            await msg.edit("Error: " + str(e))
+            return
+
+    @niobot.command(
+        "ytdl-cancel",
+        usage="[job ID]",
+        arguments=[
+            niobot.Argument(
+                "job_id",
+                int,
+                description="The download to cancel. Defaults to your most recent one.",
+                required=False,
+                default=None
+            )
+        ]
+    )
+    async def ytdl_cancel(self, ctx: niobot.Context, job_id: int = None):
+        """Cancels one of your queued or running downloads."""
+        sender = ctx.message.sender
+        if job_id is None:
+            own = self.jobs.jobs_for(sender)
+            if not own:
+                await ctx.respond("You don't have any downloads queued or running.")
                 return
+            job = own[-1]
+        else:
+            job = self.jobs.jobs.get(job_id)
+            if job is None:
+                await ctx.respond("There's no queued or running download with ID %d." % job_id)
+                return
+            if job.owner != sender and not self.bot.is_owner(sender):
+                await ctx.respond("You can only cancel your own downloads.")
+                return
+        if self.jobs.cancel(job):
+            await ctx.respond("Cancelling download %d (%s)." % (job.id, job.description))
+        else:
+            await ctx.respond("Download %d is already finishing." % job.id)
+
+    @niobot.command(
+        "ytdl-cache",
+        usage="[list|purge] [key]",
+        arguments=[
+            niobot.Argument("action", str, description="list or purge.", required=False, default="list"),
+            niobot.Argument(
+                "key",
+                str,
+                description="The download to purge. Purges everything if not given.",
+                required=False,
+                default=None
+            ),
+        ]
+    )
+    @niobot.is_owner()
+    async def ytdl_cache(self, ctx: niobot.Context, action: str = "list", key: str = None):
+        """Lists or purges cached downloads."""
+        async with self.cache_connection() as connection:
+            if action == "purge":
+                if key is None:
+                    cursor = await connection.execute("DELETE FROM downloads")
+                else:
+                    cursor = await connection.execute("DELETE FROM downloads WHERE key = ?", (key,))
+                await connection.commit()
+                await ctx.respond("Purged %d cached downloads." % cursor.rowcount)
+                return
+            if action != "list":
+                await ctx.respond("Unknown action %r (expected list or purge)." % action)
+                return
+            async with connection.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM downloads"
+            ) as cursor:
+                count, total, hits = await cursor.fetchone()
+            async with connection.execute(
+                    "SELECT key, title, size, created, hits FROM downloads ORDER BY last_used DESC LIMIT 10"
+            ) as cursor:
+                rows = await cursor.fetchall()
+        lines = [
+            "%d cached downloads, %.1f MiB of %.1f MiB, %d hits." % (
+                count,
+                total / 1024 / 1024,
+                getattr(config, "YTDL_CACHE_SIZE", 5 * 1024 ** 3) / 1024 / 1024,
+                hits
+            )
+        ]
+        for row_key, title, size, created, row_hits in rows:
+            lines.append(
+                "* `%s` %s (%.1f MiB, %d hits, %.1f hours old)" % (
+                    row_key, title, size / 1024 / 1024, row_hits, (time.time() - created) / 3600
+                )
+            )
+        await ctx.respond("\n".join(lines))
 
     @niobot.command("ytdl-metadata", arguments=[niobot.Argument("url", str, description="The URL to download.")])
     async def ytdl_metadata(self, ctx: niobot.Context, url: str):
@@ -287,14 +623,9 @@ class YoutubeDownloadModule(niobot.Module):
             await msg.edit("```json\n%s\n```" % pretty)
             return
 
-        with tempfile.NamedTemporaryFile(suffix=".json") as temp_file:
-            p = pathlib.Path(temp_file.name)
-            with open(temp_file.name, "w") as __temp_file:
-                json.dump(extracted, __temp_file, indent=4, default=repr)
-                __temp_file.flush()
-            upload = niobot.FileAttachment(p, "application/json")
+        async with attachments.open_attachment(niobot.FileAttachment, pretty.encode("utf-8"), "info.json") as upload:
             await ctx.respond("info.json", file=upload)
-            await msg.delete()
+        await msg.delete()
 
     @niobot.command("media-info")
     async def media_info(self, ctx: niobot.Context, event: niobot.Event):
@@ -303,31 +634,32 @@ class YoutubeDownloadModule(niobot.Module):
             await ctx.respond("Event is not an image, video, or audio file (%r)" % type(event))
             return
 
-        msg = await ctx.respond("Downloading, please wait.")
+        msg = edits.coalesce(await ctx.respond("Downloading, please wait."))
         response = await self.bot.download(event.url)
         if not isinstance(response, niobot.DownloadResponse):
             await msg.edit("Could not download media: %r" % response)
             return
-        suffix = pathlib.Path(response.filename).suffix
-        with tempfile.NamedTemporaryFile("wb", suffix=suffix) as _file:
-            _file.write(response.body)
-            _file.flush()
-            _file.seek(0)
-            await msg.edit('Processing, please wait.')
-            media_type = response.content_type or await niobot.run_blocking(niobot.detect_mime_type, _file.name)
-            attachment = await ({
-                'image': niobot.ImageAttachment,
-                'audio': niobot.AudioAttachment,
-                'video': niobot.VideoAttachment
-            }.get(media_type.split("/")[0], niobot.FileAttachment)).from_file(_file.name)
-            metadata = await niobot.run_blocking(niobot.get_metadata, _file.name)
+        suffix = pathlib.Path(response.filename or "").suffix
+        await msg.edit('Processing, please wait.')
+        media_type = response.content_type or await niobot.run_blocking(magic.from_buffer, response.body[:4096], True)
+        factory = {
+            'image': niobot.ImageAttachment,
+            'audio': niobot.AudioAttachment,
+            'video': niobot.VideoAttachment
+        }.get(media_type.split("/")[0], niobot.FileAttachment)
+        async with attachments.open_attachment(
+                factory,
+                response.body,
+                response.filename or "media" + suffix
+        ) as attachment:
+            metadata = await niobot.run_blocking(attachments.probe, response.body, suffix)
             duration = getattr(attachment, 'duration', 'N/A')
             resolution = "{0.width}x{0.height}".format(attachment) if hasattr(attachment, 'width') else 'N/A'
             lines = [
                 '# Summary',
                 '- **File Type**: %s' % media_type,
                 '- **File Size**: {:.1f} MiB ({:,} bytes)'.format(attachment.size_as('mib'), len(response.body)),
-                '- **File Name**: `%s`' % response.filename or pathlib.Path(_file.name).name,
+                '- **File Name**: `%s`' % (response.filename or "N/A"),
                 '- **URL**: HTTP: %s | MXC: %s' % (await self.bot.mxc_to_http(event.url), event.url),
                 "",
                 '# Metadata',
@@ -338,4 +670,4 @@ class YoutubeDownloadModule(niobot.Module):
                 '# Raw probe info',
                 '```json\n%s\n```' % json.dumps(metadata, indent=4, default=repr)
             ]
-            await msg.edit("\n".join(lines))
+        await msg.edit("\n".join(lines))
@@ -0,0 +1,225 @@
+"""
+Central scheduling for outbound room events.
+
+Every send, edit, reaction, redaction and leave goes through `bot.room_send` (or `room_redact`/`room_leave`/
+`room_forget`), which `OutboundScheduler.install` replaces with versions that queue the call instead of firing it
+immediately. Calls are then released according to a global token bucket and a per-room token bucket, in priority
+order (replies before reactions, edits and redactions), with at most one call in flight per room so that a room's
+events keep their order.
+
+If the homeserver rate limits a call anyway (M_LIMIT_EXCEEDED), everything is held back for `retry_after_ms` and the
+call is retried, rather than failing the command that made it.
+"""
+import asyncio
+import bisect
+import dataclasses
+import functools
+import itertools
+import logging
+import time
+import typing
+
+import niobot
+
+import metrics
+
+__all__ = ("TokenBucket", "OutboundScheduler", "PRIORITY_HIGH", "PRIORITY_NORMAL", "PRIORITY_LOW")
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+OUTBOUND_WAIT = metrics.REGISTRY.histogram(
+    "niobot_outbound_wait_seconds",
+    "Time outbound room events spent queued before being sent.",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+RATE_LIMITED = metrics.REGISTRY.counter(
+    "niobot_outbound_rate_limited_total",
+    "Outbound room events that were rate limited by the homeserver."
+)
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `capacity`."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """How long until a token will be available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+@dataclasses.dataclass(order=True)
+class _Request:
+    priority: int
+    seq: int
+    room_id: str = dataclasses.field(compare=False)
+    method: typing.Callable = dataclasses.field(compare=False)
+    args: tuple = dataclasses.field(compare=False)
+    kwargs: dict = dataclasses.field(compare=False)
+    future: asyncio.Future = dataclasses.field(compare=False)
+    queued: float = dataclasses.field(compare=False, default_factory=time.monotonic)
+    attempts: int = dataclasses.field(compare=False, default=0)
+
+
+class OutboundScheduler:
+    """Queues outbound room events and releases them as fast as the rate limits allow."""
+    METHODS = ("room_send", "room_redact", "room_leave", "room_forget")
+
+    def __init__(
+            self,
+            bot: niobot.NioBot,
+            rate: float = 5.0,
+            burst: float = 10,
+            room_rate: float = 1.0,
+            room_burst: float = 5,
+            max_retries: int = 5
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, burst)
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.rooms: typing.Dict[str, TokenBucket] = {}
+        self.pending: typing.List[_Request] = []
+        self.busy: typing.Set[str] = set()
+        self.backoff_until = 0.0
+        self.task: typing.Optional[asyncio.Task] = None
+        self.log = logging.getLogger(__name__)
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks: typing.Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def install(self):
+        """Replaces the bot's outbound methods with scheduled versions."""
+        for name in self.METHODS:
+            setattr(self.bot, name, self._wrap(name, getattr(self.bot, name)))
+
+    def start(self):
+        """Starts releasing queued calls, if that isn't already running. The first call submitted does this too."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    @staticmethod
+    def priority_for(name: str, args: tuple, kwargs: dict) -> int:
+        if name != "room_send":
+            return PRIORITY_LOW if name == "room_redact" else PRIORITY_NORMAL
+        message_type = args[1] if len(args) > 1 else kwargs.get("message_type")
+        content = args[2] if len(args) > 2 else kwargs.get("content")
+        if message_type == "m.reaction" or (isinstance(content, dict) and "m.new_content" in content):
+            return PRIORITY_LOW
+        return PRIORITY_HIGH
+
+    def _wrap(self, name: str, method: typing.Callable) -> typing.Callable:
+        @functools.wraps(method)
+        async def scheduled(*args, **kwargs):
+            room_id = args[0] if args else kwargs.get("room_id")
+            return await self.submit(room_id, method, args, kwargs, self.priority_for(name, args, kwargs))
+        return scheduled
+
+    async def submit(self, room_id: str, method: typing.Callable, args: tuple, kwargs: dict, priority: int):
+        """Queues `method(*args, **kwargs)` and waits for its result."""
+        request = _Request(
+            priority,
+            next(self._counter),
+            room_id,
+            method,
+            args,
+            kwargs,
+            asyncio.get_running_loop().create_future()
+        )
+        bisect.insort(self.pending, request)
+        self.start()
+        self._wakeup.set()
+        return await request.future
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self) -> typing.Optional[float]:
+        """Starts every request that can go now, returning how long until the next one might be able to."""
+        now = time.monotonic()
+        if now < self.backoff_until:
+            return self.backoff_until - now
+        soonest = None
+        for request in list(self.pending):
+            if request.future.done():
+                # The caller gave up (was cancelled).
+                self.pending.remove(request)
+                continue
+            if request.room_id in self.busy:
+                continue
+            bucket = self.rooms.get(request.room_id)
+            if bucket is None:
+                bucket = self.rooms[request.room_id] = TokenBucket(self.room_rate, self.room_burst)
+            wait = bucket.delay(now)
+            if wait > 0:
+                soonest = wait if soonest is None else min(soonest, wait)
+                continue
+            wait = self.bucket.delay(now)
+            if wait > 0:
+                return wait if soonest is None else min(soonest, wait)
+            bucket.take(now)
+            self.bucket.take(now)
+            self.pending.remove(request)
+            self.busy.add(request.room_id)
+            OUTBOUND_WAIT.observe(now - request.queued)
+            task = asyncio.create_task(self._execute(request))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return soonest
+
+    async def _execute(self, request: _Request):
+        try:
+            result = await request.method(*request.args, **request.kwargs)
+        except asyncio.CancelledError:
+            request.future.cancel()
+            raise
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+            return
+        finally:
+            self.busy.discard(request.room_id)
+            self._wakeup.set()
+
+        if getattr(result, "status_code", None) == "M_LIMIT_EXCEEDED":
+            RATE_LIMITED.inc()
+            retry_after = (getattr(result, "retry_after_ms", None) or 1000) / 1000
+            self.backoff_until = max(self.backoff_until, time.monotonic() + retry_after)
+            if request.attempts < self.max_retries and not request.future.done():
+                request.attempts += 1
+                self.log.warning(
+                    "Rate limited sending to %s, retrying in %.1fs (attempt %d)",
+                    request.room_id,
+                    retry_after,
+                    request.attempts
+                )
+                bisect.insort(self.pending, request)
+                return
+        if not request.future.done():
+            request.future.set_result(result)
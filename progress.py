@@ -0,0 +1,99 @@
+"""
+Live progress for long transfers (downloads and uploads), shown by editing a status message.
+
+    reporter = progress.TransferProgress(msg, "Uploading video.mp4", total=size, expected_rate=rate)
+    monitor = nio.TransferMonitor(size, on_transferred=reporter.update)
+
+`update` can be called as often as the transfer likes: the rate is only sampled (and the message only re-rendered)
+once every `interval` seconds, and the message itself is a CoalescedMessage, so edits are rate limited on top of that.
+"""
+import time
+import typing
+
+import edits
+
+__all__ = ("TransferProgress", "format_size", "format_duration")
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GiB" % size
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    if minutes:
+        return "%d minutes and %d seconds" % (minutes, seconds)
+    return "%d seconds" % seconds
+
+
+class TransferProgress:
+    """Tracks how fast a transfer is going (as an exponentially weighted moving average), and shows its percentage,
+    rate and ETA in `message`.
+
+    Until the rate has been measured, the ETA is based on `expected_rate` (in bytes per second), if given."""
+    def __init__(
+            self,
+            message: edits.CoalescedMessage,
+            label: str,
+            total: int = None,
+            expected_rate: float = None,
+            interval: float = 1.0,
+            alpha: float = 0.3
+    ):
+        self.message = message
+        self.label = label
+        self.total = total
+        self.expected_rate = expected_rate
+        self.interval = interval
+        self.alpha = alpha
+        self.done = 0
+        self.rate: typing.Optional[float] = None
+        self.started = self.updated = time.monotonic()
+        self._sample = (self.started, 0)
+
+    def update(self, done: int, total: int = None):
+        self.done = done
+        if total:
+            self.total = total
+        now = self.updated = time.monotonic()
+        sampled_at, sampled_done = self._sample
+        if now - sampled_at < self.interval:
+            return
+        rate = (done - sampled_done) / (now - sampled_at)
+        self.rate = rate if self.rate is None else self.alpha * rate + (1 - self.alpha) * self.rate
+        self._sample = (now, done)
+        self.message.edit_nowait(self.render())
+
+    @property
+    def duration(self) -> float:
+        """How long the transfer has been going, up to its latest update."""
+        return self.updated - self.started
+
+    @property
+    def average_rate(self) -> typing.Optional[float]:
+        """The rate over the whole transfer so far, in bytes per second."""
+        duration = self.duration
+        return self.done / duration if duration > 0 and self.done else None
+
+    def eta(self) -> typing.Optional[float]:
+        rate = self.rate or self.expected_rate
+        if not rate or not self.total:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+    def render(self) -> str:
+        parts = []
+        if self.total:
+            parts.append("%d%% of %s" % (min(100.0, self.done / self.total * 100), format_size(self.total)))
+        else:
+            parts.append(format_size(self.done))
+        if self.rate is not None:
+            parts.append("%s/s" % format_size(self.rate))
+        eta = self.eta()
+        if eta is not None:
+            parts.append("ETA %s" % format_duration(eta))
+        return "%s (%s)..." % (self.label, ", ".join(parts))
@@ -0,0 +1,114 @@
+"""
+Records sync traffic to a JSONL file, for replaying later (see bench/replay.py).
+
+Each line is one of:
+
+* `{"type": "sync", "t": ..., "next_batch": ...}` - the end of a sync response
+* `{"type": "room", "t": ..., "room_id": ..., "name": ..., "encrypted": ..., "members": ...}` - the first time a room
+  is seen
+* `{"type": "event", "t": ..., "room_id": ..., "event": {...}}` - a room event, as received
+
+If the path ends in `.zst` (and `zstandard` is installed), each flush is appended as its own zstd frame.
+
+Captures contain message contents, so treat them like logs.
+"""
+import asyncio
+import io
+import json
+import logging
+import time
+import typing
+from pathlib import Path
+
+import nio
+import niobot
+
+__all__ = ("EventRecorder", "read_capture")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def read_capture(path: typing.Union[str, Path]) -> typing.Iterator[dict]:
+    """Yields the records in a capture written by EventRecorder."""
+    path = Path(path)
+    with open(path, "rb") as raw:
+        if path.suffix == ".zst":
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read %s" % path)
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            stream = raw
+        for line in io.TextIOWrapper(stream, encoding="utf-8"):
+            if line.strip():
+                yield json.loads(line)
+
+
+class EventRecorder:
+    def __init__(self, bot: niobot.NioBot, path: typing.Union[str, Path], flush_interval: float = 5.0):
+        self.bot = bot
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.compress = self.path.suffix == ".zst"
+        if self.compress and zstandard is None:
+            raise RuntimeError("zstandard must be installed to record to %s" % self.path)
+        self.seen_rooms: typing.Set[str] = set()
+        self.log = logging.getLogger(__name__)
+        self._buffer: typing.List[str] = []
+        self._flush_task: typing.Optional[asyncio.Task] = None
+
+    def install(self):
+        self.bot.add_event_callback(self.on_event, nio.Event)
+        self.bot.add_response_callback(self.on_sync, nio.SyncResponse)
+        self.log.info("Recording sync traffic to %s", self.path)
+
+    def _record(self, record: dict):
+        self._buffer.append(json.dumps(record, separators=(",", ":")))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def on_event(self, room: nio.MatrixRoom, event: nio.Event):
+        now = time.time()
+        if room.room_id not in self.seen_rooms:
+            self.seen_rooms.add(room.room_id)
+            self._record(
+                {
+                    "type": "room",
+                    "t": now,
+                    "room_id": room.room_id,
+                    "name": room.display_name,
+                    "encrypted": room.encrypted,
+                    "members": room.member_count,
+                }
+            )
+        self._record({"type": "event", "t": now, "room_id": room.room_id, "event": event.source})
+
+    async def on_sync(self, response: nio.SyncResponse):
+        self._record({"type": "sync", "t": time.time(), "next_batch": response.next_batch})
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        lines, self._buffer = self._buffer, []
+        if not lines:
+            return
+        try:
+            await niobot.run_blocking(self._write, lines)
+        except OSError as e:
+            self.log.error("Failed to write %d records to %s: %r", len(lines), self.path, e, exc_info=e)
+
+    def _write(self, lines: typing.List[str]):
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        if self.compress:
+            data = zstandard.ZstdCompressor(level=10).compress(data)
+        with open(self.path, "ab") as file:
+            file.write(data)
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
@@ -0,0 +1,107 @@
+"""
+Background sampling of process and system resource usage.
+
+Sampling CPU usage needs an interval to measure over, so rather than blocking for one on every request, a single
+background task takes a snapshot every few seconds and everything else reads the latest one (or the history).
+"""
+import asyncio
+import collections
+import csv
+import dataclasses
+import io
+import logging
+import time
+import typing
+
+import psutil
+
+__all__ = ("Snapshot", "SystemSampler")
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    timestamp: float
+    cpu_process: float
+    """Process CPU usage since the last sample, in percent of one core."""
+    cpu_system: float
+    """System-wide CPU usage since the last sample, in percent."""
+    memory_process: int
+    """Process resident set size, in bytes."""
+    memory_system: int
+    memory_pct: float
+    open_fds: typing.Optional[int]
+    """Open file descriptors. None on platforms that don't have them (i.e. windows)."""
+    threads: int
+    loop_lag: float
+    """How late the sampler's own sleep woke up, in milliseconds. A decent proxy for event loop congestion."""
+    boot_time: float
+
+
+class SystemSampler:
+    """Periodically samples resource usage, keeping the latest snapshot and a bounded history of them."""
+    def __init__(self, interval: float = 5.0, history: int = 720):
+        self.interval = interval
+        self.history: typing.Deque[Snapshot] = collections.deque(maxlen=history)
+        self.latest: typing.Optional[Snapshot] = None
+        self.process = psutil.Process()
+        self.task: typing.Optional[asyncio.Task] = None
+        self.log = logging.getLogger(__name__)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def sample(self, loop_lag: float = 0.0) -> Snapshot:
+        """Takes a snapshot. CPU percentages are relative to the previous call, so the first one reads 0."""
+        with self.process.oneshot():
+            try:
+                open_fds = self.process.num_fds()
+            except AttributeError:
+                open_fds = None
+            virtual_memory = psutil.virtual_memory()
+            return Snapshot(
+                timestamp=time.time(),
+                cpu_process=self.process.cpu_percent(None),
+                cpu_system=psutil.cpu_percent(None),
+                memory_process=self.process.memory_info().rss,
+                memory_system=virtual_memory.used,
+                memory_pct=virtual_memory.percent,
+                open_fds=open_fds,
+                threads=self.process.num_threads(),
+                loop_lag=loop_lag,
+                boot_time=psutil.boot_time(),
+            )
+
+    def snapshot(self) -> Snapshot:
+        """Returns the latest snapshot, taking one now if the sampler hasn't produced one yet."""
+        if self.latest is None:
+            self.latest = self.sample()
+        return self.latest
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.sample()  # primes the CPU counters
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            loop_lag = max(0.0, loop.time() - started - self.interval) * 1000
+            try:
+                snapshot = self.sample(loop_lag)
+            except psutil.Error as e:
+                self.log.error("Failed to sample system stats: %r", e, exc_info=e)
+                continue
+            self.latest = snapshot
+            self.history.append(snapshot)
+
+    def series(self, field: str) -> typing.List[typing.Tuple[float, typing.Any]]:
+        """Returns (timestamp, value) pairs for the given snapshot field, oldest first."""
+        return [(snapshot.timestamp, getattr(snapshot, field)) for snapshot in self.history]
+
+    def to_csv(self) -> str:
+        """Dumps the history as CSV, one row per snapshot."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([field.name for field in dataclasses.fields(Snapshot)])
+        for snapshot in self.history:
+            writer.writerow(dataclasses.astuple(snapshot))
+        return buffer.getvalue()
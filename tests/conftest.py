@@ -0,0 +1,19 @@
+import logging
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# The bot's modules read their settings from a `config` module. Tests get their own, so that a real config.py (with
+# its credentials) is never used, and nothing is written to the real store.
+config = types.ModuleType("config")
+config.HOMESERVER = "http://127.0.0.1:9"
+config.USER_ID = "@test-bot:localhost"
+config.OWNER_ID = "@owner:localhost"
+config.STORE_PATH = tempfile.mkdtemp(prefix="niobot-tests-")
+config.LOG_LEVEL = logging.WARNING
+config.LAZY_MODULES = ()
+sys.modules["config"] = config
@@ -0,0 +1,53 @@
+import asyncio
+import io
+from pathlib import Path
+
+import pytest
+
+attachments = pytest.importorskip("attachments")
+
+
+def test_small_media_stays_in_memory():
+    with attachments.media_source(b"data", ".png") as source:
+        assert isinstance(source, io.BytesIO)
+        assert source.read() == b"data"
+        assert attachments.rewind(source).read() == b"data"
+
+
+def test_large_media_spills_to_disk(monkeypatch):
+    monkeypatch.setattr(attachments, "SPILL_THRESHOLD", 4)
+    with attachments.media_source(b"too large", ".mp4") as source:
+        assert isinstance(source, Path)
+        assert source.suffix == ".mp4"
+        assert source.read_bytes() == b"too large"
+        # Paths are passed through untouched.
+        assert attachments.rewind(source) is source
+    assert not source.exists()
+
+
+def test_on_disk_overrides_size():
+    with attachments.media_source(b"data", on_disk=True) as source:
+        assert isinstance(source, Path)
+    with attachments.media_source(b"data" * 10, on_disk=False) as source:
+        assert isinstance(source, io.BytesIO)
+
+
+def test_send_uploaded_as_reply():
+    nio = pytest.importorskip("nio")
+    sent = []
+
+    class Bot:
+        async def room_send(self, room_id, message_type, content):
+            sent.append((room_id, message_type, content))
+            return nio.RoomSendResponse("$sent", room_id)
+
+    content = {"msgtype": "m.image", "body": "comic.png", "url": "mxc://example.com/abc", "info": {"size": 3}}
+    response = asyncio.run(attachments.send_uploaded(Bot(), "!room:example.com", content, reply_to="$event"))
+    assert response.event_id == "$sent"
+    assert sent == [(
+        "!room:example.com",
+        "m.room.message",
+        {**content, "m.relates_to": {"m.in_reply_to": {"event_id": "$event"}}}
+    )]
+    # The caller's content isn't modified.
+    assert "m.relates_to" not in content
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+def make_queue(size: int, overflow_size: int = 10) -> "main.BackgroundQueue":
+    queue = main.BackgroundQueue(workers=1, durable=False)
+    queue.queue = asyncio.PriorityQueue(size)
+    queue.overflow_size = overflow_size
+    return queue
+
+
+def drain(queue: "main.BackgroundQueue") -> list:
+    """Takes jobs off the queue the way a worker does, refilling from the overflow buffer after each one."""
+    order = []
+    while queue.qsize():
+        _, _, task = queue.queue.get_nowait()
+        queue._refill()
+        order.append(task)
+    return order
+
+
+def test_priority_order():
+    async def run():
+        queue = make_queue(10)
+        queue.add("cleanup", main.BackgroundQueue.PRIORITY_CLEANUP)
+        queue.add("normal-1")
+        queue.add("high", main.BackgroundQueue.PRIORITY_HIGH)
+        queue.add("normal-2")
+        return drain(queue)
+
+    assert asyncio.run(run()) == ["high", "normal-1", "normal-2", "cleanup"]
+
+
+def test_overflow_drains_in_priority_order():
+    async def run():
+        queue = make_queue(2)
+        queue.add("normal-1")
+        queue.add("normal-2")
+        queue.add("cleanup", main.BackgroundQueue.PRIORITY_CLEANUP)
+        queue.add("high", main.BackgroundQueue.PRIORITY_HIGH)
+        assert queue.qsize() == 4
+        assert len(queue.overflow) == 2
+        return drain(queue)
+
+    # The high priority job was held back behind a full queue, but moves into it (ahead of normal-2, which is still
+    # waiting) as soon as a slot frees up. It doesn't wait behind the earlier cleanup job either.
+    assert asyncio.run(run()) == ["normal-1", "high", "normal-2", "cleanup"]
+
+
+def test_overflow_is_bounded():
+    async def run():
+        queue = make_queue(1, overflow_size=1)
+        assert queue.add("queued")
+        assert queue.add("overflow")
+        assert not queue.add("dropped")
+        return drain(queue)
+
+    assert asyncio.run(run()) == ["queued", "overflow"]
+
+
+def test_dropped_coroutines_are_closed():
+    async def job():
+        pass
+
+    async def run():
+        queue = make_queue(1, overflow_size=0)
+        assert queue.add("queued")
+        coroutine = job()
+        assert not queue.add(coroutine)
+        # Closing it means there's no "never awaited" warning, and it can't be started any more.
+        with pytest.raises(RuntimeError):
+            coroutine.send(None)
+
+    asyncio.run(run())
+
+
+def test_put_waits_for_room_behind_the_overflow():
+    async def run():
+        queue = make_queue(1, overflow_size=1)
+        queue.add("queued")
+        queue.add("overflow")
+        put = asyncio.create_task(queue.put("put", main.BackgroundQueue.PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        assert not put.done()
+        # A worker takes a job, and the overflow moves up into the queue, which makes room for the waiting put.
+        _, _, first = queue.queue.get_nowait()
+        queue._refill()
+        await asyncio.wait_for(put, 1)
+        # The put went into the overflow buffer, behind the job that was already waiting there.
+        assert queue.overflow
+        return [first] + drain(queue)
+
+    assert asyncio.run(run()) == ["queued", "overflow", "put"]
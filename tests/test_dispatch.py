@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+nio = pytest.importorskip("nio")
+dispatch = pytest.importorskip("dispatch")
+
+
+class FakeBot:
+    def __init__(self, old_event_ids=()):
+        self.callbacks = []
+        self.old_event_ids = set(old_event_ids)
+
+    def add_event_callback(self, callback, event_types):
+        self.callbacks.append((callback, event_types))
+
+    def is_old(self, event) -> bool:
+        return event.event_id in self.old_event_ids
+
+
+def message(event_id: str = "$event") -> "nio.RoomMessageText":
+    return nio.RoomMessageText(
+        {"event_id": event_id, "sender": "@user:example.com", "origin_server_ts": 0},
+        "hello",
+        None,
+        None
+    )
+
+
+def room(room_id: str) -> "nio.MatrixRoom":
+    return nio.MatrixRoom(room_id, "@bot:example.com")
+
+
+def make_router(**kwargs):
+    """A router whose handlers record the (room ID, event ID) of every event they're called with."""
+    router = dispatch.RoomEventRouter(FakeBot(**kwargs))
+    calls = []
+
+    def handler(name):
+        async def handle(matrix_room, event):
+            calls.append((name, matrix_room.room_id, event.event_id))
+        return handle
+
+    return router, calls, handler
+
+
+async def dispatch_and_settle(router, *events):
+    for matrix_room, event in events:
+        await router.dispatch(matrix_room, event)
+    await asyncio.gather(*router._tasks)
+
+
+def test_routes_by_room():
+    async def run():
+        router, calls, handler = make_router()
+        router.add(handler("a"), room_id="!a:example.com")
+        router.add(handler("b"), room_id="!b:example.com")
+        await dispatch_and_settle(
+            router,
+            (room("!a:example.com"), message("$1")),
+            (room("!c:example.com"), message("$2")),
+        )
+        assert calls == [("a", "!a:example.com", "$1")]
+
+    asyncio.run(run())
+
+
+def test_predicate_routes():
+    async def run():
+        router, calls, handler = make_router()
+        router.add(handler("room"), room_id="!a:example.com")
+        router.add(handler("any"), predicate=lambda matrix_room, event: matrix_room.room_id.startswith("!a"))
+        await dispatch_and_settle(
+            router,
+            (room("!a:example.com"), message("$1")),
+            (room("!b:example.com"), message("$2")),
+        )
+        assert sorted(calls) == [("any", "!a:example.com", "$1"), ("room", "!a:example.com", "$1")]
+
+    asyncio.run(run())
+
+
+def test_event_types_and_old_events():
+    async def run():
+        router, calls, handler = make_router(old_event_ids={"$old"})
+        router.add(handler("text"), room_id="!a:example.com")
+        router.add(handler("media"), room_id="!a:example.com", event_types=(nio.RoomMessageMedia,))
+        router.add(handler("backlog"), room_id="!a:example.com", include_old=True)
+        await dispatch_and_settle(
+            router,
+            (room("!a:example.com"), message("$new")),
+            (room("!a:example.com"), message("$old")),
+        )
+        assert sorted(calls) == [
+            ("backlog", "!a:example.com", "$new"),
+            ("backlog", "!a:example.com", "$old"),
+            ("text", "!a:example.com", "$new"),
+        ]
+
+    asyncio.run(run())
+
+
+def test_remove():
+    async def run():
+        router, calls, handler = make_router()
+        handle = handler("a")
+        router.add(handle, room_id="!a:example.com")
+        router.add(handle, predicate=lambda matrix_room, event: True)
+        router.remove(handle)
+        assert not router.by_room and not router.predicates
+        await dispatch_and_settle(router, (room("!a:example.com"), message()))
+        assert calls == []
+
+    asyncio.run(run())
+
+
+def test_add_requires_exactly_one_target():
+    router, _, handler = make_router()
+    with pytest.raises(ValueError):
+        router.add(handler("a"))
+    with pytest.raises(ValueError):
+        router.add(handler("a"), room_id="!a:example.com", predicate=lambda matrix_room, event: True)
@@ -0,0 +1,32 @@
+import pytest
+
+httpx = pytest.importorskip("httpx")
+http_cache = pytest.importorskip("http_cache")
+
+
+def test_freshness_ignores_s_maxage():
+    headers = httpx.Headers({"Cache-Control": "s-maxage=600, max-age=60"})
+    assert http_cache.freshness(headers, 1000.0) == 1060.0
+
+
+def test_key_depends_on_credentials():
+    headers = httpx.Headers({"Accept": "application/json"})
+    anonymous = http_cache.HTTPCache.key_for("https://example.com/", headers)
+    authorized = http_cache.HTTPCache.key_for("https://example.com/", headers, "Bearer token")
+    assert anonymous != authorized
+
+
+def test_credentials_for():
+    client = httpx.AsyncClient()
+    request = client.build_request("GET", "https://example.com/", headers={"Authorization": "Bearer token"})
+    assert http_cache.HTTPCache.credentials_for(client, request, None) == "Bearer token"
+    assert http_cache.HTTPCache.credentials_for(client, request, ("user", "pass")) == "Bearer token\nuser:pass"
+    assert http_cache.HTTPCache.credentials_for(client, request, httpx.BasicAuth("user", "pass")) is None
+
+
+def test_vary():
+    request = httpx.Request("GET", "https://example.com/", headers={"Accept-Language": "en"})
+    response = httpx.Response(200, headers={"Vary": "Accept-Language"}, request=request)
+    assert http_cache.HTTPCache.vary_for(response) == {"accept-language": "en"}
+    response = httpx.Response(200, headers={"Vary": "*"}, request=request)
+    assert http_cache.HTTPCache.vary_for(response) is None
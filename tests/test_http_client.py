@@ -0,0 +1,77 @@
+import asyncio
+import collections
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+http_client = pytest.importorskip("http_client")
+
+
+class ConcurrencyRecorder:
+    """A mock handler that holds each request until released, and records the peak concurrency per host."""
+    def __init__(self):
+        self.in_flight = collections.Counter()
+        self.peak = collections.Counter()
+        self.release = asyncio.Event()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        self.in_flight[host] += 1
+        self.peak[host] = max(self.peak[host], self.in_flight[host])
+        try:
+            await self.release.wait()
+        finally:
+            self.in_flight[host] -= 1
+        return httpx.Response(200, content=b"ok")
+
+
+def test_per_host_limit():
+    async def run():
+        recorder = ConcurrencyRecorder()
+        clients = http_client.HTTPClients(per_host=2, transport=httpx.MockTransport(recorder))
+        client = clients.get()
+        requests = [
+            asyncio.create_task(client.get("https://%s.example.com/%d" % (host, n)))
+            for host in ("a", "b")
+            for n in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        assert recorder.in_flight == {"a.example.com": 2, "b.example.com": 2}
+        recorder.release.set()
+        responses = await asyncio.gather(*requests)
+        assert [response.status_code for response in responses] == [200] * 10
+        assert recorder.peak == {"a.example.com": 2, "b.example.com": 2}
+        await clients.aclose()
+
+    asyncio.run(run())
+
+
+def test_slot_held_until_body_closed():
+    async def run():
+        clients = http_client.HTTPClients(
+            per_host=1,
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, content=b"ok"))
+        )
+        client = clients.get()
+        streaming = await client.send(client.build_request("GET", "https://example.com/1"), stream=True)
+        waiting = asyncio.create_task(client.get("https://example.com/2"))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await streaming.aclose()
+        assert (await asyncio.wait_for(waiting, 1)).status_code == 200
+        await clients.aclose()
+
+    asyncio.run(run())
+
+
+def test_clients_are_shared_and_recreated():
+    async def run():
+        clients = http_client.HTTPClients(transport=httpx.MockTransport(lambda request: httpx.Response(204)))
+        client = clients.get()
+        assert clients.get() is client
+        assert clients.get("other") is not client
+        await clients.aclose()
+        assert clients.get() is not client
+        await clients.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+import jobs
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class Holder:
+    """Enters a slot for `owner` and holds it until released, recording the positions it was told about."""
+    def __init__(self, scheduler: jobs.JobScheduler, owner: str, name: str, started: list):
+        self.positions = []
+        self.job = None
+        self.release = asyncio.Event()
+        self.task = asyncio.create_task(self.run(scheduler, owner, name, started))
+
+    async def on_position(self, job, position):
+        self.job = job
+        self.positions.append(position)
+
+    async def run(self, scheduler, owner, name, started):
+        async with scheduler.slot(owner, name, on_position=self.on_position) as job:
+            self.job = job
+            started.append(name)
+            await self.release.wait()
+
+
+def test_concurrency_and_round_robin():
+    async def run():
+        scheduler = jobs.JobScheduler("test", concurrency=1, per_user=1)
+        started = []
+        holders = [
+            Holder(scheduler, owner, name, started)
+            for owner, name in (("alice", "a1"), ("alice", "a2"), ("alice", "a3"), ("bob", "b1"), ("carol", "c1"))
+        ]
+        await settle()
+        assert started == ["a1"]
+        assert len(scheduler) == 4
+        for holder in holders:
+            holder.release.set()
+            await settle()
+        await asyncio.gather(*(holder.task for holder in holders))
+        # alice's later jobs wait their turn behind bob's and carol's.
+        assert started == ["a1", "b1", "c1", "a2", "a3"]
+        assert not scheduler.jobs and not scheduler.running and not scheduler.waiting
+
+    asyncio.run(run())
+
+
+def test_per_user_limit():
+    async def run():
+        scheduler = jobs.JobScheduler("test", concurrency=3, per_user=1)
+        started = []
+        holders = [Holder(scheduler, owner, name, started) for owner, name in (("alice", "a1"), ("alice", "a2"))]
+        await settle()
+        assert started == ["a1"]
+        holders[0].release.set()
+        await settle()
+        assert started == ["a1", "a2"]
+        holders[1].release.set()
+        await asyncio.gather(*(holder.task for holder in holders))
+
+    asyncio.run(run())
+
+
+def test_position():
+    async def run():
+        scheduler = jobs.JobScheduler("test", concurrency=1, per_user=1)
+        started = []
+        running = Holder(scheduler, "alice", "a1", started)
+        a2 = Holder(scheduler, "alice", "a2", started)
+        b1 = Holder(scheduler, "bob", "b1", started)
+        await settle()
+        # alice has just had a turn, so bob's next, even though a2 was queued first.
+        assert scheduler.position(running.job) == 0
+        assert scheduler.position(b1.job) == 0
+        assert scheduler.position(a2.job) == 1
+        running.release.set()
+        await settle()
+        assert started == ["a1", "b1"]
+        # First in line until bob turned up, then behind him, then next.
+        assert a2.positions == [0, 1, 0]
+        assert b1.positions == [0]
+        a2.release.set()
+        b1.release.set()
+        await asyncio.gather(running.task, a2.task, b1.task)
+
+    asyncio.run(run())
+
+
+def test_cancel_queued_and_running():
+    async def run():
+        scheduler = jobs.JobScheduler("test", concurrency=1, per_user=1)
+        started = []
+        running = Holder(scheduler, "alice", "a1", started)
+        queued = Holder(scheduler, "bob", "b1", started)
+        after = Holder(scheduler, "carol", "c1", started)
+        await settle()
+
+        assert scheduler.cancel(queued.job)
+        assert not scheduler.cancel(queued.job)
+        with pytest.raises(jobs.JobCancelled):
+            await queued.task
+        assert queued.job.state == jobs.DONE
+        assert scheduler.position(after.job) == 0
+
+        assert scheduler.cancel(running.job)
+        with pytest.raises(jobs.JobCancelled) as info:
+            await running.task
+        assert info.value.job is running.job
+        await settle()
+        assert started == ["a1", "c1"]
+        after.release.set()
+        await after.task
+        assert not scheduler.cancel(after.job)
+
+    asyncio.run(run())
+
+
+def test_shutdown_is_not_a_cancelled_job():
+    async def run():
+        scheduler = jobs.JobScheduler("test", concurrency=1)
+        holder = Holder(scheduler, "alice", "a1", [])
+        await settle()
+        holder.task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await holder.task
+        assert not scheduler.running
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+import math
+
+import pytest
+
+import latency
+
+
+def test_bucket_precision():
+    histogram = latency.Histogram(precision=0.02)
+    for value in (0.5, 3.0, 12.5, 250.0, 9000.0):
+        histogram.clear()
+        histogram.record(value)
+        histogram.record(value * 10)  # So that p0 isn't clamped to the exact value.
+        assert histogram.percentile(1) == pytest.approx(value, rel=0.02)
+
+
+def test_tiny_values_share_a_bucket():
+    histogram = latency.Histogram()
+    histogram.record(0.0)
+    histogram.record(latency.Histogram.MIN_VALUE / 2)
+    assert len(histogram.buckets) == 1
+
+
+def test_percentiles():
+    histogram = latency.Histogram()
+    for value in range(1, 101):
+        histogram.record(value)
+    assert histogram.count == 100
+    assert histogram.mean == pytest.approx(50.5)
+    values = histogram.percentiles(0, 50, 95, 99, 100)
+    assert values[0] == 1
+    assert values[100] == 100
+    assert values[50] == pytest.approx(50, rel=0.02)
+    assert values[95] == pytest.approx(95, rel=0.02)
+    assert values[99] == pytest.approx(99, rel=0.02)
+
+
+def test_empty():
+    histogram = latency.Histogram()
+    assert histogram.percentiles(50, 99) == {50: None, 99: None}
+    assert histogram.mean is None
+    assert latency.LatencyTracker().summary() == "N/A"
+
+
+def test_merge():
+    a, b = latency.Histogram(), latency.Histogram()
+    for value in range(1, 51):
+        a.record(value)
+    for value in range(51, 101):
+        b.record(value)
+    a.merge(b)
+    assert a.count == 100
+    assert (a.min, a.max) == (1, 100)
+    assert a.percentile(50) == pytest.approx(50, rel=0.02)
+
+
+def test_rolling_window_expires():
+    rolling = latency.RollingHistogram(window=60, slots=6)
+    rolling.record(5.0, now=0)
+    rolling.record(500.0, now=55)
+    assert rolling.snapshot(now=59).count == 2
+    snapshot = rolling.snapshot(now=65)
+    assert snapshot.count == 1
+    assert snapshot.min == snapshot.max == 500.0
+    assert rolling.snapshot(now=200).count == 0
+    assert math.isinf(rolling.snapshot(now=200).min)
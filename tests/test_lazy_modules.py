@@ -0,0 +1,90 @@
+import asyncio
+import sys
+import textwrap
+
+import pytest
+
+niobot = pytest.importorskip("niobot")
+nio = pytest.importorskip("nio")
+lazy_modules = pytest.importorskip("lazy_modules")
+
+MODULE = "lazy_sample"
+SOURCE = '''
+import niobot
+
+RESULTS = []
+
+
+class SampleModule(niobot.Module):
+    @niobot.command()
+    async def echo(self, ctx: niobot.Context, first: str, second: str):
+        RESULTS.append((first, second))
+
+    @niobot.command()
+    @niobot.is_owner()
+    async def secret(self, ctx: niobot.Context):
+        RESULTS.append("secret")
+'''
+OWNER = "@owner:localhost"
+
+
+def make_bot(tmp_path) -> "niobot.NioBot":
+    return niobot.NioBot(
+        "http://127.0.0.1:9",
+        "@test-bot:localhost",
+        store_path=str(tmp_path / "store"),
+        command_prefix="?",
+        owner_id=OWNER
+    )
+
+
+@pytest.fixture
+def stubbed(tmp_path, monkeypatch):
+    """A bot with the sample module deferred, after a first run has recorded its manifest."""
+    (tmp_path / ("%s.py" % MODULE)).write_text(textwrap.dedent(SOURCE))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    manifest = tmp_path / "manifest.json"
+    lazy_modules.LazyModuleLoader(make_bot(tmp_path), manifest, lazy=[MODULE]).mount_all([MODULE])
+
+    bot = make_bot(tmp_path)
+    loader = lazy_modules.LazyModuleLoader(bot, manifest, lazy=[MODULE])
+    loader.mount_all([MODULE])
+    assert MODULE not in loader.loaded
+    yield bot, loader, sys.modules[MODULE].RESULTS
+    sys.modules.pop(MODULE, None)
+
+
+async def run_command(bot: "niobot.NioBot", body: str, sender: str = "@user:localhost", command=None):
+    """Invokes a command (by default, whatever the bot has under that name) the way NioBot.process_message does."""
+    event = nio.RoomMessageText.from_dict({
+        "event_id": "$event",
+        "sender": sender,
+        "origin_server_ts": 0,
+        "type": "m.room.message",
+        "content": {"msgtype": "m.text", "body": body},
+    })
+    room = nio.MatrixRoom("!room:localhost", bot.user_id)
+    name = body[1:].split(" ")[0]
+    command = command or bot.get_command(name)
+    ctx = command.construct_context(bot, room, event, "?", "?" + name)
+    return await (await command.invoke(ctx))
+
+
+def test_stub_passes_every_argument(stubbed):
+    bot, loader, results = stubbed
+    assert bot.get_command("echo").lazy_module == MODULE
+    asyncio.run(run_command(bot, "?echo one two"))
+    assert MODULE in loader.loaded
+    assert not getattr(bot.get_command("echo"), "lazy_module", None)
+    assert results == [("one", "two")]
+
+
+def test_stub_runs_the_real_checks(stubbed):
+    bot, loader, results = stubbed
+    stub = bot.get_command("secret")
+    assert not stub.checks
+    with pytest.raises(niobot.CheckFailure):
+        asyncio.run(run_command(bot, "?secret", command=stub))
+    assert results == []
+    asyncio.run(run_command(bot, "?secret", sender=OWNER, command=stub))
+    assert results == ["secret"]
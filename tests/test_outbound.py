@@ -0,0 +1,105 @@
+import asyncio
+import types
+
+import pytest
+
+outbound = pytest.importorskip("outbound")
+
+
+def test_token_bucket_burst_and_refill():
+    bucket = outbound.TokenBucket(rate=2.0, capacity=3)
+    bucket.updated = 0.0
+    for _ in range(3):
+        assert bucket.delay(0.0) == 0.0
+        bucket.take(0.0)
+    assert bucket.delay(0.0) == pytest.approx(0.5)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(0.5) == 0.0
+    # Refilling stops at the capacity, however long it's been.
+    bucket.delay(100.0)
+    assert bucket.tokens == 3
+
+
+def test_priority_for():
+    priority_for = outbound.OutboundScheduler.priority_for
+    message = {"msgtype": "m.text", "body": "hi"}
+    edit = {"msgtype": "m.text", "body": "* hi", "m.new_content": message}
+    assert priority_for("room_send", ("!a", "m.room.message", message), {}) == outbound.PRIORITY_HIGH
+    assert priority_for("room_send", ("!a",), {"message_type": "m.room.message", "content": edit}) == \
+        outbound.PRIORITY_LOW
+    assert priority_for("room_send", ("!a", "m.reaction", {}), {}) == outbound.PRIORITY_LOW
+    assert priority_for("room_redact", ("!a", "$event"), {}) == outbound.PRIORITY_LOW
+    assert priority_for("room_leave", ("!a",), {}) == outbound.PRIORITY_NORMAL
+
+
+def make_scheduler(**kwargs):
+    """A scheduler that records the rooms and labels of the calls it makes, in the order it makes them."""
+    scheduler = outbound.OutboundScheduler(types.SimpleNamespace(), **kwargs)
+    calls = []
+
+    async def method(room_id, label, result=None):
+        calls.append((room_id, label))
+        return result
+
+    return scheduler, calls, method
+
+
+def test_releases_in_priority_order():
+    async def run():
+        # One token at a time, so that everything queues up behind the first call.
+        scheduler, calls, method = make_scheduler(rate=1000, burst=1, room_rate=1000, room_burst=10)
+        submissions = [
+            ("!1", "first", outbound.PRIORITY_NORMAL),
+            ("!2", "reaction", outbound.PRIORITY_LOW),
+            ("!3", "leave", outbound.PRIORITY_NORMAL),
+            ("!4", "reply", outbound.PRIORITY_HIGH),
+        ]
+        await asyncio.gather(*(
+            scheduler.submit(room_id, method, (room_id, label), {}, priority)
+            for room_id, label, priority in submissions
+        ))
+        scheduler.task.cancel()
+        # All four are queued before the scheduler first runs, so the order is purely by priority, then age.
+        assert [label for _, label in calls] == ["reply", "first", "leave", "reaction"]
+
+    asyncio.run(run())
+
+
+def test_one_call_in_flight_per_room():
+    async def run():
+        scheduler, calls, _ = make_scheduler(rate=1000, burst=10, room_rate=1000, room_burst=10)
+        in_flight = []
+        peak = []
+
+        async def method(room_id, label):
+            in_flight.append(room_id)
+            peak.append(in_flight.count(room_id))
+            await asyncio.sleep(0.01)
+            in_flight.remove(room_id)
+            calls.append((room_id, label))
+
+        await asyncio.gather(*(
+            scheduler.submit("!a", method, ("!a", n), {}, outbound.PRIORITY_HIGH) for n in range(3)
+        ))
+        scheduler.task.cancel()
+        assert max(peak) == 1
+        assert calls == [("!a", 0), ("!a", 1), ("!a", 2)]
+
+    asyncio.run(run())
+
+
+def test_retries_when_rate_limited():
+    async def run():
+        scheduler, calls, _ = make_scheduler()
+        limited = types.SimpleNamespace(status_code="M_LIMIT_EXCEEDED", retry_after_ms=20)
+
+        async def method(room_id):
+            calls.append(room_id)
+            return limited if len(calls) == 1 else "sent"
+
+        result = await asyncio.wait_for(scheduler.submit("!a", method, ("!a",), {}, outbound.PRIORITY_HIGH), 1)
+        scheduler.task.cancel()
+        assert result == "sent"
+        assert calls == ["!a", "!a"]
+
+    asyncio.run(run())
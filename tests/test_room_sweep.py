@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+nio = pytest.importorskip("nio")
+main = pytest.importorskip("main")
+
+
+def make_room(room_id: str, joined=(), invited=()) -> "nio.MatrixRoom":
+    room = nio.MatrixRoom(room_id, main.bot.user_id)
+    for user_id in (main.bot.user_id, *joined):
+        room.add_member(user_id, None, None)
+    for user_id in invited:
+        room.add_member(user_id, None, None, invited=True)
+    room.members_synced = True
+    return room
+
+
+def test_sweep_leaves_rooms_without_other_joined_members(monkeypatch):
+    rooms = [
+        make_room("!empty:localhost"),
+        make_room("!invited:localhost", invited=("@guest:localhost",)),
+        make_room("!busy:localhost", joined=("@user:localhost",)),
+    ]
+    queue = main.BackgroundQueue(workers=1, durable=False)
+    queue.handlers = main.bot.queue.handlers
+    monkeypatch.setattr(main.bot, "queue", queue)
+    monkeypatch.setattr(main.bot, "rooms", {room.room_id: room for room in rooms})
+
+    async def run():
+        await main.sweep_empty_rooms()
+        return sorted(job.kwargs["room_id"] for _, _, job in queue.queue._queue)
+
+    # A pending invite doesn't make a room any less empty.
+    assert asyncio.run(run()) == ["!empty:localhost", "!invited:localhost"]
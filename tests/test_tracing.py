@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+
+niobot = pytest.importorskip("niobot")
+nio = pytest.importorskip("nio")
+tracing = pytest.importorskip("tracing")
+
+
+def make_bot(tmp_path) -> "niobot.NioBot":
+    return niobot.NioBot(
+        "http://127.0.0.1:9",
+        "@test-bot:localhost",
+        store_path=str(tmp_path / "store"),
+        command_prefix="?"
+    )
+
+
+def make_context(bot: "niobot.NioBot", name: str) -> "niobot.Context":
+    event = nio.RoomMessageText.from_dict({
+        "event_id": "$event",
+        "sender": "@user:localhost",
+        "origin_server_ts": 0,
+        "type": "m.room.message",
+        "content": {"msgtype": "m.text", "body": "?" + name},
+    })
+    room = nio.MatrixRoom("!room:localhost", bot.user_id)
+    return bot.get_command(name).construct_context(bot, room, event, "?", "?" + name)
+
+
+async def run_command(ctx: "niobot.Context"):
+    """Invokes a command the way NioBot.process_message does."""
+    return await (await ctx.command.invoke(ctx))
+
+
+def test_parse_phase_covers_checks(tmp_path):
+    def slow_check(ctx):
+        time.sleep(0.05)
+        return True
+
+    @niobot.check(slow_check)
+    async def slow(ctx):
+        await asyncio.sleep(0.02)
+
+    bot = make_bot(tmp_path)
+    bot.add_command(niobot.Command("slow", slow))
+    tracer = tracing.Tracer(bot)
+    tracer.install()
+    asyncio.run(run_command(make_context(bot, "slow")))
+
+    stats = tracer.stats["slow"]
+    assert stats["parse"].last >= 50
+    assert 20 <= stats["execution"].last < 50
+    assert stats["total"].last >= stats["parse"].last + stats["execution"].last
+    assert not tracer.pending
+
+
+def test_failed_check_finishes_the_trace(tmp_path):
+    @niobot.check(lambda ctx: False)
+    async def denied(ctx):
+        pass
+
+    bot = make_bot(tmp_path)
+    bot.add_command(niobot.Command("denied", denied))
+    tracer = tracing.Tracer(bot)
+    tracer.install()
+    ctx = make_context(bot, "denied")
+    with pytest.raises(niobot.CheckFailure):
+        asyncio.run(run_command(ctx))
+    # The bot reports this through the command_error event.
+    tracer.on_error(ctx)
+    assert tracer.stats["denied"]["total"].all_time.count == 1
+    assert not tracer.pending
@@ -0,0 +1,247 @@
+"""
+Per-command timing traces.
+
+Every command invocation gets a `Trace`, split into three phases:
+
+* parse - the command's checks and argument parsing (`Command.invoke`, up to it returning the callback's coroutine)
+* execution - the callback itself
+* outbound - the time, within execution, spent waiting on sends, edits, reactions and redactions
+
+Traces feed rolling per-command percentiles (see `Tracer.table`), the command metrics, and optionally a JSONL file
+for offline analysis.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import time
+import typing
+
+import niobot
+
+import latency
+import metrics
+
+__all__ = ("Trace", "Tracer", "current_trace", "span")
+
+_current: contextvars.ContextVar[typing.Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+OUTBOUND_METHODS = ("send_message", "edit_message", "delete_message", "add_reaction")
+
+
+def current_trace() -> typing.Optional["Trace"]:
+    """The trace of the command currently running in this context, if any."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name: str) -> typing.Iterator[None]:
+    """Times the block as an outbound span of the current trace (if there is one). For sends that don't go through
+    the bot's instrumented methods, such as `room_send` with prebuilt content."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, start, time.perf_counter()))
+
+
+class Trace:
+    __slots__ = ("command", "event_id", "room_id", "sender", "timestamp", "dispatched", "parsed", "started",
+                 "finished", "status", "spans")
+
+    def __init__(self, command: str, event_id: str, room_id: str, sender: str):
+        self.command = command
+        self.event_id = event_id
+        self.room_id = room_id
+        self.sender = sender
+        self.timestamp = time.time()
+        self.dispatched = time.perf_counter()
+        self.parsed: typing.Optional[float] = None
+        self.started: typing.Optional[float] = None
+        self.finished: typing.Optional[float] = None
+        self.status = "pending"
+        self.spans: typing.List[typing.Tuple[str, float, float]] = []
+
+    @classmethod
+    def from_context(cls, ctx: niobot.Context) -> "Trace":
+        return cls(ctx.command.name, ctx.message.event_id, ctx.room.room_id, ctx.message.sender)
+
+    @property
+    def parse(self) -> float:
+        return (self.parsed or self.started or self.finished) - self.dispatched
+
+    @property
+    def execution(self) -> float:
+        return self.finished - self.started if self.started is not None else 0.0
+
+    @property
+    def outbound(self) -> float:
+        return sum(end - start for _, start, end in self.spans)
+
+    @property
+    def total(self) -> float:
+        return self.finished - self.dispatched
+
+    def as_dict(self) -> dict:
+        return {
+            "command": self.command,
+            "event_id": self.event_id,
+            "room_id": self.room_id,
+            "sender": self.sender,
+            "timestamp": self.timestamp,
+            "status": self.status,
+            "parse_ms": self.parse * 1000,
+            "execution_ms": self.execution * 1000,
+            "outbound_ms": self.outbound * 1000,
+            "total_ms": self.total * 1000,
+            "spans": [
+                {"name": name, "offset_ms": (start - self.dispatched) * 1000, "duration_ms": (end - start) * 1000}
+                for name, start, end in self.spans
+            ],
+        }
+
+
+class Tracer:
+    """Wraps every command callback (and the bot's outbound methods) to produce a Trace per invocation."""
+    PHASES = ("total", "parse", "execution", "outbound")
+
+    def __init__(self, bot: niobot.NioBot, trace_file: str = None, flush_interval: float = 5.0):
+        self.bot = bot
+        self.trace_file = trace_file
+        self.flush_interval = flush_interval
+        self.pending: typing.Dict[str, Trace] = {}
+        self.stats: typing.Dict[str, typing.Dict[str, latency.LatencyTracker]] = {}
+        self.log = logging.getLogger(__name__)
+        self._buffer: typing.List[str] = []
+        self._flush_task: typing.Optional[asyncio.Task] = None
+
+    def install(self):
+        """Instruments the bot's outbound methods, and any commands mounted from now on."""
+        for name in OUTBOUND_METHODS:
+            setattr(self.bot, name, self._wrap_outbound(name, getattr(self.bot, name)))
+
+        mount_module = self.bot.mount_module
+
+        @functools.wraps(mount_module)
+        def mount_and_instrument(*args, **kwargs):
+            result = mount_module(*args, **kwargs)
+            self.instrument_commands()
+            return result
+
+        self.bot.mount_module = mount_and_instrument
+        self.instrument_commands()
+
+    @staticmethod
+    def _wrap_outbound(name: str, method: typing.Callable) -> typing.Callable:
+        @functools.wraps(method)
+        async def traced(*args, **kwargs):
+            with span(name):
+                return await method(*args, **kwargs)
+        return traced
+
+    def instrument_commands(self):
+        """Wraps the invoke method and callback of every registered command that isn't already traced."""
+        for command in set(self.bot.commands.values()):
+            if not getattr(command.invoke, "__traced__", False):
+                command.invoke = self._wrap_invoke(command.invoke)
+            if not getattr(command.callback, "__traced__", False):
+                command.callback = self._wrap_command(command)
+
+    def _wrap_invoke(self, invoke: typing.Callable) -> typing.Callable:
+        """Starts a trace when a command is invoked, which is where its checks run and its arguments are parsed."""
+        @functools.wraps(invoke)
+        async def traced(ctx: niobot.Context):
+            outer = _current.get()
+            if outer is not None and outer.event_id == ctx.message.event_id:
+                # A command invoking another for the same message (such as a lazy module stub).
+                return await invoke(ctx)
+            trace = self.pending[ctx.message.event_id] = Trace.from_context(ctx)
+            result = await invoke(ctx)
+            trace.parsed = time.perf_counter()
+            return result
+
+        traced.__traced__ = True
+        return traced
+
+    def _wrap_command(self, command) -> typing.Callable:
+        callback = command.callback
+
+        @functools.wraps(callback)
+        async def traced(*args, **kwargs):
+            ctx = next((arg for arg in args if isinstance(arg, niobot.Context)), None)
+            trace = None
+            outer = _current.get()
+            if ctx is not None and not (outer and outer.event_id == ctx.message.event_id):
+                trace = self.pending.pop(ctx.message.event_id, None) or Trace.from_context(ctx)
+            if trace is None:
+                # Either not a command context, or a command invoking another for the same message (such as a lazy
+                # module stub), which is already being traced.
+                return await callback(*args, **kwargs)
+            trace.started = time.perf_counter()
+            token = _current.set(trace)
+            status = "ok"
+            try:
+                return await callback(*args, **kwargs)
+            except BaseException:
+                status = "error"
+                raise
+            finally:
+                _current.reset(token)
+                self.finish(trace, status)
+
+        traced.__traced__ = True
+        return traced
+
+    def on_error(self, ctx: niobot.Context):
+        """Finishes a trace that failed before its callback ran. Should be called from the "command_error" event."""
+        trace = self.pending.pop(ctx.message.event_id, None)
+        if trace is not None:
+            self.finish(trace, "error")
+
+    def finish(self, trace: Trace, status: str):
+        trace.finished = time.perf_counter()
+        trace.status = status
+        stats = self.stats.get(trace.command)
+        if stats is None:
+            stats = self.stats[trace.command] = {phase: latency.LatencyTracker() for phase in self.PHASES}
+        for phase in self.PHASES:
+            stats[phase].record(getattr(trace, phase) * 1000)
+        metrics.COMMANDS.inc(command=trace.command, status=status)
+        metrics.COMMAND_DURATION.observe(trace.total, command=trace.command)
+
+        if self.trace_file:
+            self._buffer.append(json.dumps(trace.as_dict()))
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        lines, self._buffer = self._buffer, []
+        try:
+            await niobot.run_blocking(self._write, lines)
+        except OSError as e:
+            self.log.error("Failed to write %d traces to %s: %r", len(lines), self.trace_file, e, exc_info=e)
+
+    def _write(self, lines: typing.List[str]):
+        with open(self.trace_file, "a", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def table(self, window: str = "1h") -> typing.List[typing.Tuple[str, int, dict]]:
+        """Returns (command, count, {phase: (p50, p95)}) rows for the given window, busiest command first."""
+        rows = []
+        for command, stats in self.stats.items():
+            total = stats["total"].histogram(window)
+            if not total.count:
+                continue
+            phases = {}
+            for phase in self.PHASES:
+                values = stats[phase].histogram(window).percentiles(50, 95)
+                phases[phase] = (values[50], values[95])
+            rows.append((command, total.count, phases))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows
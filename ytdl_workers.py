@@ -0,0 +1,231 @@
+"""
+Long-lived yt-dlp worker processes.
+
+Extracting and downloading with yt-dlp is mostly Python (extractor matching, page parsing, YouTube's signature
+decoding), so running it in a thread holds the GIL and stalls the event loop, and a fresh process per job pays for
+importing yt-dlp and compiling every extractor's URL pattern each time. Instead, WorkerPool keeps a few worker
+processes running, already warmed up, and hands them one job at a time.
+
+Workers are plain subprocesses running this file (so they don't import the bot), and speak JSON lines: requests on
+stdin, and progress, results and errors on stdout. Each worker is replaced after `max_jobs` jobs, to cap memory
+growth, and a worker running a job that's cancelled is killed, which is the only way to stop yt-dlp mid-download.
+"""
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+import typing
+
+__all__ = ("WorkerError", "WorkerPool")
+
+# Extractors instantiated up front in each worker, on top of every extractor's URL pattern being compiled.
+PRELOAD_EXTRACTORS = ("Youtube", "YoutubeTab", "Generic")
+# Lines can carry a whole info dict, which is easily larger than asyncio's default 64KiB line limit.
+LINE_LIMIT = 256 * 1024 * 1024
+PROGRESS_KEYS = (
+    "status", "filename", "downloaded_bytes", "total_bytes", "total_bytes_estimate", "elapsed", "eta", "speed",
+    "fragment_index", "fragment_count",
+)
+
+
+class WorkerError(Exception):
+    """A job failed inside a worker (or the worker died while running it)."""
+
+
+class Worker:
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.jobs_done = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    async def _read(self) -> dict:
+        line = await self.process.stdout.readline()
+        if not line:
+            raise WorkerError("Worker %d exited (code %r)." % (self.process.pid, await self.process.wait()))
+        return json.loads(line)
+
+    async def wait_ready(self):
+        message = await self._read()
+        if message.get("event") != "ready":
+            raise WorkerError("Worker %d failed to start: %r" % (self.process.pid, message))
+
+    async def request(
+            self,
+            request: dict,
+            on_progress: typing.Optional[typing.Callable[[dict], typing.Any]] = None
+    ) -> typing.Any:
+        self.process.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+        await self.process.stdin.drain()
+        while True:
+            message = await self._read()
+            if message.get("id") != request["id"]:
+                continue
+            if message["event"] == "progress":
+                if on_progress is not None:
+                    on_progress(message["data"])
+            elif message["event"] == "error":
+                raise WorkerError(message["error"])
+            else:
+                return message["data"]
+
+    async def close(self):
+        if self.alive:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 10)
+            except asyncio.TimeoutError:
+                self.kill()
+                await self.process.wait()
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+
+
+class WorkerPool:
+    def __init__(self, size: int = 2, max_jobs: int = 25):
+        self.size = max(1, size)
+        self.max_jobs = max(1, max_jobs)
+        self.log = logging.getLogger(__name__)
+        self._idle: typing.List[Worker] = []
+        self._slots = asyncio.Semaphore(self.size)
+        self._ids = itertools.count(1)
+        self._tasks: typing.Set[asyncio.Task] = set()
+        self._closed = False
+
+    async def _spawn(self) -> Worker:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=LINE_LIMIT
+        )
+        worker = Worker(process)
+        try:
+            await worker.wait_ready()
+        except BaseException:
+            worker.kill()
+            raise
+        self.log.debug("Started worker %d", process.pid)
+        return worker
+
+    async def _replenish(self):
+        try:
+            worker = await self._spawn()
+        except (OSError, WorkerError) as e:
+            self.log.warning("Failed to start a warm worker: %r", e)
+            return
+        if self._closed:
+            await worker.close()
+        else:
+            self._idle.append(worker)
+
+    def _replenish_later(self):
+        task = asyncio.create_task(self._replenish())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def start(self):
+        """Starts `size` workers ahead of time, so that the first jobs don't wait for them to warm up."""
+        await asyncio.gather(*(self._replenish() for _ in range(self.size - len(self._idle))))
+
+    @contextlib.asynccontextmanager
+    async def _worker(self) -> typing.AsyncIterator[Worker]:
+        async with self._slots:
+            worker = None
+            while self._idle and worker is None:
+                worker = self._idle.pop()
+                if not worker.alive:
+                    worker = None
+            if worker is None:
+                worker = await self._spawn()
+            try:
+                yield worker
+            finally:
+                worker.jobs_done += 1
+                if worker.alive and worker.jobs_done < self.max_jobs and not self._closed:
+                    self._idle.append(worker)
+                else:
+                    self.log.debug("Retiring worker %d after %d jobs", worker.process.pid, worker.jobs_done)
+                    await worker.close()
+                    if not self._closed:
+                        self._replenish_later()
+
+    async def run(self, op: str, on_progress: typing.Callable[[dict], typing.Any] = None, **params) -> typing.Any:
+        """Runs `op` ("extract" or "download") in a worker, calling on_progress with yt-dlp's progress updates."""
+        async with self._worker() as worker:
+            try:
+                return await worker.request({"id": next(self._ids), "op": op, **params}, on_progress)
+            except asyncio.CancelledError:
+                worker.kill()
+                await worker.process.wait()
+                raise
+
+    async def close(self):
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(worker.close() for worker in idle), return_exceptions=True)
+
+
+def serve():
+    """The worker side: warms up yt-dlp, then runs requests from stdin until it's closed."""
+    # Anything yt-dlp prints would corrupt the protocol, so keep stdout for ourselves, and point fd 1 at stderr.
+    out = os.fdopen(os.dup(1), "w", buffering=1, encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    from yt_dlp import YoutubeDL
+    from yt_dlp.extractor import gen_extractor_classes
+
+    for extractor in gen_extractor_classes():
+        extractor.suitable("https://example.com/")
+    with YoutubeDL({"quiet": True}) as ytdl_instance:
+        for key in PRELOAD_EXTRACTORS:
+            ytdl_instance.get_info_extractor(key)
+
+    current = None
+
+    def send(**message):
+        out.write(json.dumps(message, default=repr) + "\n")
+
+    def progress_hook(status: dict):
+        if current is not None:
+            send(id=current, event="progress", data={key: status.get(key) for key in PROGRESS_KEYS})
+
+    send(event="ready")
+    for line in sys.stdin:
+        request = json.loads(line)
+        current = request["id"]
+        try:
+            args = request["args"]
+            args["progress_hooks"] = [progress_hook]
+            with YoutubeDL(args) as ytdl_instance:
+                if request["op"] == "extract":
+                    info = ytdl_instance.extract_info(request["url"], download=False)
+                    result = ytdl_instance.sanitize_info(info, remove_private_keys=request.get("secure", False))
+                elif request["op"] == "download":
+                    if request.get("info"):
+                        ytdl_instance.process_ie_result(request["info"], download=True)
+                    else:
+                        ytdl_instance.download([request["url"]])
+                    result = None
+                else:
+                    raise ValueError("Unknown op %r" % request["op"])
+            send(id=current, event="result", data=result)
+        except Exception as e:
+            send(id=current, event="error", error="%s: %s" % (type(e).__name__, e))
+        finally:
+            current = None
+
+
+if __name__ == "__main__":
+    serve()